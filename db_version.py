@@ -1,4 +1,42 @@
 """
 ALTER TABLE codebooks_bases RENAME supercodebook_id TO base_id;
 ALTER TABLE codebooks_bases RENAME subcodebook_id TO codebook_id;
+
+CREATE TABLE article_counts_projects (
+    id serial PRIMARY KEY,
+    project_id integer NOT NULL REFERENCES projects (project_id),
+    medium_id integer NOT NULL REFERENCES media (medium_id),
+    date date NOT NULL,
+    n integer NOT NULL,
+    UNIQUE (project_id, medium_id, date));
+CREATE TABLE article_counts_articlesets (
+    id serial PRIMARY KEY,
+    articleset_id integer NOT NULL REFERENCES articlesets (articleset_id),
+    medium_id integer NOT NULL REFERENCES media (medium_id),
+    date date NOT NULL,
+    n integer NOT NULL,
+    UNIQUE (articleset_id, medium_id, date));
+-- and fill them using scripts/maintenance/rebuild_article_counts.py
+
+ALTER TABLE articles ADD COLUMN content_hash character varying(40);
+CREATE INDEX articles_content_hash ON articles (content_hash);
+-- and fill it using scripts/maintenance/set_content_hashes.py
+
+-- (before rebuilding the article counts)
+DELETE FROM articlesets_articles a USING articlesets_articles b
+    WHERE a.articleset_id = b.articleset_id AND a.article_id = b.article_id AND a.id > b.id;
+CREATE UNIQUE INDEX articlesets_articles_articleset_article
+    ON articlesets_articles (articleset_id, article_id);
+
+ALTER TABLE analysis_queue ADD COLUMN claimed_by character varying(100),
+    ADD COLUMN claimed_until timestamp;
+ALTER TABLE analysis_articleset_queue ADD COLUMN claimed_by character varying(100),
+    ADD COLUMN claimed_until timestamp;
+ALTER TABLE analysis_articles ADD COLUMN claimed_by character varying(100),
+    ADD COLUMN claimed_until timestamp;
+CREATE INDEX analysis_queue_claimed_until ON analysis_queue (claimed_until);
+CREATE INDEX analysis_articleset_queue_claimed_until ON analysis_articleset_queue (claimed_until);
+CREATE INDEX analysis_articles_claimed_until ON analysis_articles (claimed_until);
+
+ALTER TABLE analysis_articles ADD COLUMN attempts integer NOT NULL DEFAULT 0;
 """
@@ -31,6 +31,7 @@ from amcat.models.plugin import *
 
 from amcat.models.word import *
 from amcat.models.analysis import *
+from amcat.models.articlecount import *
 from amcat.models.token import *
 
 
@@ -27,7 +27,10 @@ See http://code.google.com/p/amcat/wiki/Preprocessing
 """
 from __future__ import unicode_literals, print_function, absolute_import
 
-from django.db import models, transaction
+from contextlib import contextmanager
+import threading
+
+from django.db import models, transaction, connection
 
 from amcat.tools.model import AmcatModel
 from amcat.tools.djangotoolkit import receiver
@@ -39,9 +42,11 @@ from amcat.models.plugin import Plugin
 from amcat.models.project import Project
 from amcat.models.sentence import Sentence
 from amcat.tools.djangotoolkit import get_or_create
+from amcat.tools.toolkit import splitlist
+from amcat.tools.dbtoolkit import notify
 
-from django.db.models.signals import post_save, post_delete
-from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models import Q, Min, Max
 
 import logging; log = logging.getLogger(__name__)
 
@@ -68,7 +73,19 @@ class Analysis(AmcatModel):
     def __unicode__(self):
         return self.plugin.label if self.plugin else "No plugin available"
 
-class AnalysisArticleSetQueue(AmcatModel):
+class Claimable(AmcatModel):
+    """
+    Abstract base for rows that daemons claim for processing using
+    amcat.tools.dbtoolkit.claim_rows
+    """
+    claimed_by = models.CharField(max_length=100, null=True, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta():
+        abstract = True
+        app_label = 'amcat'
+
+class AnalysisArticleSetQueue(Claimable):
     """
     An articleset needed to be checked for preprocessing.
     """ 
@@ -79,16 +96,13 @@ class AnalysisArticleSetQueue(AmcatModel):
         """
         Add whole project (i.e. all articlesets) to queue. 
         """
-        AnalysisArticleSetQueue.objects.bulk_create(
-            [AnalysisArticleSetQueue(articleset=artset)
-            for artset in project.articlesets.all()]
-            )
+        add_sets_to_queue(*project.articlesets.values_list("id", flat=True))
 
     class Meta():
         db_table = 'analysis_articleset_queue'
         app_label = 'amcat'
 
-class AnalysisQueue(AmcatModel):
+class AnalysisQueue(Claimable):
     """
     An article on the Analysis Queue needs to be checked for preprocessing
     """
@@ -130,7 +144,7 @@ class AnalysisQueue(AmcatModel):
         return q[0][0]
 
 
-class AnalysisArticle(AmcatModel):
+class AnalysisArticle(Claimable):
     """
     The Article Analysis table keeps track of which articles are / need to be preprocessed
     """
@@ -142,6 +156,8 @@ class AnalysisArticle(AmcatModel):
     started= models.BooleanField(default=False)
     done = models.BooleanField(default=False)
     delete = models.BooleanField(default=False)
+    # number of times the analysis was started, see scripts.daemons.analysis
+    attempts = models.IntegerField(default=0)
 
     class Meta():
         db_table = 'analysis_articles'
@@ -225,11 +241,109 @@ class AnalysisSentence(AmcatModel):
     def __int__(self):
         return self.id
     
+# width of the article id ranges in which sets are added to the analysis queue
+QUEUE_SET_BATCH = 100000
+# number of articles per query and insert if INSERT ... SELECT cannot be used
+QUEUE_INSERT_BATCH = 1000
+
+# Notification channels for the daemons processing the queues
+QUEUE_CHANNEL = "amcat_analysis_queue"
+ARTICLESET_QUEUE_CHANNEL = "amcat_analysis_articleset_queue"
+ANALYSIS_ARTICLES_CHANNEL = "amcat_analysis_articles"
+
+# Article and set ids collected by deferred_queue, per thread
+_deferred = threading.local()
+
+@contextmanager
+def deferred_queue():
+    """
+    Context manager that collects the articles and sets added to the queues
+    in its body, and adds each of them to the queue once when the body
+    finishes without an exception. Nested use is deferred until the outermost
+    body finishes. Use inside the transaction of the unit of work, e.g.
+
+        with deferred_queue():
+            for article in articles:
+                article.save()
+    """
+    if getattr(_deferred, "aids", None) is not None:
+        yield
+        return
+    _deferred.aids, _deferred.setids = set(), set()
+    try:
+        yield
+        aids, setids = _deferred.aids, _deferred.setids
+    finally:
+        _deferred.aids, _deferred.setids = None, None
+    _queue_articles(aids)
+    _queue_sets(setids)
+
+def _queue_articles(aids):
+    if aids:
+        AnalysisQueue.objects.bulk_create(
+            [AnalysisQueue(article_id=aid) for aid in aids]
+        )
+        notify(QUEUE_CHANNEL)
+
+def _queue_sets(setids):
+    if setids:
+        AnalysisArticleSetQueue.objects.bulk_create(
+            [AnalysisArticleSetQueue(articleset_id=setid) for setid in setids]
+        )
+        notify(ARTICLESET_QUEUE_CHANNEL)
+
 # Signal handlers to make sure the article analysis queue is filled
 def add_to_queue(*aids):
-    AnalysisQueue.objects.bulk_create(
-        [AnalysisQueue(article_id=aid) for aid in aids]
-    )
+    """Add the articles to the queue, or to the deferred_queue if one is active"""
+    if getattr(_deferred, "aids", None) is not None:
+        _deferred.aids.update(aids)
+    else:
+        _queue_articles(set(aids))
+
+def add_sets_to_queue(*setids):
+    """Add the articlesets to the queue, or to the deferred_queue if one is active"""
+    if getattr(_deferred, "setids", None) is not None:
+        _deferred.setids.update(setids)
+    else:
+        _queue_sets(set(setids))
+
+def queue_articleset(articleset_id, batch=QUEUE_SET_BATCH):
+    """
+    Add the articles in the set to the analysis queue, skipping articles that
+    are already waiting on the queue. The articles are selected per range of
+    batch article ids, on postgres using INSERT ... SELECT so the ids are
+    never loaded into python.
+    @return: the number of articles added to the queue
+    """
+    ids = ArticleSetArticle.objects.filter(articleset=articleset_id).aggregate(
+        lo=Min("article"), hi=Max("article"))
+    if ids["lo"] is None:
+        return 0
+    n = 0
+    for lo in range(ids["lo"], ids["hi"] + 1, batch):
+        if connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute("""
+                INSERT INTO analysis_queue (article_id)
+                SELECT article_id FROM articlesets_articles a
+                WHERE a.articleset_id = %s AND a.article_id >= %s AND a.article_id < %s
+                AND NOT EXISTS (SELECT 1 FROM analysis_queue q
+                                WHERE q.article_id = a.article_id AND q.claimed_until IS NULL)""",
+                           [articleset_id, lo, lo + batch])
+            n += cursor.rowcount
+        else:
+            aids = list(ArticleSetArticle.objects.filter(
+                articleset=articleset_id, article__gte=lo, article__lt=lo + batch
+            ).values_list("article_id", flat=True))
+            for chunk in splitlist(aids, QUEUE_INSERT_BATCH):
+                queued = set(AnalysisQueue.objects.filter(article__in=chunk, claimed_until__isnull=True)
+                             .values_list("article_id", flat=True))
+                new = [aid for aid in chunk if aid not in queued]
+                AnalysisQueue.objects.bulk_create([AnalysisQueue(article_id=aid) for aid in new])
+                n += len(new)
+    if n:
+        notify(QUEUE_CHANNEL)
+    return n
 
 @receiver([post_save, post_delete], Article)
 def handle_article(sender, instance, **kargs):
@@ -239,9 +353,19 @@ def handle_article(sender, instance, **kargs):
 def handle_articlesetarticle(sender, instance, **kargs):
     add_to_queue(instance.article_id)
 
+@receiver([pre_save], Project)
+def handle_project_pre_save(sender, instance, **kargs):
+    instance._old_active = None
+    if instance.pk is not None:
+        old = Project.objects.filter(pk=instance.pk).values_list("active", flat=True)
+        instance._old_active = old[0] if old else None
+
 @receiver([post_save], Project)
-def handle_project(sender, instance, **kargs11):
-    AnalysisArticleSetQueue.add_project(instance)
+def handle_project(sender, instance, created=False, **kargs):
+    # only (de)activating a project can change what needs to be analysed,
+    # changes in its analyses are handled by handle_projectanalysis
+    if created or getattr(instance, "_old_active", None) != instance.active:
+        AnalysisArticleSetQueue.add_project(instance)
 
 @receiver([post_save, post_delete], AnalysisProject)
 def handle_projectanalysis(sender, instance, **kargs):
@@ -249,7 +373,7 @@ def handle_projectanalysis(sender, instance, **kargs):
 
 @receiver([post_save], ArticleSet)
 def handle_articleset(sender, instance, **kargs):
-    AnalysisArticleSetQueue(articleset=instance).save()
+    add_sets_to_queue(instance.id)
 
 
 ###########################################################################
@@ -257,6 +381,7 @@ def handle_articleset(sender, instance, **kargs):
 ###########################################################################
 
 from amcat.tools import amcattest
+import datetime
 
 class TestAnalysis(amcattest.PolicyTestCase):
 
@@ -323,12 +448,19 @@ class TestAnalysis(amcattest.PolicyTestCase):
         self.assertNotEqual(a.project, b.project)
         s.add(b)
 
+        a.project.active=False
+        a.project.save()
         self._flush_queue()
         a.project.active=True
         a.project.save()
         self.assertIn(a.id, self._all_articles())
         self.assertIn(b.id, self._all_articles())
 
+        # saving the project without changing it does not queue its sets
+        AnalysisArticleSetQueue.objects.all().delete()
+        a.project.save()
+        self.assertFalse(AnalysisArticleSetQueue.objects.filter(articleset=s).exists())
+
         self._flush_queue()
         n = amcattest.create_test_analysis()
         AnalysisProject.objects.create(project=a.project, analysis=n)
@@ -338,6 +470,62 @@ class TestAnalysis(amcattest.PolicyTestCase):
 
 
 
+    def test_deferred_queue(self):
+        """Are articles queued once, when the deferred queue finishes?"""
+        a = amcattest.create_test_article()
+        self._flush_queue()
+        with deferred_queue():
+            for i in range(3):
+                a.headline = "headline %i" % i
+                a.save()
+                with deferred_queue():
+                    a.save()
+            self.assertNotIn(a.id, self._all_articles())
+        self.assertEqual([sa.article_id for sa in AnalysisQueue.objects.all()], [a.id])
+
+        # nothing is queued if the unit of work fails
+        self._flush_queue()
+        try:
+            with deferred_queue():
+                a.save()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertNotIn(a.id, self._all_articles())
+        add_to_queue(a.id)
+        self.assertIn(a.id, self._all_articles())
+
+    def test_claim_rows(self):
+        """Are claimed rows not claimed again until their lease expires?"""
+        from amcat.tools.dbtoolkit import claim_rows
+        arts = [amcattest.create_test_article() for _x in range(5)]
+        self._flush_queue()
+        add_to_queue(*[a.id for a in arts])
+        queue = AnalysisQueue.objects.all()
+        claimed1 = claim_rows(queue, 3, worker="w1")
+        claimed2 = claim_rows(queue, 10, worker="w2")
+        self.assertEqual(len(claimed1), 3)
+        self.assertFalse(set(claimed1) & set(claimed2))
+        self.assertEqual(set(claimed1) | set(claimed2), set(queue.values_list("id", flat=True)))
+        self.assertEqual(claim_rows(queue, 10, worker="w3"), [])
+
+        # expired leases are claimed again
+        AnalysisQueue.objects.filter(pk__in=claimed1).update(claimed_until=datetime.datetime(2000, 1, 1))
+        self.assertEqual(set(claim_rows(queue, 10, worker="w3")), set(claimed1))
+
+    def test_queue_articleset(self):
+        """Are the articles in a set queued once, in id range batches?"""
+        arts = [amcattest.create_test_article() for _x in range(5)]
+        s = amcattest.create_test_set()
+        s.add(*arts)
+        self._flush_queue()
+        add_to_queue(arts[0].id)
+        self.assertEqual(queue_articleset(s.id, batch=2), 4)
+        self.assertEqual(sorted(AnalysisQueue.objects.values_list("article_id", flat=True)),
+                         sorted(a.id for a in arts))
+        self.assertEqual(queue_articleset(s.id), 0)
+        self.assertEqual(queue_articleset(amcattest.create_test_set().id), 0)
+
     @classmethod
     def _flush_queue(cls):
         """Flush the articles queue"""
@@ -27,7 +27,7 @@ from amcat.tools.model import AmcatModel
 from amcat.models.authorisation import Role
 from amcat.models.medium import Medium
 
-from django.db import models
+from django.db import models, connection, transaction
 
 import logging
 from amcat.tools.caching import RowCacheManager
@@ -35,9 +35,14 @@ from amcat.tools.caching import RowCacheManager
 log = logging.getLogger(__name__)
 
 import re
+import hashlib
+from collections import Counter
+
+from amcat.tools.toolkit import splitlist
 
 WORD_RE = re.compile('[{L}{N}]+') # {L} --> All (unicode) letters
                                   # {N} --> All numbers
+HASH_WORD_RE = re.compile(r"\w+", re.UNICODE)
 
 def word_len(txt):
     """Count words in `txt`
@@ -46,6 +51,18 @@ def word_len(txt):
     if not txt: return 0 # Safe handling of txt=None
     return len(re.sub(WORD_RE, ' ', txt).split())
 
+def content_hash(text):
+    """Return the sha1 hex digest of the words of `text`, ignoring case, whitespace and punctuation"""
+    words = HASH_WORD_RE.findall((text or "").lower())
+    return hashlib.sha1(" ".join(words).encode("utf-8")).hexdigest()
+
+def _reserve_ids(model, n):
+    """Return n new values from the sequence of the model's primary key"""
+    cursor = connection.cursor()
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                   [model._meta.db_table, model._meta.pk.column, n])
+    return [aid for (aid,) in cursor.fetchall()]
+
 class Article(AmcatModel):
     """
     Class representing a newspaper article
@@ -68,6 +85,8 @@ class Article(AmcatModel):
     #sets = models.ManyToManyField("amcat.Set", db_table="sets_articles")
 
     text = models.TextField()
+    # see content_hash, used to find duplicates
+    content_hash = models.CharField(max_length=40, null=True, blank=True, db_index=True)
 
     parent = models.ForeignKey("self", null=True, db_column="parent_article_id",
                                db_index=True, blank=True)
@@ -88,9 +107,48 @@ class Article(AmcatModel):
     def save(self, *args, **kwargs):
         if self.length is None:
             self.length = word_len(self.text)
+        self.content_hash = content_hash(self.text)
 
         super(Article, self).save(*args, **kwargs)
 
+    @classmethod
+    def create_articles(cls, articles, articleset=None, batch=1000):
+        """
+        Save the given new articles using batched inserts, add them to the
+        articleset (if given) and queue them for analysis. As no signals are
+        sent for the individual articles, the article counts and analysis
+        queue are updated for all articles at once.
+
+        @return: the list of articles, with their ids set
+        """
+        articles = list(articles)
+        for a in articles:
+            if a.length is None:
+                a.length = word_len(a.text)
+            a.content_hash = content_hash(a.text)
+
+        if connection.vendor != 'postgresql':
+            # ids can only be reserved in advance from a postgres sequence
+            for a in articles:
+                a.save()
+        else:
+            new = [a for a in articles if a.id is None]
+            for a, aid in zip(new, _reserve_ids(cls, len(new))):
+                a.id = aid
+            for arts in splitlist(articles, batch):
+                cls.objects.bulk_create(arts)
+
+            from amcat.models.articlecount import ProjectArticleCount
+            from amcat.models.analysis import add_to_queue
+            to_date = cls._meta.get_field("date").to_python
+            counts = Counter((a.project_id, a.medium_id, to_date(a.date).date()) for a in articles)
+            ProjectArticleCount.increment_many(counts)
+            add_to_queue(*[a.id for a in articles])
+
+        if articleset is not None:
+            articleset.add(*articles)
+        return articles
+
 
     def words(self):
         "@return: a generator yielding all words in all sentences"
@@ -126,6 +184,20 @@ class Article(AmcatModel):
 
 
 
+def set_content_hashes(batch=1000):
+    """Compute the content hash of all articles that don't have one yet"""
+    last = 0
+    while True:
+        rows = list(Article.objects.filter(content_hash__isnull=True, id__gt=last)
+                    .order_by("id").values_list("id", "text")[:batch])
+        if not rows:
+            break
+        with transaction.commit_on_success():
+            for aid, text in rows:
+                Article.objects.filter(pk=aid).update(content_hash=content_hash(text))
+        last = rows[-1][0]
+        log.info("Set content hash of articles up to {last}".format(**locals()))
+
 ###########################################################################
 #                          U N I T   T E S T S                            #
 ###########################################################################
@@ -138,6 +210,28 @@ class TestArticle(amcattest.PolicyTestCase):
         a = amcattest.create_test_article()
         self.assertIsNotNone(a)
 
+    def test_create_articles(self):
+        """Are articles created in bulk added to the set and the analysis queue?"""
+        from amcat.models.analysis import AnalysisQueue
+        p, m = amcattest.create_test_project(), amcattest.create_test_medium()
+        s = amcattest.create_test_set(project=p)
+        arts = [Article(project=p, medium=m, date="2010-01-01", headline="bulk %i" % i,
+                        text="een twee drie") for i in range(5)]
+        Article.create_articles(arts, articleset=s, batch=2)
+        self.assertTrue(all(a.id for a in arts))
+        self.assertEqual(set(s.articles.all()), set(arts))
+        self.assertEqual(set(a.length for a in Article.objects.filter(pk__in=[a.id for a in arts])), {3})
+        queued = set(AnalysisQueue.objects.values_list("article_id", flat=True))
+        self.assertTrue(queued >= set(a.id for a in arts))
+
+    def test_content_hash(self):
+        a = amcattest.create_test_article(text="Dit is een test.")
+        b = amcattest.create_test_article(text="dit is  een\ntest")
+        c = amcattest.create_test_article(text="dit is geen test")
+        self.assertEqual(a.content_hash, b.content_hash)
+        self.assertNotEqual(a.content_hash, c.content_hash)
+        self.assertEqual(set(Article.objects.filter(content_hash=a.content_hash)), {a, b})
+
     def test_unicode(self):
         """Test unicode headlines"""
         for offset in range(1, 10000, 1000):
@@ -0,0 +1,238 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Model module for the article count rollups, which contain the number of
+articles per project or article set, medium and day. They are kept up to
+date by the signal handlers below (and by ArticleSet.add, which bypasses
+signals), and can be recreated using rebuild_article_counts.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+from collections import Counter
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Sum
+from django.db.models.signals import pre_save, post_save, pre_delete
+
+from amcat.tools.model import AmcatModel
+from amcat.tools.djangotoolkit import receiver
+from amcat.tools.toolkit import splitlist
+from amcat.models.article import Article
+from amcat.models.articleset import ArticleSet, ArticleSetArticle
+from amcat.models.medium import Medium
+from amcat.models.project import Project
+
+import logging; log = logging.getLogger(__name__)
+
+def _day(date):
+    """Get the day of an article date, which may not have been converted from a string yet"""
+    return Article._meta.get_field("date").to_python(date).date()
+
+class ArticleCount(AmcatModel):
+    """Number of articles of the owner (a project or set) per medium and day"""
+    owner_field = None
+
+    medium = models.ForeignKey(Medium)
+    date = models.DateField()
+    n = models.IntegerField(default=0)
+
+    class Meta():
+        abstract = True
+        app_label = 'amcat'
+
+    @classmethod
+    def increment(cls, owner_id, medium_id, date, delta=1):
+        """Add delta to the count for the given owner, medium and day"""
+        key = {cls.owner_field + "_id" : owner_id, "medium_id" : medium_id, "date" : date}
+        if cls.objects.filter(**key).update(n=F("n") + delta) or delta < 0:
+            return
+        sid = transaction.savepoint()
+        try:
+            cls.objects.create(n=delta, **key)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # created concurrently by another process
+            transaction.savepoint_rollback(sid)
+            cls.objects.filter(**key).update(n=F("n") + delta)
+
+    @classmethod
+    def increment_many(cls, counts, sign=1):
+        """Add the counts from a {(owner_id, medium_id, day) : n} dict"""
+        for (owner_id, medium_id, date), n in counts.iteritems():
+            cls.increment(owner_id, medium_id, date, sign * n)
+
+class ProjectArticleCount(ArticleCount):
+    owner_field = "project"
+    project = models.ForeignKey(Project)
+
+    class Meta():
+        db_table = 'article_counts_projects'
+        app_label = 'amcat'
+        unique_together = ('project', 'medium', 'date')
+
+class ArticleSetArticleCount(ArticleCount):
+    owner_field = "articleset"
+    articleset = models.ForeignKey(ArticleSet)
+
+    class Meta():
+        db_table = 'article_counts_articlesets'
+        app_label = 'amcat'
+        unique_together = ('articleset', 'medium', 'date')
+
+    @classmethod
+    def add_articles(cls, articleset_id, article_ids, sign=1):
+        """Update the counts for articles added to (or removed from) the set in bulk"""
+        counts = Counter()
+        for ids in splitlist(list(article_ids), 1000):
+            for medium_id, date in Article.objects.filter(pk__in=ids).values_list("medium", "date"):
+                counts[articleset_id, medium_id, _day(date)] += 1
+        cls.increment_many(counts, sign)
+
+def count_articles(projects=None, articlesets=None, mediums=None, startDate=None, endDate=None):
+    """
+    Return a list of (day, medium_id, n) tuples from the rollup for the articles
+    in the given set, or if no set is given, the given projects. Only one set
+    can be given, as articles in several sets would be counted once per set.
+    The start day is inclusive, the end day is exclusive.
+    """
+    if articlesets and len(articlesets) > 1:
+        raise ValueError("The rollup can only count the articles of a single set")
+    if articlesets:
+        q = ArticleSetArticleCount.objects.filter(articleset__in=articlesets)
+    elif projects:
+        q = ProjectArticleCount.objects.filter(project__in=projects)
+    else:
+        raise ValueError("Either projects or article sets needs to be specified")
+    if mediums:
+        q = q.filter(medium__in=mediums)
+    if startDate:
+        q = q.filter(date__gte=startDate)
+    if endDate:
+        q = q.filter(date__lt=endDate)
+    q = q.values_list("date", "medium").annotate(total=Sum("n")).order_by()
+    return [(date, medium_id, n) for (date, medium_id, n) in q if n]
+
+@transaction.commit_on_success
+def rebuild_article_counts():
+    """Recreate the article count rollups from the articles and article sets"""
+    for model, q in [(ProjectArticleCount, Article.objects.values_list("project", "medium", "date")),
+                     (ArticleSetArticleCount, ArticleSetArticle.objects.values_list(
+                         "articleset", "article__medium", "article__date"))]:
+        counts = Counter()
+        for owner_id, medium_id, date, n in q.annotate(n=models.Count("id")).order_by().iterator():
+            counts[owner_id, medium_id, date.date()] += n
+        model.objects.all().delete()
+        for batch in splitlist(counts.items(), 1000):
+            model.objects.bulk_create([model(n=n, medium_id=medium_id, date=date,
+                                             **{model.owner_field + "_id" : owner_id})
+                                       for ((owner_id, medium_id, date), n) in batch])
+        log.info("Rebuilt {model.__name__}: {n} rows".format(n=len(counts), **locals()))
+
+# Signal handlers to keep the counts up to date
+
+def _article_counts(project_id, medium_id, date, article_id):
+    """Return the project and set counts for a single article"""
+    day = _day(date)
+    sets = ArticleSetArticle.objects.filter(article=article_id).values_list("articleset_id", flat=True)
+    return {(project_id, medium_id, day) : 1}, dict(((s, medium_id, day), 1) for s in sets)
+
+@receiver([pre_save], Article)
+def handle_article_pre_save(sender, instance, **kargs):
+    instance._old_count_key = None
+    if instance.pk is not None:
+        old = Article.objects.filter(pk=instance.pk).values_list("project", "medium", "date")
+        instance._old_count_key = old[0] if old else None
+
+@receiver([post_save], Article)
+def handle_article_count(sender, instance, created=False, **kargs):
+    if created:
+        ProjectArticleCount.increment(instance.project_id, instance.medium_id, _day(instance.date))
+        return
+    old = getattr(instance, "_old_count_key", None)
+    if old is not None and (old[0], old[1], _day(old[2])) == (instance.project_id, instance.medium_id,
+                                                             _day(instance.date)):
+        return
+    if old is not None:
+        projects, sets = _article_counts(old[0], old[1], old[2], instance.pk)
+        ProjectArticleCount.increment_many(projects, -1)
+        ArticleSetArticleCount.increment_many(sets, -1)
+    projects, sets = _article_counts(instance.project_id, instance.medium_id, instance.date, instance.pk)
+    ProjectArticleCount.increment_many(projects)
+    ArticleSetArticleCount.increment_many(sets)
+
+@receiver([pre_delete], Article)
+def handle_article_delete_count(sender, instance, **kargs):
+    # set memberships are deleted (and counted) by the cascading delete
+    ProjectArticleCount.increment(instance.project_id, instance.medium_id, _day(instance.date), -1)
+
+@receiver([post_save], ArticleSetArticle)
+def handle_articlesetarticle_count(sender, instance, created=False, **kargs):
+    if created:
+        ArticleSetArticleCount.add_articles(instance.articleset_id, [instance.article_id])
+
+@receiver([pre_delete], ArticleSetArticle)
+def handle_articlesetarticle_delete_count(sender, instance, **kargs):
+    ArticleSetArticleCount.add_articles(instance.articleset_id, [instance.article_id], sign=-1)
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+import datetime
+
+class TestArticleCount(amcattest.PolicyTestCase):
+
+    def test_counts(self):
+        """Are the counts kept up to date when articles and sets change?"""
+        p = amcattest.create_test_project()
+        m1, m2 = [amcattest.create_test_medium() for _x in range(2)]
+        d1, d2 = datetime.date(2010, 1, 1), datetime.date(2010, 1, 2)
+        a1 = amcattest.create_test_article(project=p, medium=m1, date="2010-01-01")
+        a2 = amcattest.create_test_article(project=p, medium=m1, date="2010-01-01")
+        a3 = amcattest.create_test_article(project=p, medium=m2, date="2010-01-02")
+        self.assertEqual(set(count_articles(projects=[p])), {(d1, m1.id, 2), (d2, m2.id, 1)})
+
+        s = amcattest.create_test_set()
+        s.add(a1, a3)
+        self.assertEqual(set(count_articles(articlesets=[s])), {(d1, m1.id, 1), (d2, m2.id, 1)})
+
+        # changing an article moves it in both the project and set counts
+        a1.medium = m2
+        a1.save()
+        self.assertEqual(set(count_articles(projects=[p])),
+                         {(d1, m1.id, 1), (d1, m2.id, 1), (d2, m2.id, 1)})
+        self.assertEqual(set(count_articles(articlesets=[s], mediums=[m2])),
+                         {(d1, m2.id, 1), (d2, m2.id, 1)})
+        self.assertEqual(set(count_articles(articlesets=[s], startDate=d2)), {(d2, m2.id, 1)})
+        self.assertEqual(set(count_articles(articlesets=[s], endDate=d2)), {(d1, m2.id, 1)})
+        self.assertRaises(ValueError, count_articles, articlesets=[s, amcattest.create_test_set()])
+
+        s.remove(a3)
+        a2.delete()
+        self.assertEqual(set(count_articles(articlesets=[s])), {(d1, m2.id, 1)})
+        self.assertEqual(set(count_articles(projects=[p])), {(d1, m2.id, 1), (d2, m2.id, 1)})
+
+        # does a rebuild give the same counts?
+        before = set(count_articles(projects=[p])), set(count_articles(articlesets=[s]))
+        rebuild_article_counts()
+        self.assertEqual((set(count_articles(projects=[p])), set(count_articles(articlesets=[s]))),
+                         before)
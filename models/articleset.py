@@ -28,7 +28,15 @@ from amcat.tools.djangotoolkit import get_or_create
 
 from amcat.models.article import Article
 
-from django.db import models
+from amcat.tools.toolkit import splitlist
+
+from django.db import models, connection
+
+from cStringIO import StringIO
+
+# number of articles per query (or COPY on postgres) when adding articles to a set
+ADD_BATCH = 1000
+COPY_BATCH = 100000
 
 def get_or_create_articleset(name, project):
     """
@@ -53,6 +61,31 @@ def _articles_to_ids(articles):
     for art in articles:
         yield art if type(art) is int else art.id
 
+def _copy_articles(articleset_id, article_ids):
+    """
+    Add the articles to the set using COPY into a temporary table and a single
+    INSERT of the articles that are not yet in the set.
+
+    @return: a {(articleset_id, medium_id, day) : n} dict of the added articles
+    """
+    cursor = connection.cursor()
+    cursor.execute("DROP TABLE IF EXISTS articleset_add")
+    cursor.execute("CREATE TEMPORARY TABLE articleset_add (article_id integer)")
+    for ids in splitlist(list(article_ids), COPY_BATCH):
+        cursor.copy_from(StringIO("".join("%i\n" % aid for aid in ids)), "articleset_add")
+    cursor.execute("""
+        WITH added AS (
+            INSERT INTO articlesets_articles (articleset_id, article_id)
+            SELECT %s, article_id FROM articleset_add n
+            WHERE NOT EXISTS (SELECT 1 FROM articlesets_articles a
+                              WHERE a.articleset_id = %s AND a.article_id = n.article_id)
+            RETURNING article_id)
+        SELECT medium_id, date::date, count(*) FROM added JOIN articles USING (article_id)
+        GROUP BY medium_id, date::date""", [articleset_id, articleset_id])
+    counts = dict(((articleset_id, medium_id, day), n) for (medium_id, day, n) in cursor.fetchall())
+    cursor.execute("DROP TABLE articleset_add")
+    return counts
+
 class ArticleSet(AmcatModel):
     """
     Model for the sets table. A set is part of a project and contains articles.
@@ -86,13 +119,31 @@ class ArticleSet(AmcatModel):
         pass
         
     def add(self, *articles):
-        ArticleSetArticle.objects.bulk_create(
-            [ArticleSetArticle(articleset=self, article_id=artid)\
-             for artid in _articles_to_ids(articles)]
-        )
+        """
+        Add the given articles (or article ids) to this set, skipping articles
+        that are already in the set. The articles are added in chunks, on
+        postgres using COPY into a temporary table.
+        """
+        # bulk inserts send no signals, so update the article counts explicitly
+        from amcat.models.articlecount import ArticleSetArticleCount
+        article_ids = set(_articles_to_ids(articles))
+        if connection.vendor == 'postgresql':
+            ArticleSetArticleCount.increment_many(_copy_articles(self.id, article_ids))
+            return
+        for ids in splitlist(list(article_ids), ADD_BATCH):
+            existing = set(ArticleSetArticle.objects.filter(articleset=self, article__in=ids)
+                           .values_list("article_id", flat=True))
+            new = [artid for artid in ids if artid not in existing]
+            ArticleSetArticle.objects.bulk_create(
+                [ArticleSetArticle(articleset=self, article_id=artid)\
+                 for artid in new]
+            )
+            ArticleSetArticleCount.add_articles(self.id, new)
         
     def remove(self, *articles):
-        ArticleSetArticle.objects.filter(articleset=self, article__in=articles).delete()
+        from amcat.models.analysis import deferred_queue
+        with deferred_queue():
+            ArticleSetArticle.objects.filter(articleset=self, article__in=articles).delete()
     
 class ArticleSetArticle(AmcatModel):
     """
@@ -106,6 +157,7 @@ class ArticleSetArticle(AmcatModel):
     class Meta():
         app_label = 'amcat'
         db_table="articlesets_articles"
+        unique_together = ('articleset', 'article')
     
     
 ###########################################################################
@@ -123,4 +175,13 @@ class TestArticleSet(amcattest.PolicyTestCase):
             s.add(amcattest.create_test_article())
         self.assertEqual(i, len(s.articles.all()))
 
+    def test_add_existing(self):
+        """Are articles that are already in the set skipped?"""
+        s = amcattest.create_test_set()
+        a, b = [amcattest.create_test_article() for _x in range(2)]
+        s.add(a)
+        s.add(a, b, b.id)
+        self.assertEqual(ArticleSetArticle.objects.filter(articleset=s).count(), 2)
+        self.assertEqual(set(s.articles.all()), {a, b})
+
         
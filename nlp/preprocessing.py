@@ -27,11 +27,17 @@ from amcat.models import Sentence
 from amcat.models.article import Article
 from amcat.models.articleset import ArticleSetArticle
 from amcat.models.analysis import AnalysisProject, AnalysisArticle, AnalysisSentence, Analysis
+from amcat.models.analysis import ANALYSIS_ARTICLES_CHANNEL
+from amcat.tools.dbtoolkit import notify
 from amcat.nlp.sbd import SBD
-from amcat.tools.toolkit import multidict
+from amcat.tools.toolkit import multidict, splitlist
+from collections import defaultdict
 
 import logging; log = logging.getLogger(__name__)
 
+# number of objects per batched insert
+INSERT_BATCH = 1000
+
 def _get_active_project_ids(articleids):
     """
     Get all active project ids that the articles are a part of, either directly or
@@ -115,15 +121,50 @@ def split_article(article):
         sentence.save()
     return sentences
 
+def split_articles(articleids):
+    """
+    Split the given articles and store their sentences using batched inserts
+
+    @return: a {article id : [sentence ids]} dict
+    """
+    sbd = SBD()
+    articles = Article.objects.filter(pk__in=articleids).only("id", "headline", "byline", "text")
+    sentences = [sentence for article in articles for sentence in sbd.get_sentences(article)]
+    for batch in splitlist(sentences, INSERT_BATCH):
+        Sentence.objects.bulk_create(batch)
+    return _get_sentence_ids(articleids)
+
+def _get_sentence_ids(articleids):
+    """@return: a {article id : [sentence ids]} dict for the articles that have sentences"""
+    result = defaultdict(list)
+    for aid, sid in Sentence.objects.filter(article__in=articleids).values_list("article", "id"):
+        result[aid].append(sid)
+    return result
+
+def _create_analysis_sentences(analysis_articles):
+    """
+    Create the AnalysisSentence objects for the given analysis articles using
+    batched inserts, splitting the articles that have no sentences yet
+    """
+    articleids = set(aa.article_id for aa in analysis_articles)
+    sentences = _get_sentence_ids(articleids)
+    missing = articleids - set(sentences)
+    if missing:
+        sentences.update(split_articles(missing))
+    analysis_sentences = [AnalysisSentence(analysis_article_id=aa.id, sentence_id=sid)
+                          for aa in analysis_articles for sid in sentences.get(aa.article_id, [])]
+    for batch in splitlist(analysis_sentences, INSERT_BATCH):
+        AnalysisSentence.objects.bulk_create(batch)
+
 def create_sentences_articles(analysis_articles):
     """
     Create AnalysisSentence objects for the given articles where needed
     """
     anids = set(aa.analysis_id for aa in analysis_articles)
     sentence_analyses = set(pk for (pk,) in Analysis.objects.filter(pk__in=anids, sentences=True).values_list("pk"))
-    for aa in analysis_articles:
-        if aa.analysis_id in sentence_analyses:
-            create_sentences(aa)
+    aas = [aa for aa in analysis_articles if aa.analysis_id in sentence_analyses]
+    if aas:
+        _create_analysis_sentences(aas)
 
 
 def create_sentences(analysis_article):
@@ -144,15 +185,25 @@ def set_preprocessing_actions(articleids):
     required, restarts, deletions, undeletions = _get_articles_preprocessing_actions(articleids)
 
     if required:
-        aas = [AnalysisArticle.objects.create(article_id=artid, analysis_id=anid)
-               for artid, anid in required]
-        create_sentences_articles(aas)
+        for batch in splitlist(list(required), INSERT_BATCH):
+            AnalysisArticle.objects.bulk_create([AnalysisArticle(article_id=artid, analysis_id=anid)
+                                                 for artid, anid in batch])
+        # bulk_create does not set the ids, so retrieve the created objects that need sentences
+        aas = [aa for aa in AnalysisArticle.objects.filter(
+                   article__in={artid for (artid, anid) in required},
+                   analysis__in={anid for (artid, anid) in required}, analysis__sentences=True)
+               if (aa.article_id, aa.analysis_id) in required]
+        if aas:
+            _create_analysis_sentences(aas)
     if deletions:
         AnalysisArticle.objects.filter(id__in=deletions).update(delete=True)
     if undeletions:
         AnalysisArticle.objects.filter(id__in=undeletions).update(delete=False)
     if restarts:
-        AnalysisArticle.objects.filter(id__in=restarts).update(started=False, done=False)
+        AnalysisArticle.objects.filter(id__in=restarts).update(started=False, done=False, attempts=0,
+                                                               claimed_by=None, claimed_until=None)
+    if required or restarts:
+        notify(ANALYSIS_ARTICLES_CHANNEL)
 
 
 ###########################################################################
@@ -185,9 +236,9 @@ class TestPreprocessing(amcattest.PolicyTestCase):
 
         # test addition: activate analysis 1 on p1
         AnalysisProject.objects.create(project=p1, analysis=n1)
-        with self.checkMaxQueries(n=8):
+        with self.checkMaxQueries(n=9):
             # 4 for querying, 1 for mutations,
-            # 2 for checking sentence, 1 for creating sentences
+            # 2 for checking sentence, 1 for creating sentences, 1 for notifying
             set_preprocessing_actions(articles)
         self.assertEqual(self._get_analyses(articles), {(a1.id, n1.id) : False})
         s, = AnalysisSentence.objects.filter(analysis_article__article=a1)
@@ -397,6 +448,25 @@ class TestPreprocessing(amcattest.PolicyTestCase):
         sents = list(a.sentences.all())
         self.assertEqual(len(sents), 3)
 
+    def test_split_articles(self):
+        a1 = amcattest.create_test_article(headline="kop", text="Een eerste zin. En een tweede")
+        a2 = amcattest.create_test_article(headline="nog een kop", text="Een zin")
+        with self.checkMaxQueries(n=3): # articles, sentences, sentence ids
+            sentences = split_articles([a1.id, a2.id])
+        self.assertEqual({aid : len(sids) for (aid, sids) in sentences.items()}, {a1.id : 3, a2.id : 2})
+        self.assertEqual(set(sentences[a1.id]), {s.id for s in a1.sentences.all()})
+
+    def test_create_sentences_articles(self):
+        """Are sentences created in bulk for articles with and without sentences?"""
+        a1, a2 = [amcattest.create_test_article(text="Een eerste zin. En een tweede") for _x in range(2)]
+        split_article(a1)
+        n = amcattest.create_test_analysis()
+        aas = [amcattest.create_test_analysis_article(article=a, analysis=n) for a in (a1, a2)]
+        create_sentences_articles(aas)
+        for a, aa in zip((a1, a2), aas):
+            self.assertEqual({asent.sentence for asent in AnalysisSentence.objects.filter(analysis_article=aa)},
+                             set(a.sentences.all()))
+
     def test_create_sentences_article(self):
         a = amcattest.create_test_article(headline="dit is een kop", text="Een eerste zin. En een tweede")
         aa = amcattest.create_test_analysis_article(article=a)
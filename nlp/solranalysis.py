@@ -29,7 +29,7 @@ log = logging.getLogger(__name__)
 
 from amcat.models.analysis import Analysis, AnalysisArticle
 from amcat.scripts import script
-from amcat.tools.amcatsolr import Solr
+from amcat.tools.amcatsolr import get_solr
 
 from collections import defaultdict
 
@@ -51,8 +51,13 @@ class SolrAnalysis(script.Script):
             id__in=[a.id for a in _input]
         ).values("delete", "article__id")
 
-        Solr().delete_articles([a['article__id'] for a in aas if a['delete']])
-        Solr().add_articles([a['article__id'] for a in aas if not a['delete']])
+        delete = [a['article__id'] for a in aas if a['delete']]
+        add = [a['article__id'] for a in aas if not a['delete']]
+        solr = get_solr()
+        if delete:
+            solr.delete_articles(delete, commit=False)
+        if add:
+            solr.add_articles(add, commit=False)
 
 
 if __name__ == "__main__":
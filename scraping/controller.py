@@ -23,14 +23,20 @@ Module for controlling scrapers
 
 import logging; log = logging.getLogger(__name__)
 from cStringIO import StringIO
+from collections import defaultdict
 
-from amcat.tools.toolkit import to_list, retry
+from amcat.tools.toolkit import to_list, retry, splitlist
 from amcat.tools.multithread import distribute_tasks, QueueProcessorThread, add_to_queue_action
 from amcat.tools import amcatlogging
 
 from amcat.scraping.scraper import MultiScraper
+from amcat.models.article import Article
+from amcat.models.analysis import deferred_queue
 from django.db import transaction
 
+# number of articles that are saved at once
+SAVE_BATCH = 1000
+
 class Controller(object):
     """
     Controller class
@@ -47,26 +53,35 @@ class Controller(object):
         raise NotImplementedError()
 
     def save(self, article):
-        log.debug("Saving article %s" % article)
-        article.save()
-
-        articleset = article.scraper.articleset if hasattr(article, 'scraper') else self.articleset
-        log.debug("Adding article %r to articleset %r" % (article.id, articleset))
-        if articleset:
-            articleset.add(article)
-            articleset.save()
-            
+        return self.save_articles([article])[0]
+
+    def save_articles(self, articles):
+        """Save the articles in bulk, adding them to the articleset of their scraper"""
+        bysets = defaultdict(list)
+        for article in articles:
+            articleset = article.scraper.articleset if hasattr(article, 'scraper') else self.articleset
+            bysets[articleset].append(article)
+
+        with deferred_queue():
+            for articleset, articles_in_set in bysets.iteritems():
+                log.debug("Saving %i articles into articleset %r" % (len(articles_in_set), articleset))
+                Article.create_articles(articles_in_set, articleset=articleset)
+                if articleset:
+                    articleset.save()
+
         log.debug("Done")
-        return article
+        return articles
 
 
 class SimpleController(Controller):
     """Simple implementation of Controller"""
     @to_list
     def scrape(self, scraper):
-        for unit in scraper.get_units():
-            for article in scraper.scrape_unit(unit):
-                yield self.save(article)
+        articles = (article for unit in scraper.get_units()
+                    for article in scraper.scrape_unit(unit))
+        for batch in splitlist(articles, SAVE_BATCH):
+            for article in self.save_articles(batch):
+                yield article
     
 class RobustController(Controller):
     """More robust implementation of Controller with sensible transaction management and retries"""
@@ -87,9 +102,7 @@ class RobustController(Controller):
     @transaction.commit_on_success
     def _scrape_unit(self, scraper, unit):
         articles = list(scraper.scrape_unit(unit))
-        for article in articles:
-            self.save(article)
-        return articles
+        return self.save_articles(articles)
 
 class ThreadedController(Controller):
     """Threaded implementation of Controller
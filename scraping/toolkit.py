@@ -139,5 +139,19 @@ def get_scraper_model(scraper_class):
 
 
 def check_article_duplicates(article,overwrite=False):
-    """checks if given article has a duplicate within its articleset"""
-    
+    """checks if given article has a duplicate within its articleset
+
+    @param overwrite: if True, remove the duplicates from the articleset
+    @return: list of articles in the articleset with the same content hash"""
+    from amcat.models.article import Article, content_hash
+    articleset = getattr(getattr(article, 'scraper', None), 'articleset', None)
+    if articleset is None:
+        return []
+    duplicates = Article.objects.filter(articlesetarticle__articleset=articleset,
+                                        content_hash=content_hash(article.text))
+    if article.id is not None:
+        duplicates = duplicates.exclude(pk=article.id)
+    duplicates = list(duplicates)
+    if overwrite and duplicates:
+        articleset.remove(*duplicates)
+    return duplicates
@@ -25,14 +25,18 @@ Script to clean the index for a project
 
 import logging; log = logging.getLogger(__name__)
 
+import os.path
+import bisect
+import multiprocessing
+
 import solr
 from django import forms
+from django import db
 
 from amcat.models import Project, ArticleSet, Article, ArticleSetArticle
 from amcat.models.analysis import add_to_queue
 from amcat.scripts.script import Script
-from amcat.tools.amcatsolr import Solr
-from amcat.tools.toolkit import splitlist
+from amcat.tools.amcatsolr import get_solr, SOLR_INDEX_BATCH
 
 
 class SolrCleanForm(forms.Form):
@@ -40,6 +44,13 @@ class SolrCleanForm(forms.Form):
     sets = forms.ModelMultipleChoiceField(queryset=ArticleSet.objects.all(), required=False)
     include_project_sets = forms.BooleanField(initial=False, required=False)
     batch = forms.IntegerField(required=False)
+    processes = forms.IntegerField(required=False, min_value=1,
+                                   help_text="Reindex in parallel using this many processes")
+    partition = forms.IntegerField(required=False, min_value=1,
+                                   help_text="Width of the id range handled per parallel task")
+    checkpoint = forms.CharField(required=False,
+                                 help_text="File to record finished id ranges, to allow resuming")
+    optimize = forms.BooleanField(initial=False, required=False)
 
     def clean(self):
         data = super(SolrCleanForm, self).clean()
@@ -64,20 +75,179 @@ class SolrClean(Script):
             q = ArticleSetArticle.objects.filter(articleset__in=sets)
             articles |= set(aid for (aid,) in q.values_list("article_id"))
 
-        if self.options["batch"]:
-            log.info("Cleaning {n} articles in {m} batch(es) of {b}"
-                     .format(n=len(articles), b=self.options["batch"],
-                             m=1 + len(articles) // self.options["batch"]))
-            for i, articles in enumerate(splitlist(articles, self.options["batch"])):
-                log.info("Batch {i}: Cleaning {n} articles".format(n=len(articles), **locals()))
-                Solr().add_articles(articles)
+        batch = self.options["batch"] or SOLR_INDEX_BATCH
+        if self.options["processes"]:
+            self.reindex_parallel(sorted(articles), batch)
         else:
             log.info("Cleaning {n} articles".format(n=len(articles)))
-            Solr().add_articles(articles)
+            get_solr().add_articles(articles, batch=batch, commit=not self.options["optimize"])
+            if self.options["optimize"]:
+                get_solr().commit(optimize=True)
         
         log.info("Done!")
+        # articles that should be deleted are removed by solr_reconcile.SolrReconcile
+
+    def reindex_parallel(self, article_ids, batch, solr=None):
+        """
+        Partition the (sorted) article ids in id ranges and index these using
+        a pool of processes. Finished ranges are committed and then recorded in
+        the checkpoint file (if given) in groups of COMMIT_RANGES. When the
+        script is run again, recorded ranges are skipped if they still contain
+        the same articles. Finishes with a commit (and optimize if requested).
+
+        @param solr: the index to use, which is sent to the workers; if not
+                     given, every worker uses get_solr()
+        """
+        width = self.options["partition"] or DEFAULT_PARTITION
+        checkpoint = self.options["checkpoint"]
+        done = _read_checkpoint(checkpoint, width)
+        ranges = [(lo, ids) for (lo, ids) in _partition(article_ids, width)
+                  if _range_key(lo, width, ids) not in done]
+        log.info("Cleaning {n} articles in {m} id ranges of width {width} using {p} processes, "
+                 "skipping {s} finished ranges".format(n=len(article_ids), m=len(ranges),
+                                                       p=self.options["processes"],
+                                                       s=len(done), **locals()))
+        pool = self.get_pool(self.options["processes"])
+        finished = []
+        try:
+            tasks = [(solr, lo, ids, batch, width) for (lo, ids) in ranges]
+            for i, (lo, key) in enumerate(pool.imap_unordered(_reindex_range, tasks)):
+                log.info("Finished range {i}/{n} starting at id {lo}".format(n=len(tasks), **locals()))
+                finished.append(key)
+                if len(finished) >= COMMIT_RANGES:
+                    # solr has no transaction log, so only record committed ranges
+                    (solr or get_solr()).commit()
+                    _write_checkpoint(checkpoint, finished)
+                    finished = []
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        (solr or get_solr()).commit(optimize=self.options["optimize"])
+        _write_checkpoint(checkpoint, finished)
+
+    def get_pool(self, processes):
+        """Create the pool of worker processes that index the id ranges"""
+        # forked workers must not share the database connection of this process
+        db.connection.close()
+        return multiprocessing.Pool(processes, initializer=_init_worker)
+
+# width of the id range that one parallel task handles, if not given
+DEFAULT_PARTITION = 100000
+# number of finished ranges that are committed and recorded in the checkpoint at once
+COMMIT_RANGES = 10
+
+def _partition(article_ids, width):
+    """Split the sorted article ids in (range start, ids) pairs, with ranges of the given width"""
+    i = 0
+    while i < len(article_ids):
+        lo = article_ids[i] - article_ids[i] % width
+        j = bisect.bisect_left(article_ids, lo + width, i)
+        yield lo, article_ids[i:j]
+        i = j
+
+def _range_key(lo, width, article_ids):
+    """Identify a range and the articles in it, to check whether a finished range has changed"""
+    return (lo, width, len(article_ids), sum(article_ids))
+
+def _read_checkpoint(checkpoint, width):
+    """
+    Get the set of finished range keys according to the checkpoint file.
+    Raises a ValueError if the checkpoint was written with a different partition width.
+    """
+    if not (checkpoint and os.path.exists(checkpoint)):
+        return set()
+    with open(checkpoint) as f:
+        done = set(tuple(int(x) for x in line.split()) for line in f if line.strip())
+    widths = set(key[1] for key in done)
+    if widths - set([width]):
+        raise ValueError("Checkpoint {checkpoint} was written with partition {w}, not {width}. "
+                         "Use the same partition or remove the checkpoint"
+                         .format(w=", ".join(map(str, sorted(widths))), **locals()))
+    return done
+
+def _write_checkpoint(checkpoint, keys):
+    """Append the keys of the finished (and committed) ranges to the checkpoint file"""
+    if checkpoint and keys:
+        with open(checkpoint, "a") as f:
+            for key in keys:
+                f.write(" ".join(str(x) for x in key) + "\n")
+
+def _init_worker():
+    """Make sure every worker process opens its own database connection"""
+    db.connection.close()
+
+def _reindex_range((solr, lo, article_ids, batch, width)):
+    """Index the given articles without committing, returning the range start and key"""
+    (solr or get_solr()).add_articles(article_ids, batch=batch, commit=False, commit_within=None)
+    return lo, _range_key(lo, width, article_ids)
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+import tempfile
+import itertools
+
+class _SerialPool(object):
+    """Pool that runs its tasks in this process, so they see the test database"""
+    def imap_unordered(self, func, tasks):
+        return itertools.imap(func, tasks)
+    def close(self): pass
+    def terminate(self): pass
+    def join(self): pass
+
+class _SerialSolrClean(SolrClean):
+    def get_pool(self, processes):
+        return _SerialPool()
+
+class TestSolrClean(amcattest.PolicyTestCase):
+
+    def test_partition(self):
+        """Are the ids split in aligned ranges of the given width?"""
+        self.assertEqual(list(_partition([1, 5, 9, 10, 11, 35], 10)),
+                         [(0, [1, 5, 9]), (10, [10, 11]), (30, [35])])
+        self.assertEqual(list(_partition([], 10)), [])
+
+    def test_checkpoint(self):
+        """Are finished ranges skipped only if they are unchanged and have the same width?"""
+        fd, checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            ids = [1, 5, 9, 10, 11, 35]
+            _write_checkpoint(checkpoint, [_range_key(0, 10, [1, 5, 9]), _range_key(10, 10, [10, 11])])
+            done = _read_checkpoint(checkpoint, 10)
+            # the range starting at 10 has a new article, so it is indexed again
+            ids.append(12)
+            pending = [lo for (lo, r) in _partition(ids, 10) if _range_key(lo, 10, r) not in done]
+            self.assertEqual(pending, [10, 30])
+            self.assertRaises(ValueError, _read_checkpoint, checkpoint, 20)
+        finally:
+            os.remove(checkpoint)
 
-        #TODO: also delete articles that should be deleted...
+    def test_reindex_parallel(self):
+        """Are all ranges indexed and committed, and recorded in the checkpoint?"""
+        from amcat.tools.amcatsolr import get_test_solr
+        s = amcattest.create_test_set(articles=3)
+        ids = sorted(a.id for a in s.articles.all())
+        fd, checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(checkpoint)
+        try:
+            with get_test_solr() as solr:
+                script = _SerialSolrClean(sets=[s.id], processes=2, partition=2,
+                                          checkpoint=checkpoint)
+                script.reindex_parallel(ids, batch=2, solr=solr)
+                self.assertEqual(set(solr.query_ids("*:*")), set(ids))
+                done = _read_checkpoint(checkpoint, 2)
+                self.assertEqual(done, set(_range_key(lo, 2, r) for (lo, r) in _partition(ids, 2)))
+        finally:
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
 
 if __name__ == '__main__':
     from amcat.scripts.tools import cli
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+
+##########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Script to find and repair differences between the database and the index
+
+Rather than comparing all article ids, the id space is divided in buckets
+and the number and sum of the ids in each bucket are compared. Only buckets
+that differ are split into smaller buckets, until the ids of a small bucket
+are compared one by one. Set membership is checked by comparing the number
+of articles per set. Articles that are missing from the index (or from a set
+in the index) are reindexed, and articles that no longer exist are removed
+from the index. Only the article ids are compared, so articles whose content
+or other fields changed without being reindexed are not detected; use
+SolrClean to reindex those.
+"""
+
+import logging; log = logging.getLogger(__name__)
+
+from django import forms
+from django.db.models import Q, Count, Sum, Max
+
+from amcat.models import Project, ArticleSet, Article, ArticleSetArticle
+from amcat.scripts.script import Script
+from amcat.tools.toolkit import splitlist
+from amcat.tools.amcatsolr import Solr, terms_filter
+
+# width of the top level buckets
+DEFAULT_BUCKET = 100000
+# buckets that differ are split into this many smaller buckets
+FANOUT = 10
+# buckets of at most this width are compared id by id
+LEAF_BUCKET = 1000
+
+class SolrReconcileForm(forms.Form):
+    projects = forms.ModelMultipleChoiceField(queryset=Project.objects.all(), required=False)
+    sets = forms.ModelMultipleChoiceField(queryset=ArticleSet.objects.all(), required=False)
+    include_project_sets = forms.BooleanField(initial=False, required=False)
+    bucket = forms.IntegerField(required=False, min_value=LEAF_BUCKET,
+                                help_text="Width of the top level id buckets")
+    dry_run = forms.BooleanField(initial=False, required=False,
+                                 help_text="Only report the differences, don't repair them")
+
+    def clean(self):
+        data = super(SolrReconcileForm, self).clean()
+        if not data['projects'] and not data['sets']:
+            raise forms.ValidationError("Please list the projects or sets to reconcile")
+        return data
+
+class SolrReconcile(Script):
+    """
+    Compare the articles in the given projects and sets with the index, and
+    reindex or delete the articles that differ. Returns a dict with the
+    reindexed and deleted article ids.
+    """
+    options_form = SolrReconcileForm
+
+    def run(self, _input):
+        projects, sets = list(self.options["projects"]), list(self.options["sets"])
+        if self.options["include_project_sets"]:
+            sets += list(ArticleSet.objects.filter(project__in=projects))
+        self.solr = Solr()
+        self.articles = scope_articles(projects, sets)
+        self.filters = [scope_filter(projects, sets)]
+
+        width = self.options["bucket"] or DEFAULT_BUCKET
+        end = max(self.articles.aggregate(Max("id"))["id__max"], self.max_indexed_id()) + 1
+        log.info("Reconciling projects {projects}, sets {sets}, ids up to {end}".format(**locals()))
+
+        candidates = set()
+        for lo, hi in self.differing_ranges(0, _align(end, width), width):
+            candidates |= self.compare_ids(lo, hi)
+        for articleset in self.differing_sets():
+            candidates |= self.compare_ids(articleset=articleset)
+
+        reindex = _existing(candidates)
+        delete = candidates - reindex
+        log.info("Found {r} missing and {d} deleted articles"
+                 .format(r=len(reindex), d=len(delete)))
+        if not self.options["dry_run"]:
+            if delete:
+                self.solr.delete_articles(delete)
+            if reindex:
+                self.solr.add_articles(reindex)
+        return dict(reindex=sorted(reindex), delete=sorted(delete))
+
+    def max_indexed_id(self):
+        response = self.solr.query("*:*", filters=self.filters, fields="id", score=False,
+                                   rows=1, sort="id desc")
+        return response.results[0]["id"] if response.results else 0
+
+    def solr_checksum(self, lo, hi):
+        """Return the (count, sum) of the indexed ids in [lo, hi)"""
+        response = self.solr.query("*:*", filters=self.filters + ["id:[%i TO %i]" % (lo, hi - 1)],
+                                   fields="id", score=False, rows=0, stats="true", stats_field="id")
+        stats = response.stats["stats_fields"]["id"]
+        if not stats:
+            return 0, 0
+        return int(stats["count"]), int(round(stats["sum"]))
+
+    def differing_ranges(self, lo, hi, width):
+        """Yield the (lo, hi) leaf ranges with a different checksum in the database and index"""
+        checksums = db_checksums(self.articles, lo, hi, width)
+        for start in range(lo, hi, width):
+            end = min(start + width, hi)
+            if checksums.get(start, (0, 0)) == self.solr_checksum(start, end):
+                continue
+            if width <= LEAF_BUCKET:
+                yield start, end
+            else:
+                for r in self.differing_ranges(start, end, max(width // FANOUT, LEAF_BUCKET)):
+                    yield r
+
+    def differing_sets(self):
+        """Return the ids of the sets with a different article count in the database and index"""
+        db = dict((row["articleset"], row["n"]) for row in
+                  ArticleSetArticle.objects.filter(article__in=self.articles)
+                  .values("articleset").annotate(n=Count("id")).order_by())
+        response = self.solr.query("*:*", filters=self.filters, fields="id", score=False, rows=0,
+                                   facet="true", facet_field="sets", facet_mincount=1,
+                                   facet_limit=-1)
+        indexed = dict((int(setid), n) for (setid, n)
+                       in response.facet_counts["facet_fields"]["sets"].iteritems())
+        return [setid for setid in set(db) | set(indexed) if db.get(setid) != indexed.get(setid)]
+
+    def compare_ids(self, lo=None, hi=None, articleset=None):
+        """Return the ids in the id range or set that are only in the database or only in the index"""
+        articles, filters = self.articles, list(self.filters)
+        if lo is not None:
+            articles = articles.filter(id__gte=lo, id__lt=hi)
+            filters.append("id:[%i TO %i]" % (lo, hi - 1))
+        if articleset is not None:
+            articles = articles.filter(articlesetarticle__articleset=articleset)
+            filters.append(terms_filter("sets", [articleset]))
+        db = set(articles.values_list("id", flat=True))
+        indexed = set(row["id"] for row in self.solr.query_all("*:*", filters=filters,
+                                                               fields=["id"], score=False))
+        return db ^ indexed
+
+def scope_articles(projects, sets):
+    """Return a queryset of the articles in the given projects or sets"""
+    q = Q(id__in=ArticleSetArticle.objects.filter(articleset__in=sets).values("article"))
+    if projects:
+        q = Q(project__in=projects) | q
+    return Article.objects.filter(q)
+
+def scope_filter(projects, sets):
+    """Return a solr filter matching the articles in the given projects or sets"""
+    filters = []
+    if projects:
+        filters.append(terms_filter("projectid", [p.id for p in projects]))
+    if sets:
+        filters.append(terms_filter("sets", [s.id for s in sets]))
+    if len(filters) == 1:
+        return filters[0]
+    # terms query filters cannot be combined, so use a plain boolean query
+    return "projectid:({}) OR sets:({})".format(
+        " OR ".join(str(p.id) for p in projects), " OR ".join(str(s.id) for s in sets))
+
+def db_checksums(articles, lo, hi, width):
+    """
+    Return a {bucket start : (count, sum)} dict of the article ids in [lo, hi),
+    with buckets of the given width starting at lo
+    """
+    q = (articles.filter(id__gte=lo, id__lt=hi)
+         .extra(select=dict(bucket="(articles.article_id - %i) / %i" % (lo, width)))
+         .values("bucket").annotate(n=Count("id"), total=Sum("id")).order_by())
+    return dict((lo + row["bucket"] * width, (row["n"], row["total"])) for row in q)
+
+def _align(n, width):
+    """Round n up to a multiple of width"""
+    return n + (-n % width)
+
+def _existing(article_ids):
+    """Return the subset of article ids that exist in the database"""
+    result = set()
+    for ids in splitlist(list(article_ids), 1000):
+        result |= set(Article.objects.filter(pk__in=ids).values_list("id", flat=True))
+    return result
+
+if __name__ == '__main__':
+    from amcat.scripts.tools import cli
+    cli.run_cli()
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class TestSolrReconcile(amcattest.PolicyTestCase):
+
+    def test_db_checksums(self):
+        """Are articles counted and summed per id bucket?"""
+        p = amcattest.create_test_project()
+        arts = [amcattest.create_test_article(project=p) for _x in range(3)]
+        s = amcattest.create_test_set(articles=[arts[0]])
+        ids = [a.id for a in arts]
+        start = min(ids) - min(ids) % 1000000
+        self.assertEqual(db_checksums(scope_articles([p], []), 0, max(ids) + 1, 1000000),
+                         {start : (3, sum(ids))})
+        self.assertEqual(db_checksums(scope_articles([], [s]), 0, max(ids) + 1, 1000000),
+                         {start : (1, ids[0])})
+        self.assertEqual(set(scope_articles([p], [s])), set(arts))
+        # buckets are aligned to the start of the range, not to multiples of the width
+        lo = min(ids) - 7
+        self.assertEqual(db_checksums(scope_articles([p], []), lo, max(ids) + 1, 1000000),
+                         {lo : (3, sum(ids))})
+
+    def test_scope_filter(self):
+        p = amcattest.create_test_project()
+        s = amcattest.create_test_set()
+        self.assertEqual(scope_filter([p], []), terms_filter("projectid", [p.id]))
+        self.assertEqual(scope_filter([p], [s]), "projectid:({p.id}) OR sets:({s.id})".format(**locals()))
@@ -21,55 +21,234 @@
 """
 This deamon checks if there are any Articles in analysis_articles. If there
 are, it runs the plugins associated with them.
-"""
 
-from django.db import transaction
+The plugins are run in a pool of worker processes. Each plugin has its own
+concurrency limit and batch size (see ANALYSIS_PLUGIN_CONCURRENCY and
+ANALYSIS_PLUGIN_BATCH), so a slow plugin such as a parser only occupies its
+own workers and does not hold up the other plugins. Every batch is run and
+committed in its own transaction: if a plugin fails, only its batch is rolled
+back, and those articles are claimed again when their lease expires. Articles
+that were started ANALYSIS_MAX_ATTEMPTS times without success are no longer
+claimed, so a batch that always fails is not retried forever.
+"""
 
-from amcat.scripts.daemons.daemonscript import DaemonScript
-from amcat.models.analysis import AnalysisArticle
+from django.conf import settings
+from django.db import transaction, connection
+from django.db.models import F
 
-from collections import defaultdict
+from amcat.scripts.daemons.daemonscript import DaemonScript, POLL_INTERVAL
+from amcat.models.analysis import Analysis, AnalysisArticle, ANALYSIS_ARTICLES_CHANNEL
+from amcat.models.plugin import Plugin
+from amcat.tools.dbtoolkit import claim_rows, QUEUE_LEASE_SECONDS
+from amcat.tools.toolkit import splitlist
 
-BATCH = 1000
+import multiprocessing
+import time
 
 import logging; log = logging.getLogger(__name__)
 
+PROCESSES = getattr(settings, 'ANALYSIS_PROCESSES', multiprocessing.cpu_count())
+# {plugin label : n} maximum number of batches of a plugin that run at the same time
+PLUGIN_CONCURRENCY = getattr(settings, 'ANALYSIS_PLUGIN_CONCURRENCY', {})
+# {plugin label : n} number of articles passed to a plugin at once
+PLUGIN_BATCH = getattr(settings, 'ANALYSIS_PLUGIN_BATCH', {})
+# articles are not claimed again after this many attempts
+MAX_ATTEMPTS = getattr(settings, 'ANALYSIS_MAX_ATTEMPTS', 3)
+
+DEFAULT_CONCURRENCY = 1
+BATCH = 100
+
+def get_limits(plugin):
+    """Return the (concurrency, batch size) for the plugin"""
+    return (PLUGIN_CONCURRENCY.get(plugin.label, DEFAULT_CONCURRENCY),
+            PLUGIN_BATCH.get(plugin.label, BATCH))
+
+def run_plugin(plugin_id, ids):
+    """
+    Run the plugin on the claimed analysis articles and mark them as done in
+    a single transaction.
+    @return: the number of articles that were analysed (0 if the plugin failed)
+    """
+    try:
+        with transaction.commit_on_success():
+            plugin = Plugin.objects.get(pk=plugin_id)
+            arts = AnalysisArticle.objects.filter(id__in=ids).only("id").select_related("analysis__plugin")
+            arts.update(started=True)
+            plugin.get_instance().run(set(arts))
+            return arts.update(done=True, attempts=0, claimed_by=None, claimed_until=None)
+    except Exception:
+        # the claim is kept, so the articles are retried when it expires
+        # (unless they reached MAX_ATTEMPTS)
+        log.exception("Plugin {plugin_id} failed on {n} articles".format(n=len(ids), **locals()))
+        return 0
+
 class AnalysisDaemon(DaemonScript):
-    def _to_plugin_dict(self, analysis_arts):
-        res = defaultdict(set)
+    channels = [ANALYSIS_ARTICLES_CHANNEL]
 
-        for aa in analysis_arts:
-            res[aa.analysis.plugin].add(aa)
+    def prepare(self):
+        # the workers should not share the database connection of this process
+        connection.close()
+        self.pool = multiprocessing.Pool(processes=PROCESSES)
+        self.running = {} # plugin_id : [(start time, AsyncResult)]
+        log.info("Starting %i workers" % PROCESSES)
 
-        return res
+    def _collect(self):
+        """
+        Forget the batches that are done, returning the number of articles analysed.
+        Batches that run longer than the lease are forgotten as well: their worker
+        probably died or hangs, and their articles can be claimed again.
+        """
+        n = 0
+        deadline = time.time() - QUEUE_LEASE_SECONDS
+        for plugin_id, results in self.running.items():
+            for started, result in list(results):
+                if result.ready():
+                    n += result.get()
+                elif started < deadline:
+                    log.warning("Batch of plugin {plugin_id} did not finish within {QUEUE_LEASE_SECONDS}"
+                                " seconds, releasing its slot".format(QUEUE_LEASE_SECONDS=QUEUE_LEASE_SECONDS,
+                                                                     **locals()))
+                else:
+                    continue
+                results.remove((started, result))
+            if not results:
+                del self.running[plugin_id]
+        return n
+
+    def dispatch(self, plugin):
+        """Claim articles for the free slots of the plugin and start them, returning the number of batches"""
+        concurrency, batch = get_limits(plugin)
+        free = concurrency - len(self.running.get(plugin.id, []))
+        if free <= 0:
+            return 0
+        # articles that are not done and not being analysed by another worker
+        # (articles of a failed worker are claimed again when its claim expires)
+        ids = claim_rows(AnalysisArticle.objects.filter(analysis__plugin=plugin, done=False,
+                                                        attempts__lt=MAX_ATTEMPTS), free * batch)
+        # count the attempt before running, so crashing workers are counted as well
+        AnalysisArticle.objects.filter(id__in=ids).update(attempts=F("attempts") + 1)
+        batches = list(splitlist(ids, batch))
+        for ids in batches:
+            result = self.pool.apply_async(run_plugin, (plugin.id, ids))
+            self.running.setdefault(plugin.id, []).append((time.time(), result))
+        if batches:
+            log.info("Started {n} batches of {plugin.label}".format(n=len(batches), **locals()))
+        return len(batches)
 
-    @transaction.commit_on_success
     def run_action(self):
         """
         Analyse all articles.
         
         TODO: If analysis.sentences is True, also analyse all sentences.
         """
-        arts = AnalysisArticle.objects.filter(
-            analysis__plugin__active=True, started=False
-        ).only("id")[:BATCH]
-
-        # We can't use update() on sliced queries. Workaround:
-        arts = AnalysisArticle.objects.filter(
-            id__in=[a.id for a in arts]
-        ).only("id").select_related("analysis__plugin")
+        done = self._collect()
+        if done:
+            log.info("Analysed {done} articles".format(**locals()))
 
-        # Indicate that we started analysing
-        arts.update(started=True)
+        plugins = Plugin.objects.filter(active=True, id__in=Analysis.objects.values("plugin"))
+        started = sum(self.dispatch(plugin) for plugin in plugins)
 
-        for plugin, aarts in self._to_plugin_dict(arts).items():
-            script = plugin.get_instance()
-            script.run(aarts)
+        if not started and self.running:
+            # all plugins with work are busy: wait for a batch to finish
+            # rather than for a notification
+            _started, result = self.running.values()[0][0]
+            result.wait(POLL_INTERVAL)
+            return True
+        return bool(started)
 
-        # Indicate that we're done analysing
-        arts.update(done=True)
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
 
-        return bool(arts)
+from amcat.tools import amcattest
+from amcat.scripts.script import Script
+
+class _TestAnalysisScript(Script):
+    def run(self, _input):
+        pass
+
+class _FailingAnalysisScript(Script):
+    def run(self, _input):
+        raise Exception("Test exception")
+
+class _PendingResult(object):
+    def ready(self):
+        return False
+
+class _TestPool(object):
+    """Pool that never runs its tasks"""
+    def apply_async(self, func, args):
+        return _PendingResult()
+
+class TestAnalysisDaemon(amcattest.PolicyTestCase):
+
+    def test_dispatch(self):
+        """Are attempts counted, and are slots of batches that run too long released?"""
+        daemon = AnalysisDaemon(action="test")
+        daemon.pool, daemon.running = _TestPool(), {}
+        plugin = Plugin.objects.create(module=__name__, class_name="_TestAnalysisScript",
+                                       label="_test_dispatch")
+        aa = amcattest.create_test_analysis_article(analysis=amcattest.create_test_analysis(plugin=plugin))
+        self.assertEqual(daemon.dispatch(plugin), 1)
+        self.assertEqual(daemon.dispatch(plugin), 0) # at its concurrency limit
+        self.assertEqual(AnalysisArticle.objects.get(pk=aa.id).attempts, 1)
+
+        (started, result), = daemon.running[plugin.id]
+        daemon.running[plugin.id] = [(started - QUEUE_LEASE_SECONDS - 1, result)]
+        daemon._collect()
+        self.assertEqual(daemon.running, {})
+
+        # articles are not claimed again after MAX_ATTEMPTS attempts
+        AnalysisArticle.objects.filter(pk=aa.id).update(attempts=MAX_ATTEMPTS, claimed_until=None)
+        self.assertEqual(daemon.dispatch(plugin), 0)
+
+    def test_dispatch_restart(self):
+        """Is a done article that is restarted claimed again, whatever its earlier attempts?"""
+        from amcat.models.analysis import AnalysisProject
+        from amcat.nlp.preprocessing import set_preprocessing_actions
+        daemon = AnalysisDaemon(action="test")
+        daemon.pool, daemon.running = _TestPool(), {}
+        plugin = Plugin.objects.create(module=__name__, class_name="_TestAnalysisScript",
+                                       label="_test_dispatch_restart")
+        analysis = amcattest.create_test_analysis(plugin=plugin)
+        project = amcattest.create_test_project()
+        article = amcattest.create_test_article(project=project)
+        AnalysisProject.objects.create(project=project, analysis=analysis)
+        aa = AnalysisArticle.objects.create(article=article, analysis=analysis, started=True,
+                                            done=True, attempts=MAX_ATTEMPTS)
+        set_preprocessing_actions([article.id])
+        self.assertEqual(AnalysisArticle.objects.get(pk=aa.id).attempts, 0)
+        self.assertEqual(daemon.dispatch(plugin), 1)
+
+    def test_run_plugin(self):
+        """Are only the articles of a succeeding plugin marked as done?"""
+        aas = {}
+        for cls in _TestAnalysisScript, _FailingAnalysisScript:
+            plugin = Plugin.objects.create(module=__name__, class_name=cls.__name__, label=cls.__name__)
+            analysis = amcattest.create_test_analysis(plugin=plugin)
+            aas[cls] = [amcattest.create_test_analysis_article(analysis=analysis) for _x in range(2)]
+            ids = [aa.id for aa in aas[cls]]
+            claim_rows(AnalysisArticle.objects.filter(pk__in=ids), 10, worker="test")
+            AnalysisArticle.objects.filter(pk__in=ids).update(attempts=1)
+            self.assertEqual(run_plugin(plugin.id, ids), 2 if cls is _TestAnalysisScript else 0)
+        # the attempts of articles that succeeded are reset, those of failed articles are kept
+        for cls, attempts in (_TestAnalysisScript, 0), (_FailingAnalysisScript, 1):
+            self.assertEqual(set(AnalysisArticle.objects.filter(pk__in=[aa.id for aa in aas[cls]])
+                                 .values_list("attempts", flat=True)), set([attempts]))
+
+        ok = AnalysisArticle.objects.filter(pk__in=[aa.id for aa in aas[_TestAnalysisScript]])
+        self.assertEqual(set(ok.values_list("done", "claimed_by")), {(True, None)})
+        failed = AnalysisArticle.objects.filter(pk__in=[aa.id for aa in aas[_FailingAnalysisScript]])
+        self.assertEqual(set(failed.values_list("done", flat=True)), {False})
+
+    def test_get_limits(self):
+        plugin = Plugin(label="_test_plugin")
+        self.assertEqual(get_limits(plugin), (DEFAULT_CONCURRENCY, BATCH))
+        PLUGIN_BATCH["_test_plugin"] = 10
+        try:
+            self.assertEqual(get_limits(plugin), (DEFAULT_CONCURRENCY, 10))
+        finally:
+            del PLUGIN_BATCH["_test_plugin"]
 
 if __name__ == '__main__':
     from amcat.scripts.tools.cli import run_cli
@@ -31,6 +31,14 @@ from django import db
 from amcat.contrib.daemon import Daemon
 from amcat.scripts.script import Script
 from amcat.tools import amcatlogging
+from amcat.tools.dbtoolkit import get_database
+
+# seconds to sleep when there is no work and notifications are not available
+POLL_INTERVAL = 5
+# seconds to wait for a notification before running the action anyway
+LISTEN_TIMEOUT = 60
+# maximum seconds to sleep after consecutive errors
+MAX_BACKOFF = 600
 
 ACTIONS = [('start', 'Start the Daemon'), ('stop', 'Stop the Daemon'),
            ('restart', 'Restart the Daemon'), ('test', 'Test the Daemon')]
@@ -43,8 +51,14 @@ class DaemonForm(forms.Form):
     action = forms.ChoiceField(choices=ACTIONS)
 
 
+def backoff(base, errors):
+    """Return the seconds to sleep after the given number of consecutive errors"""
+    return min(base * 2 ** (errors - 1), MAX_BACKOFF)
+
 class DaemonScript(Script):
     options_form=DaemonForm
+    # notification channels that signal new work for this daemon, see amcat.tools.dbtoolkit.notify
+    channels = ()
 
     def run(self, input=None):
         """
@@ -66,16 +80,22 @@ class DaemonScript(Script):
     def run_daemon(self):
         """
         Main daemon function. Tries to call run_action indefinitely, with 
-        sleep in between failures or False exit values.
+        sleep in between failures or False exit values. If the daemon has
+        notification channels, it waits for a notification instead of
+        sleeping when there is no work.
         """
         self.prepare()
         log.info("{} started".format(self.__class__.__name__))
+        self._listener = None
+        errors = 0
         while True:
             try:
+                # listen before running the action, so no notification is missed
+                self._get_listener()
                 result = self.run_action()
+                errors = 0
                 if not result:
-                    log.info('No results found, sleeping for 5 seconds')
-                    time.sleep(5)
+                    self.wait()
             except StopDeamon:
                 log.exception('StopDaemon received, quitting')
                 try:
@@ -93,15 +113,62 @@ class DaemonScript(Script):
                     pass
 
                 db.connection.connection = None
+                self._close_listener()
 
-                time.sleep(30)
+                errors += 1
+                time.sleep(backoff(30, errors))
             except:
-                log.exception('While loop exception, sleeping for 10 seconds')
-                time.sleep(10)
+                errors += 1
+                log.exception('While loop exception, sleeping for {} seconds'.format(backoff(10, errors)))
+                time.sleep(backoff(10, errors))
 
             # Reset db-queries to prevent memory-leaking
             db.reset_queries()
 
+    def _get_listener(self):
+        """
+        Return the listener for the channels, or None if there are no channels
+        or listening failed, in which case the daemon polls. Failed attempts
+        are retried after LISTEN_TIMEOUT seconds.
+        """
+        if self._listener is None and self.channels:
+            if time.time() < getattr(self, "_listen_retry", 0):
+                return None
+            try:
+                self._listener = get_database().listen(self.channels)
+            except Exception:
+                log.exception('Cannot listen for notifications, polling every {} seconds'
+                              .format(POLL_INTERVAL))
+                self._listen_retry = time.time() + LISTEN_TIMEOUT
+        return self._listener
+
+    def _close_listener(self):
+        if self._listener is not None:
+            try:
+                self._listener.close()
+            except Exception:
+                pass
+            self._listener = None
+
+    def wait(self):
+        """
+        Wait until there might be new work: until a notification is received
+        on one of the channels (at most LISTEN_TIMEOUT seconds), or for
+        POLL_INTERVAL seconds if the database does not support notifications.
+        """
+        listener = self._get_listener()
+        if listener is None:
+            log.info('No results found, sleeping for {} seconds'.format(POLL_INTERVAL))
+            time.sleep(POLL_INTERVAL)
+            return
+        try:
+            if listener.wait(LISTEN_TIMEOUT):
+                log.debug('Notification received')
+        except Exception:
+            log.exception('Error while waiting for notifications, reconnecting')
+            self._close_listener()
+            time.sleep(POLL_INTERVAL)
+
     def prepare(self):
         """
         Hook to allow a subclass to run actions prior to running. This will be called in the forked process
@@ -157,6 +224,27 @@ class TestDaemon(amcattest.PolicyTestCase):
         l = [0]
         _TestDaemon(action='test').run()
         self.assertEqual(l, [1])
+
+    def test_listen_failure(self):
+        """Does the daemon poll if it cannot listen for notifications?"""
+        global get_database
+        class _FailingDatabase(object):
+            def listen(self, channels):
+                raise Exception("Cannot connect")
+        class _TestDaemon(DaemonScript):
+            channels = ["test"]
+        d = _TestDaemon(action='test')
+        d._listener = None
+        old, get_database = get_database, _FailingDatabase
+        try:
+            self.assertEqual(d._get_listener(), None)
+            self.assertTrue(d._listen_retry > time.time())
+        finally:
+            get_database = old
+
+    def test_backoff(self):
+        self.assertEqual([backoff(10, n) for n in range(1, 5)], [10, 20, 40, 80])
+        self.assertEqual(backoff(10, 100), MAX_BACKOFF)
         
 if __name__ == "__main__":
     from amcat.scripts.tools import cli
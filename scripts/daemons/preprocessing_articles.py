@@ -26,7 +26,8 @@ from django.db import transaction
 
 from amcat.scripts.daemons.daemonscript import DaemonScript
 
-from amcat.models.analysis import AnalysisQueue
+from amcat.models.analysis import AnalysisQueue, QUEUE_CHANNEL
+from amcat.tools.dbtoolkit import claim_rows
 from amcat.nlp.preprocessing import set_preprocessing_actions
 
 import logging; log = logging.getLogger(__name__)
@@ -39,10 +40,14 @@ PROCESSES = multiprocessing.cpu_count()
 
 def _set_preprocessing_actions(queue):
     while True:
+        queue_ids, aids = queue.get()
         with transaction.commit_on_success():
-            set_preprocessing_actions(queue.get())
+            set_preprocessing_actions(aids)
+            AnalysisQueue.objects.filter(pk__in=queue_ids).delete()
 
 class PreprocessingArticlesDaemon(DaemonScript):
+    channels = [QUEUE_CHANNEL]
+
     def prepare(self):
         self.manager = multiprocessing.Manager()
         self.queue = self.manager.Queue(PROCESSES)
@@ -53,21 +58,16 @@ class PreprocessingArticlesDaemon(DaemonScript):
 
         log.info("Starting %i workers" % PROCESSES)
 
-    @transaction.commit_on_success
     def run_action(self):
-        aids = set()
-        preprocess_ids = list()
-
-        for ap in AnalysisQueue.objects.all()[:BATCH]:
-            aids.add(ap.article_id)
-            preprocess_ids.append(ap.id)
+        # the queue objects are deleted by the worker when it is done, if it
+        # fails their claim expires and they are claimed again
+        preprocess_ids = claim_rows(AnalysisQueue.objects.all(), BATCH)
 
-        if aids: 
-            # Articles were processed
-            log.info("Deleting {n} queue objects".format(n=len(preprocess_ids)))
-            AnalysisQueue.objects.filter(pk__in=preprocess_ids).delete()
+        if preprocess_ids:
+            aids = set(AnalysisQueue.objects.filter(pk__in=preprocess_ids)
+                       .values_list("article_id", flat=True))
             log.info("Will set preprocessing on {n} articles".format(n=len(aids)))
-            self.queue.put(aids)
+            self.queue.put((preprocess_ids, aids))
 
             return True
 
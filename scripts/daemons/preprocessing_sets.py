@@ -26,32 +26,42 @@ from django.db import transaction
 
 from amcat.scripts.daemons.daemonscript import DaemonScript
 
-from amcat.models.analysis import AnalysisQueue, AnalysisArticleSetQueue, add_to_queue
-from amcat.nlp.preprocessing import set_preprocessing_actions
+from amcat.models.analysis import AnalysisArticleSetQueue, queue_articleset
+from amcat.models.analysis import ARTICLESET_QUEUE_CHANNEL
+from amcat.tools.dbtoolkit import claim_rows
+from django.db.models import Q
 
 import logging; log = logging.getLogger(__name__)
 
 BATCH = 5
 
 class PreprocessingArticleSetsDaemon(DaemonScript):
+    channels = [ARTICLESET_QUEUE_CHANNEL]
+
 
-    @transaction.commit_on_success
     def run_action(self):
-        # Retrieve top sets
-        asets = [a.articleset for a in AnalysisArticleSetQueue.objects.all()[:BATCH]]
-        log.info("Adding {} sets to queue".format(len(asets)))
+        # Claim top sets
+        ids = claim_rows(AnalysisArticleSetQueue.objects.all(), BATCH)
+        if not ids:
+            return False
+
+        with transaction.commit_on_success():
+            setids = set(AnalysisArticleSetQueue.objects.filter(pk__in=ids)
+                         .values_list("articleset_id", flat=True))
+            log.info("Adding {} sets to queue".format(len(setids)))
 
-        # Add articles in articlesets to article queue
-        for aset in asets:
-            art_ids = aset.articles.all().values("id") 
-            add_to_queue(*(a['id'] for a in art_ids))
+            # Add articles in articlesets to article queue
+            for setid in setids:
+                n = queue_articleset(setid)
+                log.info("Added {n} articles of set {setid} to queue".format(**locals()))
 
-        # Clean up articleset queue
-        AnalysisArticleSetQueue.objects.filter(
-            articleset__id__in=tuple(a.id for a in asets)
-        ).delete()
+            # Clean up articleset queue: the claimed objects and unclaimed
+            # objects for the same sets
+            AnalysisArticleSetQueue.objects.filter(
+                articleset__id__in=tuple(setids)
+            ).filter(Q(pk__in=ids) | Q(claimed_until__isnull=True)).delete()
 
-        return bool(asets)
+        return True
 
 if __name__ == '__main__':
     from amcat.scripts.tools.cli import run_cli
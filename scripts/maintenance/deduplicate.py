@@ -17,69 +17,128 @@
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 
+"""
+Script to remove duplicate articles from article sets
+
+Articles with the same content hash are exact duplicates (ignoring case,
+whitespace and punctuation). Articles with a similar text, e.g. a trivially
+edited re-publication, are found by comparing MinHash signatures (see
+amcat.tools.minhash). The texts are retrieved in batches, so large sets can
+be deduplicated. Of each cluster of duplicates, the first (lowest id)
+article is kept, and the others are moved to the trash project and removed
+from the set.
+"""
+
+import datetime
+from itertools import groupby
 
 from django import forms
+from django.db.models import Count
 
 from amcat.scripts.script import Script
 from amcat.scripts.tools import cli
 
-from amcat.models.article import Article
+from amcat.models.article import Article, content_hash
 from amcat.models.scraper import Scraper
 from amcat.models.articleset import ArticleSet, ArticleSetArticle
+from amcat.models.analysis import deferred_queue
+from amcat.tools.minhash import find_near_duplicates
+from amcat.tools.toolkit import splitlist
 import logging; log = logging.getLogger(__name__)
 from amcat.tools import amcatlogging
 
+TRASH_PROJECT = 2
+BATCH = 1000
 
 class DeduplicateForm(forms.Form):
-    date = forms.DateField()
+    articleset = forms.ModelChoiceField(queryset=ArticleSet.objects.all(), required=False,
+                                        help_text="Leave empty to deduplicate the sets of the daily scrapers")
+    date = forms.DateField(required=False, help_text="Only consider articles from this date")
+    end_date = forms.DateField(required=False, help_text="Only consider articles until this date")
+    threshold = forms.FloatField(initial=0.8, min_value=0, max_value=1, required=False,
+                                 help_text="Minimal similarity of near duplicates, or empty to only "
+                                 "remove exact duplicates")
+    dry_run = forms.BooleanField(initial=False, required=False,
+                                 help_text="Only report the duplicates, don't remove them")
+
+def exact_duplicates(articles):
+    """Return the clusters of ids of articles with the same content hash, lowest id first"""
+    hashes = [row["content_hash"] for row in articles.exclude(content_hash=None)
+              .exclude(content_hash=content_hash("")).values("content_hash")
+              .annotate(n=Count("id")).filter(n__gt=1).order_by()]
+    clusters = []
+    for chunk in splitlist(hashes, BATCH):
+        rows = (articles.filter(content_hash__in=chunk).order_by("content_hash", "id")
+                .values_list("content_hash", "id"))
+        for _hash, ids in groupby(rows, lambda row: row[0]):
+            clusters.append([aid for (_hash, aid) in ids])
+    return clusters
+
+def iter_texts(articles, exclude=frozenset()):
+    """Yield the (id, text) pairs of the articles in batches, skipping the given ids"""
+    last = 0
+    while True:
+        rows = list(articles.filter(id__gt=last).order_by("id").values_list("id", "text")[:BATCH])
+        if not rows:
+            break
+        for aid, text in rows:
+            if aid not in exclude:
+                yield aid, text
+        last = rows[-1][0]
+
+def find_duplicates(articles, threshold=0.8):
+    """
+    Return the clusters of ids of duplicate articles. If threshold is not None,
+    near duplicates with at least this similarity are also clustered.
+    """
+    clusters = exact_duplicates(articles)
+    log.info("Found {n} clusters of exact duplicates".format(n=len(clusters)))
+    if threshold is not None:
+        exact = dict((cluster[0], cluster) for cluster in clusters)
+        duplicates = set(aid for cluster in clusters for aid in cluster[1:])
+        near = find_near_duplicates(iter_texts(articles, exclude=duplicates), threshold)
+        log.info("Found {n} clusters of near duplicates".format(n=len(near)))
+        # merge the exact duplicates of the near duplicates into their cluster
+        clusters = [[aid for rep in cluster for aid in exact.pop(rep, [rep])] for cluster in near]
+        clusters += exact.values()
+    return clusters
 
 class DeduplicateScript(Script):
+    """
+    Remove the duplicate articles from the given articleset, or from the
+    sets of the daily scrapers. Returns the clusters of duplicate article ids.
+    """
     options_form = DeduplicateForm
 
     def run(self,_input):
-        """
-        Takes an articleset/date as input and removes all duplicated articles from that set/date
-        """
-        for scraper in Scraper.objects.raw("SELECT * FROM scrapers WHERE run_daily='t'"):
-            articleset=scraper.articleset
-            date = self.options['date']
-            articles = Article.objects.filter(articlesetarticle__articleset=articleset,date__gte=date)
-            
-            txtDict, texts = {}, set()
-            for article in articles:
-                text = article.text
-                if text:
-                    if not text in texts:
-                        txtDict[text] = []
-                    txtDict[text].append(article.id)
-                    texts.add(text)
-
-            removable_ids = []
-            for ids in txtDict.itervalues():
-                if len(ids) > 1:
-                    removable_ids.extend(ids[1:])
-            articles.filter(id__in = removable_ids).update(project = 2) #trash project
-            ArticleSetArticle.objects.filter(article__in = removable_ids).delete() #delete from article set
-            log.info("Moved %s duplicated articles to (trash) project 2" % len(removable_ids))
-    
-        
-    def run_scrapers(self):
-        """
-        Runs on all daily scraper articlesets
-        """
-        
+        if self.options['articleset']:
+            articlesets = [self.options['articleset']]
+        else:
+            articlesets = [scraper.articleset for scraper in
+                           Scraper.objects.raw("SELECT * FROM scrapers WHERE run_daily='t'")]
+        result = []
+        for articleset in articlesets:
+            articles = Article.objects.filter(articlesetarticle__articleset=articleset)
+            if self.options['date']:
+                articles = articles.filter(date__gte=self.options['date'])
+            if self.options['end_date']:
+                articles = articles.filter(date__lt=self.options['end_date'] + datetime.timedelta(days=1))
+            clusters = find_duplicates(articles, self.options['threshold'])
+            result += clusters
+            if not self.options['dry_run']:
+                self.remove(articleset, [aid for cluster in clusters for aid in cluster[1:]])
+        return result
+
+    def remove(self, articleset, removable_ids):
+        with deferred_queue():
+            for ids in splitlist(removable_ids, BATCH):
+                Article.objects.filter(id__in=ids).update(project=TRASH_PROJECT)
+                ArticleSetArticle.objects.filter(articleset=articleset, article__in=ids).delete()
+        log.info("Moved %s duplicated articles from %s to (trash) project %s"
+                 % (len(removable_ids), articleset, TRASH_PROJECT))
         
         
 if __name__ == '__main__':
-    from sys import argv
-    from getopt import getopt
-    opts,args = getopt(argv,"s")
-    for opt,arg in opts:
-        if opt == '-s':
-            dedu = DeduplicateScript()
-            dedu.run_scrapers()
-    
-
     amcatlogging.info_module("amcat.scripts.maintenance.deduplicate")
     from amcat.scripts.tools import cli
     cli.run_cli(DeduplicateScript)
@@ -91,14 +150,29 @@ if __name__ == '__main__':
 from amcat.tools import amcattest    
 
 class TestDeduplicateScript(amcattest.PolicyTestCase):
+    TEXT = ("De minister van financien heeft vandaag in Den Haag de plannen voor de"
+            " nieuwe begroting gepresenteerd. Volgens de minister is er voor het"
+            " komende jaar geen ruimte voor lastenverlichting, maar worden de"
+            " bezuinigingen op onderwijs en zorg wel verzacht.")
+
     def test_deduplicate(self):
         """One article should be deleted from artset and added to project 2"""
         p = amcattest.create_test_project()
-        art1 = amcattest.create_test_article( url='blaat1', project=p)
-        art2 = amcattest.create_test_article( url='blaat2', project=p)
-        art3 = amcattest.create_test_article( url='blaat1', project=p)
+        art1 = amcattest.create_test_article( url='blaat1', project=p, text="tekst 1")
+        art2 = amcattest.create_test_article( url='blaat2', project=p, text="tekst 2")
+        art3 = amcattest.create_test_article( url='blaat1', project=p, text="Tekst 1.")
         artset = amcattest.create_test_set(articles=[art1, art2, art3])
-        d = DeduplicateScript(articleset = artset.id)
-        d.run( None )
+        d = DeduplicateScript(articleset = artset.id, threshold=None)
+        self.assertEqual(d.run( None ), [[art1.id, art3.id]])
         self.assertEqual(len(artset.articles.all()), 2)
         self.assertEqual(len(Article.objects.filter(project = 2)), 1)
+
+    def test_near_duplicates(self):
+        """Are trivially edited articles and their exact duplicates clustered?"""
+        p = amcattest.create_test_project()
+        texts = [self.TEXT, "iets heel anders", self.TEXT + " (ANP)", self.TEXT.upper() + " (ANP)"]
+        arts = [amcattest.create_test_article(project=p, text=text) for text in texts]
+        artset = amcattest.create_test_set(articles=arts)
+        d = DeduplicateScript(articleset=artset.id, threshold=0.8, dry_run=True)
+        self.assertEqual(d.run(None), [[arts[0].id, arts[2].id, arts[3].id]])
+        self.assertEqual(len(artset.articles.all()), 4)
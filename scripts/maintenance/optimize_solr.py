@@ -1,3 +1,2 @@
-import solr
-s = solr.SolrConnection('http://localhost:8983/solr')
-s.optimize()
\ No newline at end of file
+from amcat.tools.amcatsolr import get_solr
+get_solr().commit(optimize=True)
@@ -0,0 +1,2 @@
+from amcat.models.articlecount import rebuild_article_counts
+rebuild_article_counts()
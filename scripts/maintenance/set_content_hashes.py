@@ -0,0 +1,2 @@
+from amcat.models.article import set_content_hashes
+set_content_hashes()
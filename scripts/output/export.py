@@ -0,0 +1,190 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Script that streams the articles of a selection to CSV, JSON lines or Excel.
+
+Unlike the ArticleListTo* scripts, the articles are never all in memory: they
+are read from the database in batches, loading only the fields needed for the
+requested columns, and the output is produced in chunks. The result can be
+written to a file or passed to an HttpResponse.
+"""
+
+from amcat.scripts import script
+from amcat.scripts.tools import solrlib, database
+from amcat.scripts.processors.articlelist_to_table import getArticleColumns
+from amcat.scripts.output.json import encode_json
+from amcat.tools.table.tableoutput import getstr
+from amcat.tools.toolkit import splitlist
+from amcat.models.article import Article
+from django.utils import simplejson
+from django import forms
+import amcat.scripts.forms
+from cStringIO import StringIO
+import tempfile
+import zipfile
+import csv
+
+import logging
+log = logging.getLogger(__name__)
+
+# output is yielded in chunks of (at least) this many bytes
+CHUNK_SIZE = 64 * 1024
+
+MIMETYPES = {'csv' : 'text/csv',
+             'jsonl' : 'application/x-json-lines',
+             'xlsx' : 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'}
+
+class ArticleExportForm(amcat.scripts.forms.SelectionForm, amcat.scripts.forms.ArticleColumnsForm):
+    format = forms.ChoiceField(choices=(('csv', 'CSV'), ('jsonl', 'JSON lines'), ('xlsx', 'Excel')),
+                               initial='csv')
+    delimiter = forms.CharField(initial=',', max_length=1, required=False)
+    limitTextLength = forms.BooleanField(initial=False, required=False)
+
+    def clean_columns(self):
+        data = self.cleaned_data['columns']
+        if 'keywordInContext' in data or 'hits' in data:
+            raise forms.ValidationError('Keyword in Context and Hits columns cannot be exported')
+        return data
+
+def selectFields(queryset, fields):
+    """ returns the queryset, loading only the given fields (including fields of related objects) """
+    related = set(f.split('__')[0] for f in fields if '__' in f)
+    if related:
+        queryset = queryset.select_related(*related)
+    return queryset.only(*set(f.split('__')[0] for f in fields))
+
+def iterArticles(options, fields):
+    """ iterate over the selected articles, loading only the given fields, in batches """
+    if options['useSolr'] == False:
+        queryset = selectFields(database.getQuerySet(**options), fields)
+        return database.iterQuerySet(queryset)
+    query = '(%s)' % ') OR ('.join([q.query for q in options['queries']])
+    return _iterArticlesById(solrlib.iterArticleids(query, options), fields)
+
+def _iterArticlesById(articleids, fields):
+    for ids in splitlist(articleids, database.STREAM_BATCH):
+        articles = selectFields(Article.objects.filter(pk__in=ids), fields).in_bulk(ids)
+        for aid in ids:
+            if aid in articles:
+                yield articles[aid]
+
+def _chunks(buffer, rows, write):
+    """ write the rows to the buffer, yielding its contents whenever it exceeds CHUNK_SIZE """
+    for row in rows:
+        write(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def exportCsv(header, rows, delimiter=','):
+    buffer = StringIO()
+    writer = csv.writer(buffer, dialect='excel', delimiter=str(delimiter))
+    writer.writerow(map(getstr, header))
+    return _chunks(buffer, rows, lambda row: writer.writerow(map(getstr, row)))
+
+def exportJsonLines(header, rows):
+    buffer = StringIO()
+    def write(row):
+        buffer.write(simplejson.dumps(dict(zip(header, row)), default=encode_json))
+        buffer.write("\n")
+    return _chunks(buffer, rows, write)
+
+def exportXlsx(header, rows):
+    # Import openpyxl "lazy" to prevent global dependency
+    from openpyxl.workbook import Workbook
+    from openpyxl.writer.dump_worksheet import ExcelDumpWriter
+
+    # the optimized (dump) worksheet writes the rows to a temporary file,
+    # the zipped workbook is written to a temporary file and then streamed
+    wb = Workbook(optimized_write = True)
+    ws = wb.create_sheet()
+    ws.append(map(unicode, header))
+    for row in rows:
+        ws.append(list(row))
+    out = tempfile.TemporaryFile()
+    zf = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+    ExcelDumpWriter(wb).write_data(zf)
+    zf.close()
+    out.seek(0)
+    return iter(lambda: out.read(CHUNK_SIZE), b"")
+
+class ArticleExport(script.Script):
+    """
+    Export the selected articles in the requested format. Returns an iterator
+    over chunks of the output, use MIMETYPES[format] for the content type.
+    """
+    input_type = None
+    options_form = ArticleExportForm
+    output_type = None
+
+    def run(self, input=None):
+        columns = getArticleColumns(self.options)
+        header = [label for (_name, label, _fields, _func) in columns]
+        fields = set(['id']) | set(f for (_name, _label, fields, _func) in columns for f in fields)
+        articles = iterArticles(self.options, fields)
+        rows = ([func(a) for (_name, _label, _fields, func) in columns] for a in articles)
+        format = self.options['format']
+        log.info("Exporting articles to {format}, columns={header}".format(**locals()))
+        if format == 'csv':
+            return exportCsv(header, rows, self.options['delimiter'] or ',')
+        elif format == 'jsonl':
+            return exportJsonLines(header, rows)
+        elif format == 'xlsx':
+            return exportXlsx(header, rows)
+        raise ValueError("Unknown export format: %r" % format)
+
+if __name__ == '__main__':
+    from amcat.scripts.tools import cli
+    cli.run_cli(ArticleExport)
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class TestArticleExport(amcattest.PolicyTestCase):
+
+    def export(self, **options):
+        return "".join(ArticleExport(**options).run())
+
+    def test_export(self):
+        """Are all articles exported as CSV and JSON lines?"""
+        p = amcattest.create_test_project()
+        arts = [amcattest.create_test_article(project=p, headline=u"h\xe9adline %i" % i)
+                for i in range(5)]
+        options = dict(projects=[p.id], datetype='all', columns=['article_id', 'headline', 'medium_name'])
+        lines = self.export(format='csv', **options).splitlines()
+        self.assertEqual(lines[0], "Article ID,Headline,Medium Name")
+        self.assertEqual(lines[1:], ["{a.id},{h},{a.medium.name}".format(a=a, h=a.headline.encode('utf-8'))
+                                     for a in arts])
+        rows = [simplejson.loads(line) for line in self.export(format='jsonl', **options).splitlines()]
+        self.assertEqual([row['Article ID'] for row in rows], [a.id for a in arts])
+        self.assertEqual(rows[0]['Headline'], arts[0].headline)
+
+    def test_chunks(self):
+        """Is output yielded in chunks?"""
+        rows = ([str(i) * 1000] for i in range(200))
+        chunks = list(exportCsv(["x"], rows))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(len("".join(chunks).splitlines()), 201)
@@ -36,6 +36,41 @@ class ArticleListToTableForm(amcat.scripts.forms.ArticleColumnsForm):
 def lambdaHitFactory(query):
     return lambda a: a.hits.get(query)
 
+# mapping of column names to (label, article fields used, function to get the value)
+# fields of related objects (medium__name) require a select_related on the relation
+ARTICLE_COLUMNS = {
+    'article_id': ("Article ID", ['id'], lambda a: a.id),
+    'date': ('Date', ['date'], lambda a: a.date.strftime('%d-%m-%Y')),
+    'medium_id': ('Medium ID', ['medium'], lambda a:a.medium_id),
+    'medium_name': ('Medium Name', ['medium__name'], lambda a:a.medium.name),
+    'project_id': ('Project ID', ['project'], lambda a:a.project_id),
+    'project_name': ('Project Name', ['project__name'], lambda a:a.project.name),
+    'pagenr': ('Page number', ['pagenr'], lambda a:a.pagenr),
+    'section': ('Section', ['section'], lambda a:a.section),
+    'length': ('Length', ['length'], lambda a:a.length),
+    'url': ('url', ['url'], lambda a:a.url),
+    'parent_id': ('Parent Article ID', ['parent'], lambda a:a.parent_id),
+    'externalid': ('External ID', ['externalid'], lambda a:a.externalid),
+    'additionalMetadata': ('Additional Metadata', ['metastring'], lambda a:a.metastring),
+    'headline': ('Headline', ['headline'], lambda a:a.headline),
+    'author': ('Author', ['author'], lambda a:a.author),
+}
+
+def getArticleColumns(options):
+    """
+    returns a list of (name, label, fields, function) tuples for the requested
+    columns that can be read from the article itself (so not hits or keywordInContext)
+    """
+    if options.get('limitTextLength') == True:
+        textLambda = lambda a:a.text[:31900]
+    else:
+        textLambda = lambda a:a.text
+    columns = dict(ARTICLE_COLUMNS)
+    columns['text'] = ('Article Text', ['text'], textLambda)
+    columns['interval'] = ('Interval', ['date'],
+                           lambda a:dateToInterval(a.date, options['columnInterval']))
+    return [(name,) + columns[name] for name in options['columns'] if name in columns]
+
 class ArticleListToTable(script.Script):
     input_type = types.ArticleIterator
     options_form = ArticleListToTableForm
@@ -43,12 +78,6 @@ class ArticleListToTable(script.Script):
 
 
     def run(self, articles):
-        if self.options['limitTextLength'] == True:
-            textLambda = lambda a:a.text[:31900]
-        else:
-            textLambda = lambda a:a.text
-             
-            
         hitsColumns = []
         if 'hits' in self.options['columns']:
             articles = list(articles)
@@ -60,25 +89,9 @@ class ArticleListToTable(script.Script):
         
         #log.info(hitsColumns)
         
-        colDict = { # mapping of names to article object attributes
-            'article_id': table.table3.ObjectColumn("Article ID", lambda a: a.id),
-            'date': table.table3.ObjectColumn('Date', lambda a: a.date.strftime('%d-%m-%Y')),
-            'medium_id': table.table3.ObjectColumn('Medium ID', lambda a:a.medium_id),
-            'medium_name': table.table3.ObjectColumn('Medium Name', lambda a:a.medium.name),
-            'project_id': table.table3.ObjectColumn('Project ID', lambda a:a.project_id),
-            'project_name': table.table3.ObjectColumn('Project Name', lambda a:a.project.name),
-            'pagenr': table.table3.ObjectColumn('Page number', lambda a:a.pagenr),
-            'section': table.table3.ObjectColumn('Section', lambda a:a.section),
-            'length': table.table3.ObjectColumn('Length', lambda a:a.length),
-            'url': table.table3.ObjectColumn('url', lambda a:a.url),
-            'parent_id': table.table3.ObjectColumn('Parent Article ID', lambda a:a.parent_id),
-            'externalid': table.table3.ObjectColumn('External ID', lambda a:a.externalid),
-            'additionalMetadata': table.table3.ObjectColumn('Additional Metadata', lambda a:a.metastring),
-            'headline': table.table3.ObjectColumn('Headline', lambda a:a.headline),
-            'author': table.table3.ObjectColumn('Author', lambda a:a.author),
-            'text': table.table3.ObjectColumn('Article Text', textLambda),
-            'interval':table.table3.ObjectColumn(
-                'Interval', lambda a:dateToInterval(a.date, self.options['columnInterval'])),
+        colDict = dict((name, table.table3.ObjectColumn(label, func))
+                       for (name, label, _fields, func) in getArticleColumns(self.options))
+        colDict.update({
             'keywordInContext': [table.table3.ObjectColumn(
                     'Context before', lambda a:a.keywordInContext.get('text',{}).get('before')),
                                 table.table3.ObjectColumn(
@@ -87,7 +100,7 @@ class ArticleListToTable(script.Script):
                     'Context after', lambda a:a.keywordInContext.get('text',{}).get('after')),
                                  ],
             'hits': hitsColumns
-        }
+        })
         #print self.options
         columns = []
         for col in self.options['columns']:
@@ -28,7 +28,10 @@ from amcat.scripts.tools import solrlib, database
 import amcat.scripts.forms
 from django import forms
 from django.db.models import Sum, Count
+import datetime
 from amcat.models.medium import Medium
+from amcat.models.articlecount import count_articles
+from amcat.tools.toolkit import dateToInterval
 from amcat.tools import table
 
 
@@ -70,6 +73,10 @@ class AggregationScript(script.Script):
     def run(self, input=None):
         """ returns a table containing the aggregations"""
         
+        if (self.options['useSolr'] == False and not self.options.get('articleids')
+            and len(self.options.get('articlesets') or []) <= 1):
+            # the rollup would count articles in several sets more than once
+            return self.countAggregate()
         if self.options['useSolr'] == False: # make database query
             queryset = database.getQuerySet(**self.options)
             xAxis = self.options['xAxis']
@@ -100,7 +107,8 @@ class AggregationScript(script.Script):
                 vals.append('y')
 
             # the following line will perform a group by database query
-            data = queryset.extra(select=select_data).values(*vals).annotate(count=Count('id'))
+            # (distinct, as an article can be in more than one of the selected sets)
+            data = queryset.extra(select=select_data).values(*vals).annotate(count=Count('id', distinct=True))
             xDict = {}
             if xAxis == 'medium':
                 xDict = Medium.objects.in_bulk(set(row['x'] for row in data)) # retrieve the Medium objects
@@ -118,6 +126,53 @@ class AggregationScript(script.Script):
             return table3
         else:
             return solrlib.basicAggregate(self.options)
+
+    def countAggregate(self):
+        """ aggregate using the per day article count rollups rather than the articles """
+        xAxis, yAxis = self.options['xAxis'], self.options['yAxis']
+        if xAxis == 'date' and not self.options['dateInterval']:
+            raise Exception('Missing date interval')
+        if xAxis not in ('date', 'medium'):
+            raise Exception('unsupported xAxis')
+        if yAxis == 'searchTerm':
+            raise Exception('searchTerm not supported when not performing a search')
+        if yAxis not in ('medium', 'total'):
+            raise Exception('unsupported yAxis')
+
+        options = dict((k, self.options.get(k)) for k in
+                       ('projects', 'articlesets', 'mediums', 'startDate', 'endDate'))
+        endDate = options['endDate']
+        if not endDate:
+            counts = count_articles(**options)
+        else:
+            # getQuerySet includes the articles up to and including endDate (midnight for
+            # a date), but the rollup only knows days: count the days before the end day
+            # from the rollup and the end day itself from the articles
+            endDay = _toDatetime(endDate).replace(hour=0, minute=0, second=0, microsecond=0)
+            counts = count_articles(**dict(options, endDate=endDay.date()))
+            startDate = endDay
+            if options['startDate']:
+                startDate = max(startDate, _toDatetime(options['startDate']))
+            q = database.getQuerySet(**dict(options, startDate=startDate))
+            counts += [(endDay.date(), mediumid, n) for (mediumid, n)
+                       in q.values_list("medium").annotate(n=Count("id")).order_by()]
+        mediums = Medium.objects.in_bulk(set(mediumid for (_date, mediumid, _n) in counts))
+        table3 = table.table3.DictTable(0) # the start aggregation count is 0
+        table3.rowNamesRequired = True # make sure row names are printed
+        for date, mediumid, n in counts:
+            if xAxis == 'date':
+                x = dateToInterval(date, self.options['dateInterval'])
+            else:
+                x = mediums[mediumid]
+            y = mediums[mediumid] if yAxis == 'medium' else '[total]'
+            table3.addValue(x, y, table3.getValue(x, y) + n)
+        return table3
+
+def _toDatetime(date):
+    """Return the date as a datetime, at midnight if it has no time"""
+    if isinstance(date, datetime.datetime):
+        return date
+    return datetime.datetime.combine(date, datetime.time())
             
         
         
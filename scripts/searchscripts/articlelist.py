@@ -30,10 +30,14 @@ from django import forms
 import logging
 log = logging.getLogger(__name__)
 
+# length used for 'all articles', which are streamed when searching the database
+ALL_ROWS = 999999
+
 class ArticleListForm(amcat.scripts.forms.SelectionForm, amcat.scripts.forms.ArticleColumnsForm):
     start = forms.IntegerField(initial=0, min_value=0, widget=forms.HiddenInput, required=False)
     length = forms.IntegerField(initial=100, min_value=1, max_value=9999999,
                                 widget=forms.HiddenInput, required=False)
+    pageToken = forms.CharField(required=False, widget=forms.HiddenInput)
     highlight = forms.BooleanField(initial=False, required=False)
     sortColumn = forms.CharField(required=False)
     sortOrder = forms.ChoiceField(
@@ -54,7 +58,7 @@ class ArticleListForm(amcat.scripts.forms.SelectionForm, amcat.scripts.forms.Art
         if data == None:
             data = 100
         if data == -1:
-            data = 999999 # unlimited (well, sort of ;)
+            data = ALL_ROWS
         return data
 
     def clean_columns(self):
@@ -81,17 +85,21 @@ class ArticleListScript(script.Script):
 
 
     def run(self, input=None):
-        """ returns an iterable of articles, when Solr is used, possibly including highlighting """
+        """
+        returns an iterable of articles, when Solr is used, possibly including highlighting.
+        Database queries return an ArticlePage, whose nextPageToken can be passed as
+        pageToken to get the next page, or an iterator if all articles are requested.
+        """
         start = self.options['start']
         length = self.options['length']
 
         if self.options['useSolr'] == False: # make database query
-            qs = database.getQuerySet(**self.options)
-            if self.options['sortColumn']:
-                qs = qs.order_by(('-' if self.options['sortOrder'] == 'desc' else '')
-                                 + self.options['sortColumn'])
-            qs = qs[start:start+length].select_related('medium__name', 'medium')
-            return qs
+            qs = database.getQuerySet(**self.options).select_related('medium')
+            sortColumn, sortOrder = self.options['sortColumn'], self.options['sortOrder']
+            pageToken = self.options.get('pageToken')
+            if length == ALL_ROWS and not (start or pageToken):
+                return database.iterQuerySet(qs, sortColumn, sortOrder)
+            return database.getPage(qs, sortColumn, sortOrder, length, pageToken, start)
         else:
 
             if self.options['highlight']:
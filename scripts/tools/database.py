@@ -2,8 +2,17 @@
 A number of functions that help the Amcat3 selection page to retrieve selections from the database
 """
 
+import json
+import base64
+
+from django.db import connection
+from django.db.models import Q
+
 from amcat.models import article
 
+# number of articles retrieved per query when iterating over all articles
+STREAM_BATCH = 1000
+
 def getQuerySet(projects=None, articlesets=None, mediums=None, startDate=None, endDate=None, articleids=None, **kargs):
     queryset = article.Article.objects
     if articlesets:
@@ -21,3 +30,127 @@ def getQuerySet(projects=None, articlesets=None, mediums=None, startDate=None, e
     if articleids:
         queryset = queryset.filter(id__in=articleids)
     return queryset
+
+
+class ArticlePage(list):
+    """ a page of articles, with the token for the next page (None if this is the last page) """
+    def __init__(self, articles, nextPageToken=None):
+        list.__init__(self, articles)
+        self.nextPageToken = nextPageToken
+
+def getSortField(sortColumn):
+    """
+    returns the Article field for the sortColumn, which can be a field name (date), column (medium_id)
+    or the id of a related object (medium__id). Returns None for other related lookups (medium__name),
+    which can be sorted on but not used for page tokens.
+    """
+    name = sortColumn
+    if '__' in sortColumn:
+        name, related = sortColumn.split('__', 1)
+    for field in article.Article._meta.fields:
+        if name in (field.name, field.attname):
+            if name == sortColumn or (field.rel and related in ('id', 'pk')):
+                return field
+            if field.rel:
+                return None
+    raise ValueError("Cannot sort articles on %r" % sortColumn)
+
+def encodePageToken(field, a):
+    """ returns an opaque token containing the sort value and id of the article """
+    value = getattr(a, field.attname)
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, a.id]))
+
+def decodePageToken(field, token):
+    """ returns the (sort value, id) pair from a token created by encodePageToken """
+    try:
+        value, aid = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid page token: %r" % token)
+    return (None if value is None else field.to_python(value)), aid
+
+def sortQuerySet(queryset, field, desc=False):
+    """
+    returns the queryset sorted on (field, id). NULL values of a nullable field are sorted
+    after all other values (before them if desc), regardless of the database.
+    """
+    sign = '-' if desc else ''
+    if field.name == 'id':
+        return queryset.order_by(sign + 'id')
+    # sort foreign keys on the id rather than the ordering of the related model
+    name = field.name + '__id' if field.rel else field.name
+    if not field.null:
+        return queryset.order_by(sign + name, sign + 'id')
+    column = '%s.%s' % (connection.ops.quote_name(queryset.model._meta.db_table),
+                        connection.ops.quote_name(field.column))
+    queryset = queryset.extra(select={'sort_isnull' : '%s IS NULL' % column})
+    return queryset.order_by(sign + 'sort_isnull', sign + name, sign + 'id')
+
+def afterKey(field, value, aid, desc=False):
+    """ returns a Q selecting the articles after (value, aid) in the sortQuerySet order """
+    op = 'lt' if desc else 'gt'
+    after = Q(**{'id__' + op : aid})
+    if field.name == 'id':
+        return after
+    if value is None:
+        # NULLs come last in ascending order and first in descending order
+        after = Q(**{field.name + '__isnull' : True}) & after
+        if desc:
+            after |= Q(**{field.name + '__isnull' : False})
+        return after
+    after = Q(**{field.name + '__' + op : value}) | (Q(**{field.name : value}) & after)
+    if field.null and not desc:
+        after |= Q(**{field.name + '__isnull' : True})
+    return after
+
+def getPage(queryset, sortColumn=None, sortOrder='asc', length=100, pageToken=None, start=0):
+    """
+    returns an ArticlePage with the articles sorted on (sortColumn, id).
+    If a pageToken (from the previous page) is given, the page starts after the
+    article in the token. Since this only needs an index lookup, any page is
+    as fast as the first page. Otherwise, the page starts at the start offset:
+    only the ids are skipped on the database, but this still gets slower for
+    every page. Pages sorted on fields of related objects (other than their id)
+    have no page token and can only be selected using start.
+    """
+    field = getSortField(sortColumn or 'id')
+    desc = (sortOrder == 'desc')
+    if field is None:
+        queryset = queryset.order_by(('-' if desc else '') + sortColumn, 'id')
+        if pageToken:
+            raise ValueError("Cannot use page tokens when sorting on %r" % sortColumn)
+    else:
+        queryset = sortQuerySet(queryset, field, desc)
+    if pageToken:
+        value, aid = decodePageToken(field, pageToken)
+        articles = list(queryset.filter(afterKey(field, value, aid, desc))[:length + 1])
+    elif start:
+        # the extra select used for sorting should be selected as well
+        fields = ['id'] + [name for name in queryset.query.extra if name == 'sort_isnull']
+        ids = [row[0] for row in queryset.values_list(*fields)[start:start + length + 1]]
+        articlesDict = queryset.model.objects.filter(pk__in=ids).select_related('medium').in_bulk(ids)
+        articles = [articlesDict[aid] for aid in ids if aid in articlesDict]
+    else:
+        articles = list(queryset[:length + 1])
+    if len(articles) > length:
+        token = encodePageToken(field, articles[length - 1]) if field else None
+        return ArticlePage(articles[:length], token)
+    return ArticlePage(articles)
+
+def iterQuerySet(queryset, sortColumn=None, sortOrder='asc', batch=STREAM_BATCH):
+    """ iterate over all articles sorted on (sortColumn, id), retrieving them in pages of batch articles """
+    keyset = getSortField(sortColumn or 'id') is not None
+    pageToken, start = None, 0
+    while True:
+        page = getPage(queryset, sortColumn, sortOrder, batch, pageToken, start)
+        for a in page:
+            yield a
+        if keyset:
+            if page.nextPageToken is None:
+                break
+            pageToken = page.nextPageToken
+        else:
+            if len(page) < batch:
+                break
+            start += batch
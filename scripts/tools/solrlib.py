@@ -23,9 +23,16 @@ Library that makes it easier to access Solr features as used in Amcat3
 Requires solrpy
 """
 import solr, re
+import datetime
+import itertools
+from solr.core import utc_from_string
 from amcat.models import article
 from amcat.models import medium
 from amcat.tools.toolkit import dateToInterval
+from amcat.tools.amcatsolr import get_solr, SOLR_VERSION, SOLR_POOL_SIZE
+from amcat.tools.amcatsolr import filters_from_form, terms_filter
+
+from multiprocessing.pool import ThreadPool
 
 from amcat.tools.table.table3 import DictTable
 import time
@@ -38,9 +45,7 @@ def doQuery(query, form, kargs, additionalFilters=None):
     if additionalFilters:
         filters += additionalFilters
     startTime = time.time()
-    solrResponse = solr.SolrConnection('http://localhost:8983/solr').query(query,
-                    fq=filters,
-                    **kargs)
+    solrResponse = get_solr().cached_query(query, filters=filters, **kargs)
     log.info("found %s results in %2f ms! \r"
              % (len(solrResponse.results),((time.time() - startTime) * 1000)))
     return solrResponse
@@ -109,6 +114,14 @@ def highlightArticles(form, snippets=3):
 
 
 
+def sortArgument(form):
+    """returns the solr sort argument for the sortColumn and sortOrder of the form"""
+    sortColumn = form['sortColumn']
+    if sortColumn == 'medium__id': sortColumn = 'mediumid'
+    if sortColumn not in ('id', 'date', 'mediumid', 'score', 'headline'):
+        raise Exception('Cannot sort on %s' % sortColumn)
+    return '%s %s' % (sortColumn, form.get('sortOrder') or 'asc')
+
 def getArticles(form):
     #if len(queries) == 1:
     query = '(%s)' % ') OR ('.join([q.query for q in form['queries']])
@@ -118,10 +131,7 @@ def getArticles(form):
             )
 
     if form['sortColumn']:
-        if form['sortColumn'] == 'medium__id': form['sortColumn'] = 'mediumid'
-        if form['sortColumn'] not in ('id', 'date', 'mediumid', 'score', 'headline'):
-            raise Exception('Cannot sort on %s' % form['sortColumn'])
-        kargs['sort'] = '%s %s' % (form['sortColumn'], form['sortOrder'])
+        kargs['sort'] = sortArgument(form)
 
     kargsMainQuery = kargs.copy()
 
@@ -155,17 +165,10 @@ def getArticles(form):
 
     if 'hits' in form['columns']:
         if len(form['queries']) > 1:
-            additionalFilters = [' OR '.join(['id:%d' % id for id in articleids])]
             for singleQuery in form['queries']:
                 hitsTable.columns.add(singleQuery.label)
-                solrResponseSingleQuery = doQuery(singleQuery.query, form, kargs, additionalFilters)
-                #articleIdList = []
-                for d in solrResponseSingleQuery.results:
-                    articleid = int(d['id'])
-                    #articleIdList.append(articleid)
-                    hits = int(d['score'])
-                    log.info('add %s %s %s' % (articleid, singleQuery.label, hits))
-                    hitsTable.addValue(articleid, singleQuery.label, hits)
+            for articleid, label, hits in getHits(form['queries'], form, articleids):
+                hitsTable.addValue(articleid, label, hits)
         else: # only 1 query
             queryLabel = form['queries'][0].label
             hitsTable.columns.add(queryLabel)
@@ -189,62 +192,122 @@ def getArticles(form):
         result.append(a)
     return result
 
+def getHits(queries, form, articleids):
+    """
+    yield (articleid, query label, hits) tuples for the given articles and queries
+
+    On Solr 4+, this is a single request that retrieves the score of each
+    query as a pseudo-field. Older versions can only return one score per
+    document, so one request per query is done, concurrently.
+    """
+    if not articleids:
+        return
+    idFilter = [terms_filter('id', articleids)]
+    kargs = dict(start=0, rows=len(articleids), score=False)
+    if SOLR_VERSION >= (4, 0):
+        fields = ['id']
+        for i, query in enumerate(queries):
+            fields.append('hits%i:query($hitsq%i)' % (i, i))
+            kargs['hitsq%i' % i] = query.query
+        solrResponse = doQuery('*:*', form, dict(kargs, fields=fields), idFilter)
+        for d in solrResponse.results:
+            for i, query in enumerate(queries):
+                hits = int(d.get('hits%i' % i) or 0)
+                if hits:
+                    yield int(d['id']), query.label, hits
+    else:
+        def queryHits(query):
+            solrResponse = doQuery(query.query, form, dict(kargs, fields='id,score'), idFilter)
+            return [(int(d['id']), query.label, int(d['score'])) for d in solrResponse.results]
+        pool = ThreadPool(min(len(queries), SOLR_POOL_SIZE))
+        try:
+            for hits in pool.map(queryHits, queries):
+                for row in hits:
+                    yield row
+        finally:
+            pool.close()
+
+# interval used for the per-interval article counts of the set statistics
+STATS_INTERVAL = 'year'
+# dates outside this range are not counted in the per-interval statistics
+STATS_RANGE = ('1900-01-01T00:00:00Z', 'NOW/YEAR+1YEAR')
+
 def getStats(statsObj, form):
+    """
+    fill statsObj with the article count, first/last date, per-medium counts
+    and per-interval counts of the query, using a single facet request
+    (plus a probe for the last date on Solr < 4.0, which cannot compute date stats)
+    """
     query = '(%s)' % ') OR ('.join([q.query for q in form['queries']])
-
-    kargs = dict(
-                fields="date",
-                start=0,
-                rows=1,
-                sort='date asc')
+    unit = RANGE_GAP_UNITS[STATS_INTERVAL]
+    kargs = {'fields' : 'date', 'score' : False, 'start' : 0,
+             'facet' : 'true', 'facet_mincount' : 1, 'facet_limit' : -1,
+             'facet_field' : 'mediumid', 'facet_range' : 'date',
+             'f_date_facet_range_start' : STATS_RANGE[0],
+             'f_date_facet_range_end' : STATS_RANGE[1],
+             'f_date_facet_range_gap' : '+1%s' % unit}
+    if SOLR_VERSION >= (4, 0):
+        kargs.update(rows=0, stats='true', stats_field='date')
+    else:
+        kargs.update(rows=1, sort='date asc')
     solrResponse = doQuery(query, form, kargs)
     statsObj.articleCount = solrResponse.numFound
-
+    statsObj.mediums, statsObj.intervalCounts = [], []
     if solrResponse.numFound == 0:
         return
 
-    statsObj.firstDate = solrResponse.results[0]['date']
+    if SOLR_VERSION >= (4, 0):
+        dateStats = solrResponse.stats['stats_fields']['date']
+        statsObj.firstDate, statsObj.lastDate = dateStats['min'], dateStats['max']
+    else:
+        statsObj.firstDate = solrResponse.results[0]['date']
+        lastResponse = doQuery(query, form, dict(fields="date", score=False, start=0,
+                                                 rows=1, sort='date desc'))
+        statsObj.lastDate = lastResponse.results[0]['date']
+
+    facets = solrResponse.facet_counts
+    mediumCounts = dict((int(mediumid), count) for (mediumid, count)
+                        in facets['facet_fields']['mediumid'].iteritems())
+    statsObj.mediums = [(m, mediumCounts[m.id]) for m in mediumidsToObj(sorted(mediumCounts))]
+    dateCounts = facets['facet_ranges']['date']['counts']
+    statsObj.intervalCounts = [(dateToInterval(utc_from_string(bucket), STATS_INTERVAL), count)
+                               for (bucket, count) in sorted(dateCounts.iteritems())]
 
-    kargs = dict(
-                fields="date",
-                start=0,
-                rows=1,
-                sort='date desc')
-    solrResponse = doQuery(query, form, kargs)
 
-    statsObj.lastDate = solrResponse.results[0]['date']
+# beyond this number of rows, stream the ids instead of asking for one big page
+STREAM_ROWS = 10000
 
-    # kargs = dict(
-                # fields="id",
-                # facet='true',
-                # facet_field='mediumid',
-                # facet_mincount=1,
-                # score=False,
-                # rows=0)
-    # solrResponse = doQuery(query, form, kargs)
+def iterQuery(query, form, fields, **kargs):
+    """lazily yield all result rows for a query, in id order"""
+    return get_solr().query_all(query, filters=createFilters(form), fields=fields, **kargs)
 
-    # mediums = []
-    # for mediumid, count in solrResponse.facet_counts['facet_fields']['mediumid'].items():
-        # m = medium.Medium.objects.get(pk=mediumid)
-        # mediums.append(m)
-    # statsObj.mediums = sorted(mediums, key=lambda x:x.id)
+def iterArticleids(query, form):
+    """lazily yield all articleids for a query, in id order"""
+    return (row['id'] for row in iterQuery(query, form, "id", score=False))
 
+def _queryArticleids(query, form):
+    """
+    get an iterable of the articleids for a single query, in the requested order.
+    If all (or many) ids are requested and no sort order is given, they are
+    lazily retrieved page by page in id order rather than as one big page.
+    """
+    if form['start'] == 0 and form['length'] >= STREAM_ROWS and not form.get('sortColumn'):
+        return itertools.islice(iterArticleids(query, form), form['length'])
+    kargs = dict(fields="id", start=form['start'], rows=form['length'], score=False)
+    if form.get('sortColumn'):
+        kargs['sort'] = sortArgument(form)
+    solrResponse = doQuery(query, form, kargs)
+    return [x['id'] for x in solrResponse.results]
 
 def articleids(form):
     """get only the articleids for a query"""
     query = '(%s)' % ') OR ('.join([q.query for q in form['queries']])
-    kargs = dict(fields="id", start=form['start'], rows=form['length'], score=False)
-    solrResponse = doQuery(query, form, kargs)
-    return [x['id'] for x in solrResponse.results]
+    return _queryArticleids(query, form)
 
 def articleidsDict(form):
     """get only the articleids for a query"""
-    result = {}
-    for query in form['queries']:
-        kargs = dict(fields="id", start=form['start'], rows=form['length'], score=False)
-        solrResponse = doQuery(query.query, form, kargs)
-        result[query.label] = [x['id'] for x in solrResponse.results]
-    return result
+    # lists, as the ids per query are used more than once (see clustermap)
+    return dict((query.label, list(_queryArticleids(query.query, form))) for query in form['queries'])
 
 """
 def aggregate(queries, xAxis, yAxis, filters=[]):
@@ -294,8 +357,121 @@ def mediumidToObj(mediumid):
 def increaseCounter(table, x, y, a, counterLambda):
     table.addValue(x, y, table.getValue(x, y) + counterLambda(a))
 
+def mediumidsToObj(mediumids):
+    """resolve the given medium ids using (at most) a single query"""
+    todo = set(mediumids) - set(mediumCache)
+    if todo:
+        mediumCache.update(medium.Medium.objects.in_bulk(todo))
+    return [mediumCache[mediumid] for mediumid in mediumids if mediumid in mediumCache]
+
+
+# Solr range gap unit used for each aggregation interval. Weeks and quarters
+# are not supported by Solr date math, so these are counted per day/month and
+# then merged using dateToInterval
+RANGE_GAP_UNITS = {'day' : 'DAY', 'week' : 'DAY', 'month' : 'MONTH',
+                   'quarter' : 'MONTH', 'year' : 'YEAR'}
+
+def truncateDate(date, unit):
+    """truncate the date to the start of the day, month or year"""
+    date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit in ('MONTH', 'YEAR'):
+        date = date.replace(day=1)
+    if unit == 'YEAR':
+        date = date.replace(month=1)
+    return date
+
+def solrDate(date):
+    """format the (UTC) date in the format Solr expects"""
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def facetQuery(query, form, facetArgs, additionalFilters=None):
+    """perform a query that only returns the facet counts, not the articles"""
+    kargs = dict(fields="id", score=False, rows=0,
+                 facet='true', facet_mincount=1, facet_limit=-1)
+    kargs.update(facetArgs)
+    return doQuery(query, form, kargs, additionalFilters)
+
+def getDateRange(query, form):
+    """returns a (first date, last date) tuple for the query, or None if nothing matches"""
+    kargs = dict(fields="date", score=False, rows=1)
+    solrResponse = doQuery(query, form, dict(kargs, sort='date asc'))
+    if not solrResponse.results:
+        return None
+    firstDate = solrResponse.results[0]['date']
+    solrResponse = doQuery(query, form, dict(kargs, sort='date desc'))
+    return firstDate, solrResponse.results[0]['date']
+
+def mediumCounts(query, form):
+    """yield (medium, count) tuples using a facet on mediumid"""
+    solrResponse = facetQuery(query, form, dict(facet_field='mediumid'))
+    counts = solrResponse.facet_counts['facet_fields']['mediumid']
+    counts = dict((int(mediumid), count) for (mediumid, count) in counts.iteritems())
+    for m in mediumidsToObj(sorted(counts)):
+        yield m, counts[m.id]
+
+def dateCounts(query, form, dateInterval, dateRange, additionalFilters=None):
+    """yield (interval, count) tuples in date order using a range facet on date"""
+    if not dateRange:
+        return
+    unit = RANGE_GAP_UNITS[dateInterval]
+    firstDate, lastDate = dateRange
+    facetArgs = {'facet_range' : 'date',
+                 'f_date_facet_range_start' : solrDate(truncateDate(firstDate, unit)),
+                 # range end is exclusive, so make sure the last article is included
+                 'f_date_facet_range_end' : solrDate(lastDate + datetime.timedelta(seconds=1)),
+                 'f_date_facet_range_gap' : '+1%s' % unit}
+    solrResponse = facetQuery(query, form, facetArgs, additionalFilters)
+    counts = solrResponse.facet_counts['facet_ranges']['date']['counts']
+    for bucket, count in sorted(counts.iteritems()):
+        yield dateToInterval(utc_from_string(bucket), dateInterval), count
+
+def facetAggregate(form):
+    """
+    aggregate the number of articles using Solr facets, so Solr only returns
+    the counts rather than a row per matching article
+    """
+    table = DictTable(0)
+    table.rowNamesRequired = True
+    queries = form['queries']
+    xAxis = form['xAxis']
+    yAxis = form['yAxis']
+    dateInterval = form['dateInterval']
+    singleQuery = '(%s)' % ') OR ('.join([q.query for q in form['queries']])
+
+    if xAxis == 'medium' and yAxis == 'searchTerm':
+        for query in queries:
+            table.columns.add(query.label)
+            for x, count in mediumCounts(query.query, form):
+                increaseCounter(table, x, query.label, count, int)
+    elif xAxis == 'medium' and yAxis == 'total':
+        for x, count in mediumCounts(singleQuery, form):
+            increaseCounter(table, x, '[total]', count, int)
+    elif xAxis == 'date' and yAxis == 'total':
+        dateRange = getDateRange(singleQuery, form)
+        for x, count in dateCounts(singleQuery, form, dateInterval, dateRange):
+            increaseCounter(table, x, '[total]', count, int)
+    elif xAxis == 'date' and yAxis == 'medium':
+        dateRange = getDateRange(singleQuery, form)
+        for y, _count in mediumCounts(singleQuery, form):
+            mediumFilter = [terms_filter('mediumid', [y.id])]
+            for x, count in dateCounts(singleQuery, form, dateInterval, dateRange, mediumFilter):
+                increaseCounter(table, x, y, count, int)
+    elif xAxis == 'date' and yAxis == 'searchTerm':
+        for query in queries:
+            table.columns.add(query.label)
+            dateRange = getDateRange(query.query, form)
+            for x, count in dateCounts(query.query, form, dateInterval, dateRange):
+                increaseCounter(table, x, query.label, count, int)
+    else:
+        raise Exception('%s %s combination not possible' % (xAxis, yAxis))
+    log.debug('created table')
+    return table
+
 def basicAggregate(form):
     """aggregate by using a counter"""
+    if form['counterType'] != 'numberOfHits':
+        # counting articles does not need the individual rows
+        return facetAggregate(form)
     table = DictTable(0)
     table.rowNamesRequired = True
     queries = form['queries']
@@ -303,7 +479,6 @@ def basicAggregate(form):
     yAxis = form['yAxis']
     counterType = form['counterType']
     dateInterval = form['dateInterval']
-    rowLimit = 1000000
     singleQuery = '(%s)' % ') OR ('.join([q.query for q in form['queries']])
     if counterType == 'numberOfHits':
         counterLambda = lambda a: int(a['score'])
@@ -312,36 +487,30 @@ def basicAggregate(form):
 
     if xAxis == 'medium' and yAxis == 'searchTerm':
         for query in queries:
-            solrResponse = doQuery(query.query, form, dict(fields="score,mediumid", rows=rowLimit))
             table.columns.add(query.label)
-            for a in solrResponse.results:
+            for a in iterQuery(query.query, form, "score,mediumid"):
                 x = mediumidToObj(a['mediumid'])
                 y = query.label
                 increaseCounter(table, x, y, a, counterLambda)
     elif xAxis == 'medium' and yAxis == 'total':
-        solrResponse = doQuery(singleQuery, form, dict(fields="score,mediumid", rows=rowLimit))
-        for a in solrResponse.results:
+        for a in iterQuery(singleQuery, form, "score,mediumid"):
             x = mediumidToObj(a['mediumid'])
             y = '[total]'
             increaseCounter(table, x, y, a, counterLambda)
     elif xAxis == 'date' and yAxis == 'total':
-        solrResponse = doQuery(singleQuery, form, dict(fields="score,date", rows=rowLimit))
-        for a in solrResponse.results:
+        for a in iterQuery(singleQuery, form, "score,date"):
             x = dateToInterval(a['date'], dateInterval)
             y = '[total]'
             increaseCounter(table, x, y, a, counterLambda)
     elif xAxis == 'date' and yAxis == 'medium':
-        solrResponse = doQuery(singleQuery, form, dict(fields="score,date,mediumid", rows=rowLimit))
-        counterDict = {}
-        for a in solrResponse.results:
+        for a in iterQuery(singleQuery, form, "score,date,mediumid"):
             x = dateToInterval(a['date'], dateInterval)
             y = mediumidToObj(a['mediumid'])
             increaseCounter(table, x, y, a, counterLambda)
     elif xAxis == 'date' and yAxis == 'searchTerm':
         for query in queries:
-            solrResponse = doQuery(query.query, form, dict(fields="score,date", rows=rowLimit))
             table.columns.add(query.label)
-            for a in solrResponse.results:
+            for a in iterQuery(query.query, form, "score,date"):
                 x = dateToInterval(a['date'], dateInterval)
                 y = query.label
                 increaseCounter(table, x, y, a, counterLambda)
@@ -354,25 +523,4 @@ def basicAggregate(form):
 
 def createFilters(form):
     """ takes a form as input and ceate filter queries for start/end date, mediumid and set """
-    startDateTime = (form['startDate'].strftime('%Y-%m-%dT00:00:00.000Z')
-                     if 'startDate' in form else '*')
-    endDateTime = form['endDate'].strftime('%Y-%m-%dT00:00:00.000Z') if 'endDate' in form else '*'
-    result = []
-    if startDateTime != '*' or endDateTime != '*': # if at least one of the 2 is a date
-        result.append('date:[%s TO %s]' % (startDateTime, endDateTime))
-    if 'mediums' in form:
-        mediumidQuery = ('mediumid:%d' % m.id for m in form['mediums'])
-        result.append(' OR '.join(mediumidQuery))
-    if 'articleids' in form:
-        articleidQuery = ('id:%d' % a for a in form['articleids'])
-        result.append(' OR '.join(articleidQuery))
-    if 'articlesets' in form and form['articlesets']:
-        setsQuery = ('sets:%d' % s.id for s in form['articlesets'])
-        result.append(' OR '.join(setsQuery))
-    else:
-        log.warn("PROJECTS: %s/%r" % (type(form['projects']), form['projects']))
-        projectQuery = ('projectid:%d' % p.id for p in form['projects'])
-        result.append(' OR '.join(projectQuery))
-
-
-    return result
+    return filters_from_form(form)
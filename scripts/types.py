@@ -50,11 +50,14 @@ class ImageMap(object):
         self.table = table
 
 class ArticleSetStatistics(object):
-    """ class representing some basic information of a search query: the number of articles and the first/last date of the matching articles """
-    def __init__(self, articleCount=None, firstDate=None, lastDate=None):
+    """ class representing some basic information of a search query: the number of articles, the first/last date,
+    and the (medium, count) and (interval, count) pairs of the matching articles """
+    def __init__(self, articleCount=None, firstDate=None, lastDate=None, mediums=None, intervalCounts=None):
         self.articleCount = articleCount
         self.firstDate = firstDate
         self.lastDate = lastDate
+        self.mediums = mediums
+        self.intervalCounts = intervalCounts
 
         
 class ErrorMsg(object):
@@ -62,6 +62,47 @@ class TestArticleList(amcattest.PolicyTestCase):
         self.assertEqual(self.list(projects=[p2.id]), set())
         self.assertEqual(self.list(projects=[p2.id], articlesets=[s.id]), arts)
 
+    def test_paging(self):
+        """Do page tokens give the next page, and can we get all articles?"""
+        p = amcattest.create_test_project()
+        arts = [amcattest.create_test_article(project=p, date="2000-01-%02i" % (i % 3 + 1))
+                for i in range(10)]
+        options = dict(DEFAULTS, projects=[p.id], sortColumn='date', sortOrder='desc', length=4)
+        pages, token = [], None
+        while True:
+            page = ArticleListScript(pageToken=token, **options).run()
+            pages.append(list(page))
+            token = page.nextPageToken
+            if token is None: break
+        self.assertEqual([len(page) for page in pages], [4, 4, 2])
+        expected = sorted(arts, key=lambda a: (a.date, a.id), reverse=True)
+        self.assertEqual(sum(pages, []), expected)
+        # an offset gives the same page as the token
+        self.assertEqual(list(ArticleListScript(start=4, **options).run()), pages[1])
+        # all articles are streamed
+        self.assertEqual(list(ArticleListScript(**dict(options, length=-1)).run()), expected)
+
+    def test_paging_nulls(self):
+        """Can we page on nullable columns and related ids?"""
+        p = amcattest.create_test_project()
+        arts = [amcattest.create_test_article(project=p, section=(None if i % 2 else "s%i" % (i % 3)))
+                for i in range(9)]
+        for sortOrder in 'asc', 'desc':
+            options = dict(DEFAULTS, projects=[p.id], sortColumn='section', sortOrder=sortOrder, length=2)
+            result, token = [], None
+            while True:
+                page = ArticleListScript(pageToken=token, **options).run()
+                result += list(page)
+                token = page.nextPageToken
+                if token is None: break
+            # NULLs are sorted after the other values
+            expected = sorted(arts, key=lambda a: (a.section is None, a.section, a.id),
+                              reverse=(sortOrder == 'desc'))
+            self.assertEqual(result, expected)
+        options = dict(DEFAULTS, projects=[p.id], sortColumn='medium__id', length=-1)
+        self.assertEqual(list(ArticleListScript(**options).run()),
+                         sorted(arts, key=lambda a: (a.medium_id, a.id)))
+
     def test_aggregation(self):
         """Can we create nice tables?"""
         p = amcattest.create_test_project()
@@ -0,0 +1,879 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Embedded search index with the same interface as amcatsolr.Solr
+
+The index is a directory of immutable segments. Each segment consists of a
+memory mapped file with positional postings for the text fields (headline,
+body, byline, section) and keyword fields (id, projectid, mediumid, sets),
+a memory mapped file with the stored documents, and a pickled term
+dictionary. Adding articles writes a new segment; deleting (or replacing)
+articles only changes the manifest, which records the deleted documents of
+every segment. Small segments are merged as they pile up.
+
+The query parser understands the part of the lucene syntax used in AmCAT:
+terms, wildcards, field:term, AND/OR/NOT/+/-, parentheses, ranges, and
+(complex) phrases with slop such as "een (bl* -blo)"~2. As in the AmCAT
+solr schema, the score of an article is its number of hits.
+
+This is meant for small installations and for testing: there is no support
+for faceting or highlighting. Set settings.SOLR_BACKEND to 'embedded' to use
+it instead of a solr server (see amcatsolr.get_solr).
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import re
+import mmap
+import fcntl
+import bisect
+import fnmatch
+import logging
+import tempfile
+import threading
+import cPickle as pickle
+from array import array
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+
+from solr.core import utc, utc_from_string
+from django.conf import settings
+
+from amcat.tools.toolkit import splitlist
+from amcat.tools.djangotoolkit import get_ids
+from amcat.tools.amcatsolr import Solr, SOLR_INDEX_BATCH, bump_generation, _get_article_dicts
+
+log = logging.getLogger(__name__)
+
+EMBEDDED_INDEX_PATH = getattr(settings, 'EMBEDDED_INDEX_PATH', None)
+# merge the smallest MERGE_FACTOR segments if there are more than MAX_SEGMENTS
+MAX_SEGMENTS = getattr(settings, 'EMBEDDED_INDEX_MAX_SEGMENTS', 10)
+MERGE_FACTOR = 10
+
+TEXT_FIELDS = ("headline", "body", "byline", "section")
+# text fields that are searched if a query term has no field
+DEFAULT_FIELDS = ("headline", "body")
+KEYWORD_FIELDS = ("id", "projectid", "mediumid", "sets")
+# fields that can be used for sorting and range queries
+VALUE_FIELDS = ("id", "projectid", "mediumid", "date")
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+_PATTERN = re.compile(r"[\w*?]+", re.UNICODE)
+
+def analyze(text):
+    """Split the text into lower case tokens, the unit of the positional index"""
+    if not text:
+        return []
+    return _TOKEN.findall(text.lower())
+
+def _patterns(word):
+    """Split a query word into lower case tokens, keeping wildcards"""
+    return _PATTERN.findall(word.lower())
+
+def _is_wildcard(pattern):
+    return "*" in pattern or "?" in pattern
+
+###########################################################################
+#                          S E G M E N T S                                #
+###########################################################################
+
+def _segment_file(path, name, extension):
+    return os.path.join(path, "{name}.{extension}".format(**locals()))
+
+def _mmap(filename):
+    """Memory map the file for reading (empty files cannot be mapped)"""
+    with open(filename, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _write_segment(path, name, docs):
+    """Write the (stored) documents as a new segment and return their ids"""
+    postings = defaultdict(dict) # (field, term) : {id : [positions]}
+    values = dict((field, {}) for field in VALUE_FIELDS)
+    stored = {}
+    with open(_segment_file(path, name, "docs"), "wb") as f:
+        for doc in docs:
+            aid = doc["id"]
+            for field in TEXT_FIELDS:
+                for position, term in enumerate(analyze(doc.get(field))):
+                    postings[field, term].setdefault(aid, []).append(position)
+            for field in KEYWORD_FIELDS:
+                value = doc.get(field)
+                for v in (value if isinstance(value, list) else [value]):
+                    if v is not None:
+                        postings[field, unicode(v)][aid] = [0]
+            for field in VALUE_FIELDS:
+                if doc.get(field) is not None:
+                    values[field][aid] = doc[field]
+            data = pickle.dumps(doc, pickle.HIGHEST_PROTOCOL)
+            stored[aid] = (f.tell(), len(data))
+            f.write(data)
+
+    # postings of a term are stored as a flat int array: id, n, position_1..n, id, ...
+    terms = {}
+    offset = 0
+    with open(_segment_file(path, name, "post"), "wb") as f:
+        for key in sorted(postings):
+            data = array(b"i")
+            for aid, positions in sorted(postings[key].iteritems()):
+                data.append(aid)
+                data.append(len(positions))
+                data.extend(positions)
+            terms[key] = (offset, len(data))
+            offset += len(data)
+            data.tofile(f)
+
+    with open(_segment_file(path, name, "meta"), "wb") as f:
+        pickle.dump(dict(terms=terms, docs=stored, values=values), f, pickle.HIGHEST_PROTOCOL)
+    return sorted(stored)
+
+def _remove_segment(path, name):
+    for extension in ("docs", "post", "meta"):
+        try:
+            os.remove(_segment_file(path, name, extension))
+        except OSError:
+            pass
+
+class Segment(object):
+    """Read-only view on a segment, with memory mapped postings and documents"""
+    def __init__(self, path, name):
+        self.name = name
+        with open(_segment_file(path, name, "meta"), "rb") as f:
+            meta = pickle.load(f)
+        self.terms, self.stored, self.values = meta["terms"], meta["docs"], meta["values"]
+        self.fieldterms = defaultdict(list)
+        for field, term in self.terms:
+            self.fieldterms[field].append(term)
+        for terms in self.fieldterms.values():
+            terms.sort()
+        self._postings = _mmap(_segment_file(path, name, "post"))
+        self._docs = _mmap(_segment_file(path, name, "docs"))
+        self._sorted_values = {}
+
+    def sorted_values(self, field):
+        """Return the (values, ids) lists of the field, sorted on value, for range queries"""
+        try:
+            return self._sorted_values[field]
+        except KeyError:
+            pairs = sorted((value, aid) for (aid, value) in self.values[field].iteritems())
+            result = self._sorted_values[field] = ([v for (v, _aid) in pairs], [aid for (_v, aid) in pairs])
+            return result
+
+    def postings(self, field, term):
+        """Return an {id : positions} dict for the term in the given field"""
+        try:
+            offset, length = self.terms[field, term]
+        except KeyError:
+            return {}
+        data = array(b"i")
+        data.fromstring(self._postings[offset * data.itemsize:(offset + length) * data.itemsize])
+        result, i = {}, 0
+        while i < length:
+            aid, n = data[i], data[i + 1]
+            result[aid] = data[i + 2:i + 2 + n]
+            i += n + 2
+        return result
+
+    def expand(self, field, pattern):
+        """Return the terms in the given field that match the (wildcard) pattern"""
+        if not _is_wildcard(pattern):
+            return [pattern] if (field, pattern) in self.terms else []
+        prefix = re.split(r"[*?]", pattern, 1)[0]
+        terms = self.fieldterms.get(field, [])
+        result = []
+        for i in xrange(bisect.bisect_left(terms, prefix), len(terms)):
+            if not terms[i].startswith(prefix):
+                break
+            if fnmatch.fnmatchcase(terms[i], pattern):
+                result.append(terms[i])
+        return result
+
+    def document(self, aid):
+        """Return the stored document with the given id"""
+        offset, length = self.stored[aid]
+        return pickle.loads(self._docs[offset:offset + length])
+
+###########################################################################
+#                           Q U E R I E S                                 #
+###########################################################################
+
+# Every query has an evaluate(segment) method that returns an {id : score}
+# dict of the matching documents in that segment, including deleted ones
+
+class AllQuery(object):
+    def evaluate(self, segment):
+        return dict.fromkeys(segment.stored, 0)
+
+class TermQuery(object):
+    def __init__(self, fields, pattern):
+        self.fields = fields
+        self.pattern = pattern
+
+    def evaluate(self, segment):
+        result = {}
+        for field in self.fields:
+            for term in segment.expand(field, self.pattern):
+                for aid, positions in segment.postings(field, term).iteritems():
+                    result[aid] = result.get(aid, 0) + len(positions)
+        return result
+
+def _count_ordered(positions, slop):
+    """
+    Count the start positions from which every list of positions can be
+    matched in order with at most slop positions in between
+    """
+    n = 0
+    for start in positions[0]:
+        last = start
+        for candidates in positions[1:]:
+            i = bisect.bisect_right(candidates, last)
+            if i == len(candidates):
+                return n # later start positions cannot match either
+            last = candidates[i]
+        if last - start - (len(positions) - 1) <= slop:
+            n += 1
+    return n
+
+class PhraseQuery(object):
+    """
+    A phrase is a list of (include, exclude) pattern lists, one for each
+    position. A position matches a term that matches any of the include
+    patterns and none of the exclude patterns.
+    """
+    def __init__(self, fields, elements, slop=0):
+        self.fields = fields
+        self.elements = elements
+        self.slop = slop
+
+    def evaluate(self, segment):
+        result = {}
+        if not self.elements:
+            return result
+        for field in self.fields:
+            positions = [self._positions(segment, field, include, exclude)
+                         for (include, exclude) in self.elements]
+            for aid in set(positions[0]).intersection(*positions[1:]):
+                n = _count_ordered([p[aid] for p in positions], self.slop)
+                if n:
+                    result[aid] = result.get(aid, 0) + n
+        return result
+
+    @staticmethod
+    def _positions(segment, field, include, exclude):
+        excluded = set(term for pattern in exclude for term in segment.expand(field, pattern))
+        result = defaultdict(set)
+        for pattern in include:
+            for term in segment.expand(field, pattern):
+                if term not in excluded:
+                    for aid, positions in segment.postings(field, term).iteritems():
+                        result[aid].update(positions)
+        return dict((aid, sorted(positions)) for (aid, positions) in result.iteritems())
+
+class RangeQuery(object):
+    def __init__(self, field, low, high, include_low=True, include_high=True):
+        self.field, self.low, self.high = field, low, high
+        self.include_low, self.include_high = include_low, include_high
+
+    def evaluate(self, segment):
+        values, ids = segment.sorted_values(self.field)
+        start, end = 0, len(values)
+        if self.low is not None:
+            start = (bisect.bisect_left if self.include_low else bisect.bisect_right)(values, self.low)
+        if self.high is not None:
+            end = (bisect.bisect_right if self.include_high else bisect.bisect_left)(values, self.high)
+        return dict.fromkeys(ids[start:end], 0)
+
+class BooleanQuery(object):
+    """
+    Documents must match all must queries (or at least one should query if
+    there are no must queries) and none of the must_not queries.
+    """
+    def __init__(self, should=(), must=(), must_not=()):
+        self.should, self.must, self.must_not = list(should), list(must), list(must_not)
+
+    def evaluate(self, segment):
+        if self.must:
+            result = self.must[0].evaluate(segment)
+            for query in self.must[1:]:
+                other = query.evaluate(segment)
+                result = dict((aid, score + other[aid]) for (aid, score) in result.iteritems()
+                              if aid in other)
+            for query in self.should:
+                for aid, score in query.evaluate(segment).iteritems():
+                    if aid in result:
+                        result[aid] += score
+        elif self.should:
+            result = {}
+            for query in self.should:
+                for aid, score in query.evaluate(segment).iteritems():
+                    result[aid] = result.get(aid, 0) + score
+        else:
+            result = dict.fromkeys(segment.stored, 0)
+        for query in self.must_not:
+            for aid in query.evaluate(segment):
+                result.pop(aid, None)
+        return result
+
+###########################################################################
+#                            P A R S I N G                                #
+###########################################################################
+
+_QUERY_TOKEN = re.compile(r'\s*(?:(?P<phrase>"[^"]*")(?:~(?P<slop>\d+))?'
+                          r'|(?P<range>[\[{][^\]}]*[\]}])'
+                          r'|(?P<op>[()+\-])'
+                          r'|(?P<word>[^\s()"\[\]{}]+))', re.UNICODE)
+_OPERATORS = {"&&" : "AND", "||" : "OR", "!" : "NOT"}
+_LOCAL_PARAMS = re.compile(r"\s*\{!(\w+)([^}]*)\}", re.UNICODE)
+
+def _parse_value(field, value):
+    if value == "*":
+        return None
+    if field == "date":
+        return utc_from_string(value)
+    return int(value)
+
+def _range_query(field, text):
+    if field not in VALUE_FIELDS:
+        raise ValueError("Range queries are not supported on field {field!r}".format(**locals()))
+    low, _to, high = text[1:-1].split()
+    return RangeQuery(field, _parse_value(field, low), _parse_value(field, high),
+                      include_low=text[0] == "[", include_high=text[-1] == "]")
+
+def _word_query(fields, word):
+    if fields[0] in KEYWORD_FIELDS:
+        return TermQuery(fields, word)
+    patterns = _patterns(word)
+    if len(patterns) == 1:
+        return TermQuery(fields, patterns[0])
+    # e.g. e-mail is split into two tokens that should be adjacent
+    return PhraseQuery(fields, [([p], []) for p in patterns])
+
+def _phrase_query(fields, text, slop):
+    if fields[0] in KEYWORD_FIELDS:
+        return TermQuery(fields, text[1:-1])
+    elements = []
+    for group, word in re.findall(r"\(([^)]*)\)|(\S+)", text[1:-1], re.UNICODE):
+        if group:
+            words = [w for w in group.split() if w not in ("OR", "||")]
+            include = [p for w in words if not w.startswith("-") for p in _patterns(w)]
+            exclude = [p for w in words if w.startswith("-") for p in _patterns(w[1:])]
+            elements.append((include, exclude))
+        else:
+            elements += [([p], []) for p in _patterns(word)]
+    return PhraseQuery(fields, elements, int(slop or 0))
+
+class QueryParser(object):
+    """Parse a (lucene syntax) query string into a query object"""
+    def __init__(self, query):
+        self.tokens = []
+        position = 0
+        query = query.strip()
+        while position < len(query):
+            m = _QUERY_TOKEN.match(query, position)
+            if not m or m.end() == position:
+                raise ValueError("Cannot parse query {query!r}".format(**locals()))
+            kind = m.lastgroup if m.lastgroup != "slop" else "phrase"
+            value = m.group(kind)
+            if kind == "word":
+                value = _OPERATORS.get(value, value)
+            self.tokens.append((kind, value, m.group("slop")))
+            position = m.end()
+        self.tokens.reverse()
+
+    def _peek(self):
+        return self.tokens[-1][1] if self.tokens else None
+
+    def _next(self):
+        if not self.tokens:
+            raise ValueError("Unexpected end of query")
+        return self.tokens.pop()
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError("Empty query")
+        query = self._parse_boolean()
+        if self.tokens:
+            raise ValueError("Unbalanced parentheses in query")
+        return query
+
+    def _parse_boolean(self, fields=None):
+        should, must, must_not = [], [], []
+        while self._peek() not in (None, ")"):
+            if self._peek() == "OR":
+                self._next()
+                continue
+            group = [self._parse_clause(fields)]
+            while self._peek() == "AND":
+                self._next()
+                group.append(self._parse_clause(fields))
+            if len(group) == 1:
+                occur, query = group[0]
+                {"+" : must, "-" : must_not, None : should}[occur].append(query)
+            else:
+                should.append(BooleanQuery(must=[q for (occur, q) in group if occur != "-"],
+                                           must_not=[q for (occur, q) in group if occur == "-"]))
+        if len(should) == 1 and not (must or must_not):
+            return should[0]
+        return BooleanQuery(should, must, must_not)
+
+    def _parse_clause(self, fields):
+        occur = None
+        if self._peek() in ("+", "-", "NOT"):
+            occur = "+" if self._next()[1] == "+" else "-"
+        return occur, self._parse_primary(fields)
+
+    def _parse_primary(self, fields):
+        kind, value, slop = self._next()
+        if kind == "op" and value == "(":
+            query = self._parse_boolean(fields)
+            if self._next()[1] != ")":
+                raise ValueError("Unbalanced parentheses in query")
+            return query
+        if kind == "phrase":
+            return _phrase_query(fields or DEFAULT_FIELDS, value, slop)
+        if kind == "range":
+            if not fields:
+                raise ValueError("Range query {value!r} needs a field".format(**locals()))
+            return _range_query(fields[0], value)
+        if kind == "word":
+            if value == "*:*":
+                return AllQuery()
+            field, colon, rest = value.partition(":")
+            if colon and (field in TEXT_FIELDS or field in KEYWORD_FIELDS or field == "date"):
+                if not rest:
+                    return self._parse_primary((field,))
+                if field == "date":
+                    return RangeQuery(field, _parse_value(field, rest), _parse_value(field, rest))
+                value, fields = rest, (field,)
+            return _word_query(fields or DEFAULT_FIELDS, value)
+        raise ValueError("Unexpected {value!r} in query".format(**locals()))
+
+def parse_query(query):
+    """Parse a lucene syntax query, including {!terms f=field}a,b,c queries"""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8")
+    m = _LOCAL_PARAMS.match(query)
+    if m:
+        params = dict(p.split("=", 1) for p in m.group(2).split() if "=" in p)
+        query = query[m.end():]
+        if m.group(1) == "terms":
+            return BooleanQuery(should=[TermQuery((params["f"],), v.strip())
+                                        for v in query.split(",") if v.strip()])
+    return QueryParser(query).parse()
+
+###########################################################################
+#                              I N D E X                                  #
+###########################################################################
+
+class Response(object):
+    """Search results, with the same attributes as a solr Response"""
+    def __init__(self, results, numFound, start, maxScore=None):
+        self.results, self.numFound, self.start, self.maxScore = results, numFound, start, maxScore
+        self.highlighting = self.facet_counts = self.stats = None
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+def _parse_sort(sort):
+    if not sort:
+        return [("score", "desc")]
+    return [tuple(clause.split()) for clause in sort.split(",")]
+
+def _parse_fields(fields, score):
+    """Return the (fields, score) to return, fields is None for all fields"""
+    if isinstance(fields, basestring):
+        fields = fields.split(",")
+    if fields is not None:
+        fields = [f.strip() for f in fields]
+        score = score or "score" in fields
+        if "*" in fields:
+            fields = None
+    return fields, score
+
+def _result(segment, aid, s, fields, score):
+    doc = segment.document(aid)
+    if fields is not None:
+        doc = dict((f, doc[f]) for f in fields if f in doc)
+    if score:
+        doc["score"] = s
+    return doc
+
+class Index(object):
+    """
+    An index stored in the given directory. Indexes can be read and written
+    from multiple threads and processes: writes are serialized using a lock
+    file, and readers pick up changes through the (atomically replaced) manifest.
+
+    The manifest lists the segments and, per segment, the ids of the documents
+    that were deleted or replaced by a newer version, so its size does not
+    depend on the number of documents. Readers open the segments listed in the
+    manifest while holding a shared lock, which the writer needs exclusively
+    to replace the manifest and remove old segments: once a segment is opened
+    (memory mapped) it stays readable after its files are removed.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        self._manifest_key = None
+        self._manifest = dict(segments=[], deleted={}, counter=0)
+        self._segments = {}
+
+    @property
+    def _manifest_file(self):
+        return os.path.join(self.path, "manifest")
+
+    @contextmanager
+    def _file_lock(self, name, operation):
+        with open(os.path.join(self.path, name), "a") as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_manifest(self):
+        if not os.path.exists(self._manifest_file):
+            return dict(segments=[], deleted={}, counter=0)
+        with open(self._manifest_file, "rb") as f:
+            return pickle.load(f)
+
+    def _write_manifest(self, manifest):
+        fd, filename = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(manifest, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(filename, self._manifest_file)
+
+    def _segment(self, name):
+        """Return the (cached) segment with the given name, call with self._lock held"""
+        segment = self._segments.get(name)
+        if segment is None:
+            segment = self._segments[name] = Segment(self.path, name)
+        return segment
+
+    def reader(self):
+        """Return the current (manifest, {name : segment}) pair, reopening the index if needed"""
+        with self._lock, self._file_lock("read.lock", fcntl.LOCK_SH):
+            try:
+                stat = os.stat(self._manifest_file)
+            except OSError:
+                return self._manifest, {}
+            key = (stat.st_ino, stat.st_mtime, stat.st_size)
+            if key != self._manifest_key:
+                self._manifest = self._read_manifest()
+                self._manifest_key = key
+            segments = dict((name, self._segment(name)) for name in self._manifest["segments"])
+            return self._manifest, segments
+
+    #### WRITING ####
+
+    @contextmanager
+    def _update(self):
+        """Lock the index and yield the manifest, which is saved afterwards"""
+        with self._write_lock():
+            manifest = self._read_manifest()
+            old_segments = set(manifest["segments"])
+            yield manifest
+            # drop segments that no longer contain live documents
+            manifest["segments"] = [name for name in manifest["segments"] if self._live(manifest, name)]
+            obsolete = (old_segments | set(self._created)) - set(manifest["segments"])
+            for name in obsolete:
+                manifest["deleted"].pop(name, None)
+            with self._file_lock("read.lock", fcntl.LOCK_EX):
+                self._write_manifest(manifest)
+                for name in obsolete:
+                    _remove_segment(self.path, name)
+            with self._lock:
+                for name in obsolete:
+                    self._segments.pop(name, None)
+
+    @contextmanager
+    def _write_lock(self):
+        with self._file_lock("write.lock", fcntl.LOCK_EX):
+            self._created = []
+            yield
+
+    def _open(self, name):
+        with self._lock:
+            return self._segment(name)
+
+    def _live(self, manifest, name):
+        """Return the number of live documents in the segment"""
+        return len(self._open(name).stored) - len(manifest["deleted"].get(name, ()))
+
+    def _delete(self, manifest, ids):
+        """Mark the documents with the given ids as deleted in the segments that contain them"""
+        for name in manifest["segments"]:
+            stored = self._open(name).stored
+            deleted = [aid for aid in ids if aid in stored]
+            if deleted:
+                manifest["deleted"].setdefault(name, set()).update(deleted)
+
+    def _new_segment(self, manifest, docs):
+        name = "segment{:08d}".format(manifest["counter"])
+        manifest["counter"] += 1
+        self._created.append(name)
+        _write_segment(self.path, name, docs)
+        manifest["segments"].append(name)
+
+    def _merge(self, manifest, names):
+        """Replace the given segments by a single segment with their live documents"""
+        def docs():
+            for name in names:
+                segment, deleted = self._open(name), manifest["deleted"].get(name, ())
+                for aid in sorted(segment.stored):
+                    if aid not in deleted:
+                        yield segment.document(aid)
+        log.debug("Merging {n} segments".format(n=len(names)))
+        self._new_segment(manifest, docs())
+        manifest["segments"] = [name for name in manifest["segments"] if name not in names]
+
+    def add(self, docs):
+        """Add or replace the given documents, which should be dicts including an id"""
+        docs = dict((doc["id"], doc) for doc in docs)
+        if not docs:
+            return
+        with self._update() as manifest:
+            self._delete(manifest, docs)
+            self._new_segment(manifest, (docs[aid] for aid in sorted(docs)))
+            if len(manifest["segments"]) > MAX_SEGMENTS:
+                segments = sorted(manifest["segments"], key=lambda name: self._live(manifest, name))
+                self._merge(manifest, segments[:MERGE_FACTOR])
+
+    def delete(self, ids):
+        ids = set(ids)
+        if not ids:
+            return
+        with self._update() as manifest:
+            self._delete(manifest, ids)
+
+    def optimize(self):
+        """Merge all segments into a single segment"""
+        with self._update() as manifest:
+            if len(manifest["segments"]) > 1 or manifest["deleted"]:
+                self._merge(manifest, list(manifest["segments"]))
+
+    #### SEARCHING ####
+
+    def _matches(self, query, filters):
+        """Return an {id : (segment, score)} dict of the live documents matching the query and filters"""
+        manifest, segments = self.reader()
+        query = parse_query(query)
+        filters = [parse_query(f) for f in filters or ()]
+        matches = {}
+        for name in manifest["segments"]:
+            segment, deleted = segments[name], manifest["deleted"].get(name, ())
+            hits = query.evaluate(segment)
+            for f in filters:
+                allowed = f.evaluate(segment)
+                hits = dict((aid, s) for (aid, s) in hits.iteritems() if aid in allowed)
+            for aid, s in hits.iteritems():
+                if aid not in deleted:
+                    matches[aid] = (segment, float(s))
+        return matches
+
+    def search(self, query, filters=(), fields=None, score=True, sort=None, start=0, rows=10):
+        """
+        Search the index, returning a Response with the requested page of results.
+        Results are sorted on score (descending) by default, and then on id.
+        """
+        matches = self._matches(query, filters)
+        ordered = sorted(matches)
+        for field, order in reversed(_parse_sort(sort)):
+            if field == "score":
+                key = lambda aid: matches[aid][1]
+            else:
+                key = lambda aid: matches[aid][0].values[field].get(aid)
+            ordered.sort(key=key, reverse=(order == "desc"))
+
+        fields, score = _parse_fields(fields, score)
+        results = [_result(matches[aid][0], aid, matches[aid][1], fields, score)
+                   for aid in ordered[start:start + rows]]
+        maxScore = max(s for (_segment, s) in matches.itervalues()) if matches else None
+        return Response(results, len(matches), start, maxScore)
+
+    def search_all(self, query, filters=(), fields=None, score=True):
+        """Lazily yield all results of the query in id order, evaluating the query only once"""
+        matches = self._matches(query, filters)
+        fields, score = _parse_fields(fields, score)
+        for aid in sorted(matches):
+            segment, s = matches[aid]
+            yield _result(segment, aid, s, fields, score)
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_index(path):
+    """Return the (shared) Index for the given directory"""
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = Index(path)
+        return _indexes[path]
+
+def _stored_document(article_dict):
+    """Create the document to store from a dict created by amcatsolr._get_article_dicts"""
+    doc = dict((k, v) for (k, v) in article_dict.iteritems() if v is not None)
+    if "date" in doc:
+        doc["date"] = doc["date"].astimezone(utc)
+    if "sets" in doc:
+        doc["sets"] = sorted(doc["sets"])
+    return doc
+
+class EmbeddedConnection(object):
+    """
+    Stand-in for a (solrpy) solr connection that works on an embedded index,
+    for code that uses Solr.connection() directly. Changes are visible
+    immediately, so commit_within is ignored.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def query(self, q, fq=(), fields=None, score=True, sort=None, start=0, rows=10, **kargs):
+        return self.index.search(q, fq, fields=fields, score=score, sort=sort,
+                                 start=int(start), rows=int(rows))
+
+    def add_many(self, docs, _commit=False, commit_within=None):
+        self.index.add(_stored_document(d) for d in docs)
+
+    def delete_many(self, ids, commit_within=None):
+        self.index.delete(ids)
+
+    def commit(self):
+        pass
+
+    def optimize(self):
+        self.index.optimize()
+
+    def close(self):
+        pass
+
+class EmbeddedSolr(Solr):
+    """
+    Replacement for amcatsolr.Solr that uses an embedded index stored in the
+    given directory (or settings.EMBEDDED_INDEX_PATH) rather than a solr server.
+    Use amcatsolr.get_solr() with settings.SOLR_BACKEND = 'embedded' to select it.
+    Only the query options fields, score, sort, start and rows are supported.
+    """
+    def __init__(self, path=None):
+        path = path or EMBEDDED_INDEX_PATH
+        if not path:
+            raise ValueError("No index path given and settings.EMBEDDED_INDEX_PATH not set")
+        self.path = os.path.abspath(path)
+        self.index = get_index(self.path)
+
+    @property
+    def url(self):
+        return b"file://" + self.path.encode("utf-8")
+
+    @contextmanager
+    def connection(self):
+        yield EmbeddedConnection(self.index)
+
+    def query_all(self, query, batch=1000, filters=[], fields=None, **kargs):
+        """Like Solr.query_all, but the query is evaluated once instead of once per batch"""
+        if 'sort' in kargs or 'start' in kargs:
+            raise ValueError("query_all iterates in id order and cannot sort or skip")
+        for row in self.index.search_all(query, filters, fields=fields, score=kargs.get("score", True)):
+            if 'score' in row:
+                row['score'] = int(row['score'])
+            yield row
+
+    def add_articles(self, articles, batch=SOLR_INDEX_BATCH, commit=True, commit_within=None):
+        """
+        Add the given articles to the index. Every batch is written as a new
+        segment and is searchable immediately, so commit and commit_within are ignored.
+        """
+        if hasattr(articles, "values_list"):
+            articles = articles.values_list("id", flat=True)
+        article_ids = sorted(set(get_ids(articles)))
+        for ids in splitlist(article_ids, batch):
+            self.index.add(_stored_document(d) for d in _get_article_dicts(ids))
+        bump_generation(self.url)
+
+    def delete_articles(self, articles, commit=True, commit_within=None):
+        """Remove the given articles from the index, the removal is visible immediately"""
+        self.index.delete(get_ids(articles))
+        bump_generation(self.url)
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+import shutil
+
+class TestAmcatIndex(amcattest.PolicyTestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_parse(self):
+        """Are (complex) phrases and boolean operators parsed correctly?"""
+        q = parse_query('"een (bl* -blo)"~2')
+        self.assertEqual(q.elements, [(["een"], []), (["bl*"], ["blo"])])
+        self.assertEqual(q.slop, 2)
+        q = parse_query('test AND -mediumid:3')
+        self.assertEqual(len(q.must), 1)
+        self.assertEqual(len(q.must_not), 1)
+        self.assertEqual(parse_query("id:[10 TO *]").low, 10)
+        self.assertEqual(len(parse_query("{!terms f=id}1,2,3").should), 3)
+        self.assertRaises(ValueError, parse_query, "(test")
+
+    def test_index(self):
+        """Are replaced and deleted documents tracked per segment, and do range filters work?"""
+        index = Index(self.path)
+        index.add([dict(id=i, headline="test %i" % i, projectid=i % 2) for i in range(1, 21)])
+        index.add([dict(id=5, headline="replaced"), dict(id=25, headline="test 25")])
+        index.delete([6, 7])
+        manifest = index._read_manifest()
+        self.assertEqual(manifest["deleted"], {"segment00000000" : set([5, 6, 7])})
+        self.assertEqual(index.search("test").numFound, 18)
+        self.assertEqual(index.search("replaced").results, [dict(id=5, headline="replaced", score=1.0)])
+        self.assertEqual([r["id"] for r in index.search_all("test", filters=["id:[10 TO *]", "projectid:1"])],
+                         [11, 13, 15, 17, 19])
+        self.assertEqual(index.search("id:{10 TO 13]", rows=100, sort="id asc").numFound, 3)
+
+        # optimizing removes the deleted documents and the old segments
+        index.optimize()
+        manifest = index._read_manifest()
+        self.assertEqual((len(manifest["segments"]), manifest["deleted"]), (1, {}))
+        self.assertEqual(sorted(f for f in os.listdir(self.path) if f.startswith("segment")),
+                         ["segment00000002.%s" % e for e in ("docs", "meta", "post")])
+        self.assertEqual(Index(self.path).search("test").numFound, 18)
+
+    def test_connection(self):
+        """Does code that uses the solr connection work on the embedded index?"""
+        solr = EmbeddedSolr(self.path)
+        a = amcattest.create_test_article(text="een test")
+        with solr.connection() as conn:
+            conn.add_many(_get_article_dicts([a.id]))
+        solr.commit(optimize=True)
+        self.assertEqual(list(solr.query_ids("test")), [a.id])
+        solr.delete_articles([a])
+        self.assertEqual(list(solr.query_ids("test")), [])
@@ -23,15 +23,212 @@ from __future__ import unicode_literals, print_function, absolute_import
 import logging
 import re
 import datetime
+import os
+import time
+import threading
+import hashlib
+import cPickle as pickle
+from contextlib import contextmanager
 
 import solr
+from django.conf import settings
+from django.core.cache import cache
 
-from amcat.tools.toolkit import multidict
+from amcat.tools.toolkit import multidict, splitlist
 from amcat.tools.djangotoolkit import get_ids
 from amcat.models import Article, ArticleSetArticle
 
 log = logging.getLogger(__name__)
 
+# 'solr' to use a solr server, or 'embedded' for the embedded index (see tools.amcatindex)
+SOLR_BACKEND = getattr(settings, 'SOLR_BACKEND', 'solr')
+SOLR_HOST = getattr(settings, 'SOLR_HOST', 'localhost')
+# (major, minor) version of the solr server, used to decide which features can be used
+SOLR_VERSION = tuple(getattr(settings, 'SOLR_VERSION', (3, 6)))
+SOLR_PORT = getattr(settings, 'SOLR_PORT', 8983)
+SOLR_POOL_SIZE = getattr(settings, 'SOLR_POOL_SIZE', 4)
+SOLR_TIMEOUT = getattr(settings, 'SOLR_TIMEOUT', None)
+# number of articles sent to solr per request when indexing
+SOLR_INDEX_BATCH = getattr(settings, 'SOLR_INDEX_BATCH', 1000)
+# max. number of ms before solr commits added documents if no explicit commit is done
+SOLR_COMMIT_WITHIN = getattr(settings, 'SOLR_COMMIT_WITHIN', 10000)
+SOLR_CACHE_SECONDS = getattr(settings, 'SOLR_CACHE_SECONDS', 3600)
+# memcached refuses values over 1MB, and large results are not worth keeping anyway
+SOLR_CACHE_MAX_ENTRY_SIZE = getattr(settings, 'SOLR_CACHE_MAX_ENTRY_SIZE', 1024 * 1024)
+
+###########################################################################
+#                     C O N N E C T I O N   P O O L                       #
+###########################################################################
+
+class AmcatSolrConnection(solr.SolrConnection):
+    """SolrConnection that can ask solr to commit updates within a given time"""
+    _commit_within = None
+
+    def add_many(self, docs, _commit=False, commit_within=None):
+        """
+        Add the docs (see SolrConnection.add_many). If commit_within is given,
+        solr will make the documents visible within that many milliseconds.
+        """
+        self._commit_within = commit_within
+        try:
+            return solr.SolrConnection.add_many(self, docs, _commit)
+        finally:
+            self._commit_within = None
+
+    def delete_many(self, ids, commit_within=None):
+        """
+        Delete the docs with the given ids. If commit_within is given, solr
+        will commit the deletion within that many milliseconds.
+        """
+        self._commit_within = commit_within
+        try:
+            return solr.SolrConnection.delete_many(self, ids)
+        finally:
+            self._commit_within = None
+
+    def _update(self, request, query=None):
+        if self._commit_within is not None:
+            query = dict(query or {}, commitWithin=str(self._commit_within))
+        return solr.SolrConnection._update(self, request, query)
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent (keep-alive) connections to a solr server.
+    At most `size` connections are in use at the same time, callers wait for
+    a connection to be returned to the pool if all are in use.
+    """
+    def __init__(self, url, size=SOLR_POOL_SIZE, timeout=SOLR_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(size)
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return AmcatSolrConnection(self.url, persistent=True, timeout=self.timeout)
+
+    def _checkin(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that lends a connection from the pool"""
+        self._available.acquire()
+        conn = self._checkout()
+        try:
+            yield conn
+        except:
+            # the http connection might be in an undefined state, so close the
+            # socket. httplib will reconnect when the connection is used again
+            conn.close()
+            raise
+        finally:
+            self._checkin(conn)
+            self._available.release()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = None
+
+def get_pool(url):
+    """Get the connection pool for the given solr url, shared by all threads in this process"""
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # don't share sockets with the parent of a forked process
+            _pools.clear()
+            _pools_pid = os.getpid()
+        try:
+            return _pools[url]
+        except KeyError:
+            pool = _pools[url] = ConnectionPool(url)
+            return pool
+
+###########################################################################
+#                          Q U E R Y   C A C H E                          #
+###########################################################################
+
+# Query results are cached under a key that includes the index generation.
+# Changing the index increments the generation, making all older entries
+# unreachable; these are then evicted by the (LRU) django cache backend.
+# A generation that is not (or no longer) in the cache restarts from the
+# current time in ms, so it can never return to an old generation.
+GENERATION_KEY = "amcat_solr_generation_{url}"
+GENERATION_SECONDS = 30 * 24 * 3600
+QUERY_CACHE_KEY = "amcat_solr_query_{generation}_{digest}"
+# Changes sent with commitWithin are not visible until solr commits them.
+# Results are not cached until then, as they might not include the changes.
+PENDING_KEY = "amcat_solr_pending_{url}"
+# extra seconds to wait for queries that started before the commit
+PENDING_MARGIN = 2
+
+def _new_generation():
+    return int(time.time() * 1000)
+
+def get_generation(url):
+    """Get the current generation of the index at the given url"""
+    key = GENERATION_KEY.format(url=url)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, _new_generation(), GENERATION_SECONDS)
+        generation = cache.get(key)
+    return generation
+
+def bump_generation(url):
+    """Increment the generation of the index, invalidating all cached results"""
+    key = GENERATION_KEY.format(url=url)
+    try:
+        return cache.incr(key)
+    except ValueError: # key did not exist (anymore)
+        generation = _new_generation()
+        cache.set(key, generation, GENERATION_SECONDS)
+        return generation
+
+def set_commit_pending(url, commit_within):
+    """Record that changes to the index will be committed within commit_within ms"""
+    seconds = commit_within / 1000. + PENDING_MARGIN
+    cache.set(PENDING_KEY.format(url=url), time.time() + seconds, int(seconds) + 1)
+
+def commit_pending(url):
+    """Are there changes to the index that might not be visible yet?"""
+    until = cache.get(PENDING_KEY.format(url=url))
+    return until is not None and until > time.time()
+
+def _query_cache_key(url, query, filters, kargs):
+    """Create a cache key from the normalised query arguments"""
+    kargs = dict(kargs)
+    fields = kargs.get("fields")
+    if fields and not isinstance(fields, basestring):
+        kargs["fields"] = ",".join(fields)
+    normalised = (url, query.strip(), sorted(f.strip() for f in filters), sorted(kargs.items()))
+    digest = hashlib.md5(repr(normalised).encode("utf-8")).hexdigest()
+    return QUERY_CACHE_KEY.format(generation=get_generation(url), digest=digest)
+
+class CachedResponse(object):
+    """Picklable copy of the relevant parts of a solr Response"""
+    def __init__(self, response):
+        self.numFound = response.numFound
+        self.start = response.start
+        self.results = list(response.results)
+        for attr in ("highlighting", "facet_counts", "stats", "maxScore"):
+            setattr(self, attr, getattr(response, attr, None))
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
 
 
 class Query(object):
@@ -44,34 +241,76 @@ class Query(object):
 
 class Solr(object):
     """Object oriented and AmCAT aware wrapper around the solr module"""
-    def __init__(self, port=8983, host="localhost"):
-        self.port = port
-        self.host = host
+    def __init__(self, port=None, host=None):
+        self.port = SOLR_PORT if port is None else port
+        self.host = SOLR_HOST if host is None else host
 
     @property
     def url(self):
         return b'http://{self.host}:{self.port}/solr'.format(**locals())
         
-    def _connect(self):
-        return solr.SolrConnection(self.url)
+    def connection(self):
+        """Context manager that lends a pooled connection to this solr server"""
+        return get_pool(self.url).connection()
 
     #### QUERYING ####
 
-    def query_all(self, query, batch=1000, filters=[], **kargs):
-        """Make repeated calls to solr to get all articles"""
-        response = self._connect().query(query, fq=filters, rows=batch, **kargs)
-        while response.results:
-            log.debug("Iterating over all results, n={response.numFound}, "
-                      "start={response.start}, |response.results|={n}"
-                  .format(n=len(response.results), **locals()))
+    def query_all(self, query, batch=1000, filters=[], fields=None, **kargs):
+        """
+        Lazily iterate over all results of the query, retrieving them in batches.
+
+        Rather than paging with start/rows, which gets slower for every batch as
+        Solr has to collect and skip all earlier results, this sorts on id and
+        asks for the ids after the last id seen, so every batch costs the same.
+        As a consequence, results are yielded in id order.
+
+        @param fields: the fields to retrieve (id is always included)
+        """
+        if 'sort' in kargs or 'start' in kargs:
+            raise ValueError("query_all iterates in id order and cannot sort or skip")
+        if fields is not None:
+            if isinstance(fields, basestring):
+                fields = fields.split(",")
+            fields = ["id"] + [f for f in fields if f != "id"]
+        last_id = None
+        while True:
+            page_filters = list(filters)
+            if last_id is not None:
+                # (Solr 3.x does not allow mixed inclusive/exclusive ranges)
+                page_filters.append("id:[{} TO *]".format(last_id + 1))
+            response = self.query(query, filters=page_filters, fields=fields,
+                                  rows=batch, sort="id asc", **kargs)
+            log.debug("Iterating over all results, n={response.numFound}, after id {last_id}, "
+                      "|response.results|={n}".format(n=len(response.results), **locals()))
             for row in response.results:
                 if 'score' in row:
                     row['score']  = int(row['score'])
                 yield row
-            response = response.next_batch()
+            if len(response.results) < batch:
+                break
+            last_id = response.results[-1]["id"]
 
     def query(self, query, filters=[], **kargs):
-        return self._connect().query(query, fq=filters, **kargs)
+        with self.connection() as conn:
+            return conn.query(query, fq=filters, **kargs)
+
+    def cached_query(self, query, filters=[], **kargs):
+        """
+        Like query, but return a (cached) CachedResponse. The cached results are
+        invalidated whenever articles are added or removed through this module.
+        While changes are waiting for a (commitWithin) commit, results are not
+        cached.
+        """
+        key = _query_cache_key(self.url, query, filters, kargs)
+        response = cache.get(key)
+        if response is None:
+            response = CachedResponse(self.query(query, filters, **kargs))
+            if commit_pending(self.url):
+                return response
+            pickled = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+            if len(pickled) <= SOLR_CACHE_MAX_ENTRY_SIZE:
+                cache.set(key, response, SOLR_CACHE_SECONDS)
+        return response
 
     def query_ids(self, query, filters=[], **kargs):
         """Return a sequence of article ids for the given query"""
@@ -95,20 +334,77 @@ class Solr(object):
             
     #### ADDING / REMOVING ARICLES ####
 
-    def add_articles(self, articles):
-        """Add the given articles to the solr index"""
-        dicts = list(_get_article_dicts(list(get_ids(articles))))
-        log.debug("Adding %i articles to solr" % len(dicts))
-        conn = self._connect()
-        conn.add_many(dicts)
-        conn.commit()
-
-    def delete_articles(self, articles):
+    def add_articles(self, articles, batch=SOLR_INDEX_BATCH, commit=True,
+                     commit_within=SOLR_COMMIT_WITHIN):
+        """
+        Add the given articles to the solr index.
+
+        The articles are read from the database and sent to solr in id-ordered
+        batches, so memory use does not depend on the number of articles.
+        If commit is True, a single commit is done after the last batch.
+        Otherwise, solr is asked to commit within commit_within milliseconds,
+        which is much cheaper if add_articles is called frequently. If commit
+        is False and commit_within is None, the caller has to commit.
+
+        @param articles: a sequence of articles or article ids, or a queryset
+        """
+        if hasattr(articles, "values_list"):
+            articles = articles.values_list("id", flat=True)
+        article_ids = sorted(set(get_ids(articles)))
+        log.debug("Adding {n} articles to solr".format(n=len(article_ids)))
+        start = time.time()
+        with self.connection() as conn:
+            for i, ids in enumerate(splitlist(article_ids, batch)):
+                conn.add_many(_get_article_dicts(ids),
+                              commit_within=None if commit else commit_within)
+                done = min((i + 1) * batch, len(article_ids))
+                log.debug("Added {done}/{n} articles, {rate:.1f} docs/sec".format(
+                        n=len(article_ids), rate=done / (time.time() - start), **locals()))
+            if commit:
+                conn.commit()
+        if not commit and commit_within is not None:
+            set_commit_pending(self.url, commit_within)
+        bump_generation(self.url)
+        if article_ids:
+            log.info("Added {n} articles to solr in {t:.1f} seconds ({rate:.1f} docs/sec)".format(
+                    n=len(article_ids), t=time.time() - start,
+                    rate=len(article_ids) / (time.time() - start)))
+
+    def commit(self, optimize=False):
+        """Commit pending changes to the index, optionally optimizing it as well"""
+        with self.connection() as conn:
+            if optimize:
+                conn.optimize()
+            else:
+                conn.commit()
+        bump_generation(self.url)
+
+    def delete_articles(self, articles, commit=True, commit_within=SOLR_COMMIT_WITHIN):
+        """
+        Remove the given articles (or article ids) from the solr index. As with
+        add_articles, if commit is False solr commits within commit_within ms.
+        """
         article_ids = list(get_ids(articles))
+        if not article_ids:
+            return
         log.debug("Removing {n} articles from solr".format(n=len(article_ids)))
-        conn = self._connect()
-        conn.delete_many(article_ids)
-        conn.commit()
+        with self.connection() as conn:
+            conn.delete_many(article_ids, commit_within=None if commit else commit_within)
+            if commit:
+                conn.commit()
+        if not commit and commit_within is not None:
+            set_commit_pending(self.url, commit_within)
+        bump_generation(self.url)
+
+def get_solr():
+    """Return a Solr object for the backend configured in settings.SOLR_BACKEND"""
+    if SOLR_BACKEND == 'embedded':
+        # lazy import, as amcatindex imports this module
+        from amcat.tools.amcatindex import EmbeddedSolr
+        return EmbeddedSolr()
+    if SOLR_BACKEND != 'solr':
+        raise ValueError("Unknown SOLR_BACKEND: %r" % SOLR_BACKEND)
+    return Solr()
 
 def parseSolrHighlightingToArticles(solrResponse):
     scoresDict = dict((x['id'], int(x['score'])) for x in solrResponse.results)
@@ -139,24 +435,57 @@ def _highlight_get_context(snippet):
 def _clean(text):
     if text: return re.sub('[\x00-\x08\x0B\x0C\x0E-\x1F]', ' ', text)
         
+class GMT1(datetime.tzinfo):
+    def utcoffset(self, dt): return datetime.timedelta(hours=1)
+    def tzname(self, dt): return "GMT +1"
+    def dst(self, dt): return datetime.timedelta(0)
+
+ARTICLE_DICT_FIELDS = ("id", "headline", "text", "byline", "section",
+                       "project_id", "medium_id", "date")
+
 def _get_article_dicts(article_ids):
-    """Yield dicts suitable for uploading to Solr from article IDs"""
-    class GMT1(datetime.tzinfo):
-        def utcoffset(self, dt): return datetime.timedelta(hours=1)
-        def tzname(self, dt): return "GMT +1"
-        def dst(self, dt): return datetime.timedelta(0)
-    sets = multidict((aa.article_id, aa.articleset_id)
-                     for aa in ArticleSetArticle.objects.filter(article__in=article_ids))
-    for a in Article.objects.filter(pk__in=article_ids):
-        yield dict(id=a.id,
-                   headline=_clean(a.headline),
-                   body=_clean(a.text),
-                   byline=_clean(a.byline),
-                   section=_clean(a.section),
-                   projectid=a.project_id,
-                   mediumid=a.medium_id,
-                   date=a.date.replace(tzinfo=GMT1()),
-                   sets=sets.get(a.id))
+    """Yield dicts suitable for uploading to Solr from article IDs, in id order"""
+    article_ids = list(get_ids(article_ids))
+    sets = multidict(ArticleSetArticle.objects.filter(article__in=article_ids)
+                     .values_list("article_id", "articleset_id"))
+    articles = (Article.objects.filter(pk__in=article_ids).order_by("id")
+                .values_list(*ARTICLE_DICT_FIELDS).iterator())
+    for (aid, headline, text, byline, section, projectid, mediumid, date) in articles:
+        yield dict(id=aid,
+                   headline=_clean(headline),
+                   body=_clean(text),
+                   byline=_clean(byline),
+                   section=_clean(section),
+                   projectid=projectid,
+                   mediumid=mediumid,
+                   date=date.replace(tzinfo=GMT1()),
+                   sets=sets.get(aid))
+
+# solr refuses boolean queries with more than maxBooleanClauses (default 1024) clauses
+MAX_BOOLEAN_CLAUSES = getattr(settings, 'SOLR_MAX_BOOLEAN_CLAUSES', 1024)
+
+def terms_filter(field, values):
+    """
+    Create a filter query that matches documents with any of the (integer)
+    values in the given field, or None if there are no values. The values are
+    sorted and deduplicated, so the same selection always gives the same filter
+    and solr's filterCache is hit. Solr 4.10+ uses the compact terms query
+    parser, which skips query parsing and scoring; older versions get
+    field:(a OR b OR ..) clauses of at most MAX_BOOLEAN_CLAUSES values each.
+    """
+    values = sorted(set(int(v) for v in values))
+    if not values:
+        return None
+    if SOLR_VERSION >= (4, 10):
+        return "{!terms f=%s}%s" % (field, ",".join(str(v) for v in values))
+    if len(values) == 1:
+        return "%s:%i" % (field, values[0])
+    clauses = ["%s:(%s)" % (field, " OR ".join(str(v) for v in chunk))
+               for chunk in splitlist(values, MAX_BOOLEAN_CLAUSES)]
+    if len(clauses) > MAX_BOOLEAN_CLAUSES:
+        raise ValueError("Cannot filter on more than {n} values of {field}"
+                         .format(n=MAX_BOOLEAN_CLAUSES ** 2, **locals()))
+    return " OR ".join(clauses)
 
 def filters_from_form(form):
     """takes a form as input and ceate filter queries for start/end date, mediumid and set """
@@ -167,18 +496,15 @@ def filters_from_form(form):
     if startDateTime != '*' or endDateTime != '*': # if at least one of the 2 is a date
         filters.append('date:[%s TO %s]' % (startDateTime, endDateTime))
     if form.get('mediums'):
-        mediumidQuery = ('mediumid:%d' % m.id for m in form['mediums'])
-        filters.append(' OR '.join(mediumidQuery))
+        filters.append(terms_filter("mediumid", get_ids(form['mediums'])))
     if form.get('articleids'):
-        articleidQuery = ('id:%d' % a for a in form['articleids'])
-        filters.append(' OR '.join(articleidQuery))
+        filters.append(terms_filter("id", form['articleids']))
     if form.get('articlesets'):
-        setsQuery = ('sets:%d' % s.id for s in form['articlesets'])
-        filters.append(' OR '.join(setsQuery))
+        filters.append(terms_filter("sets", get_ids(form['articlesets'])))
     else:
-        projectQuery = ('projectid:%d' % p.id for p in form['projects'])
-        filters.append(' OR '.join(projectQuery))
-    return filters
+        filters.append(terms_filter("projectid", get_ids(form['projects'] or [])))
+    # filters for empty selections are None
+    return [f for f in filters if f is not None]
 
 def query_args_from_form(form):
     """ takes a form as input and return a dict of filter, start, and rows arguments for query"""
@@ -194,8 +520,9 @@ from amcat.tools import amcattest
 
 import tempfile
 import os.path
+import shutil
 import subprocess
-from contextlib import contextmanager
+import unittest
 
 class TestSolr(Solr):
     def __init__(self, port=1234, temp_home=None, solr_home=None, **kargs):
@@ -246,57 +573,89 @@ class TestSolr(Solr):
         self.stop()
 
 
-class TestAmcatSolr(amcattest.PolicyTestCase):
-    def test_query(self):
+@contextmanager
+def get_test_solr():
+    """
+    Context manager that yields a solr instance for testing with an empty index:
+    a test solr server, or an embedded index if SOLR_BACKEND is 'embedded'
+    """
+    if SOLR_BACKEND != 'embedded':
         with TestSolr() as solr:
-            a1 = amcattest.create_test_article(text='een dit is een test bla', headline='bla bla')
-            a2 = amcattest.create_test_article(text='en alweer een test blo')
-            # can we add articles, and are the right articles returned?
-            solr.add_articles([a1, a2])
-            self.assertEqual(set(solr.query_ids("test")), set([a1.id, a2.id]))
-            self.assertEqual(set(solr.query_ids("alweer")), set([a2.id]))
-            
-            # test phrase queries
-            self.assertEqual(len(solr.query('"een test"').results), 2)
-            self.assertEqual(len(solr.query('"test bla"').results), 1)
-            self.assertEqual(len(solr.query('"een bla"').results), 0)
-            # BUG: door de complex phrase query is de ordering er nu af?
-            #self.assertEqual(len(solr.query('"bla test"').results), 0) 
-            self.assertEqual(len(solr.query('"test bl*"').results), 2)
-            self.assertEqual(len(solr.query('"een bl*"').results), 0)
-            self.assertEqual(len(solr.query('"een bl*"~2').results), 2)
-            self.assertEqual(len(solr.query('"een (bl* -blo)"~2').results), 1)
-            self.assertEqual(len(solr.query('"een (bla OR blo)"~2').results), 2)
-            self.assertEqual(len(solr.query('"dit bl*"~5').results), 1)
-            
-            # can we delete an article, and are the scores correct?
-            solr.delete_articles([a2])
-            self.assertEqual(set(solr.query("alweer")), set([]))
-            self.assertEqual(solr.query("test", fields=["id", "mediumid"]).results,
-                             [dict(score=1.0, id=a1.id, mediumid=a1.medium_id)])
-            self.assertEqual(solr.query("een", fields=["id"]).results,
-                             [dict(score=2.0, id=a1.id)])
-            self.assertEqual(solr.query("bla", fields=["id", "sets"]).results,
-                             [dict(score=3.0, id=a1.id)])
-            # does update via 'add' work, and is set membership done correctly?
-            s1 = amcattest.create_test_set()
-            s1.add(a1)
-            a1.headline="bla"
-            a1.save()
-            solr.add_articles([Article.objects.get(pk=a1.id)])
-            self.assertEqual(solr.query("bla", fields=["id", "sets"]).results,
-                             [dict(score=2.0, id=a1.id, sets=[s1.id])])
-            # test query_all
-            arts = [amcattest.create_test_article(text='en alweer een test')
-                    for i in range(195)]
-            solr.add_articles(arts)
-            # normal query returns 10 results
-            self.assertEqual(len(solr.query("test").results), 10)
-            self.assertEqual(len(solr.query("test", rows=100).results), 100)
-            self.assertEqual(len(list(solr.query_all("test"))), 196) # a1 + 195 new
-
-            
+            yield solr
+        return
+    from amcat.tools.amcatindex import EmbeddedSolr
+    path = tempfile.mkdtemp()
+    try:
+        yield EmbeddedSolr(path)
+    finally:
+        shutil.rmtree(path)
 
+class TestAmcatSolr(amcattest.PolicyTestCase):
+    def test_query(self):
+        with get_test_solr() as solr:
+            self._check_query(solr)
+
+    def test_query_embedded(self):
+        """Does the embedded index give the same results as solr?"""
+        from amcat.tools.amcatindex import EmbeddedSolr
+        path = tempfile.mkdtemp()
+        try:
+            self._check_query(EmbeddedSolr(path))
+        finally:
+            shutil.rmtree(path)
+
+    def _check_query(self, solr):
+        a1 = amcattest.create_test_article(text='een dit is een test bla', headline='bla bla')
+        a2 = amcattest.create_test_article(text='en alweer een test blo')
+        # can we add articles, and are the right articles returned?
+        solr.add_articles([a1, a2])
+        self.assertEqual(set(solr.query_ids("test")), set([a1.id, a2.id]))
+        self.assertEqual(set(solr.query_ids("alweer")), set([a2.id]))
+        
+        # test phrase queries
+        self.assertEqual(len(solr.query('"een test"').results), 2)
+        self.assertEqual(len(solr.query('"test bla"').results), 1)
+        self.assertEqual(len(solr.query('"een bla"').results), 0)
+        # BUG: door de complex phrase query is de ordering er nu af?
+        #self.assertEqual(len(solr.query('"bla test"').results), 0) 
+        self.assertEqual(len(solr.query('"test bl*"').results), 2)
+        self.assertEqual(len(solr.query('"een bl*"').results), 0)
+        self.assertEqual(len(solr.query('"een bl*"~2').results), 2)
+        self.assertEqual(len(solr.query('"een (bl* -blo)"~2').results), 1)
+        self.assertEqual(len(solr.query('"een (bla OR blo)"~2').results), 2)
+        self.assertEqual(len(solr.query('"dit bl*"~5').results), 1)
+        
+        # can we delete an article, and are the scores correct?
+        solr.delete_articles([a2])
+        self.assertEqual(set(solr.query("alweer")), set([]))
+        self.assertEqual(solr.query("test", fields=["id", "mediumid"]).results,
+                         [dict(score=1.0, id=a1.id, mediumid=a1.medium_id)])
+        self.assertEqual(solr.query("een", fields=["id"]).results,
+                         [dict(score=2.0, id=a1.id)])
+        self.assertEqual(solr.query("bla", fields=["id", "sets"]).results,
+                         [dict(score=3.0, id=a1.id)])
+        # does update via 'add' work, and is set membership done correctly?
+        s1 = amcattest.create_test_set()
+        s1.add(a1)
+        a1.headline="bla"
+        a1.save()
+        solr.add_articles([Article.objects.get(pk=a1.id)])
+        self.assertEqual(solr.query("bla", fields=["id", "sets"]).results,
+                         [dict(score=2.0, id=a1.id, sets=[s1.id])])
+        # test query_all
+        arts = [amcattest.create_test_article(text='en alweer een test')
+                for i in range(195)]
+        solr.add_articles(arts)
+        # normal query returns 10 results
+        self.assertEqual(len(solr.query("test").results), 10)
+        self.assertEqual(len(solr.query("test", rows=100).results), 100)
+        self.assertEqual(len(list(solr.query_all("test"))), 196) # a1 + 195 new
+        # query_all in multiple batches returns every article exactly once
+        ids = [row["id"] for row in solr.query_all("test", batch=50, fields=["date"])]
+        self.assertEqual(len(ids), 196)
+        self.assertEqual(ids, sorted(set(ids)))
+
+    @unittest.skipIf(SOLR_BACKEND == 'embedded', "Needs a solr server")
     def test_version(self):
         with TestSolr() as solr:
             url = "{solr.url}/admin/registry.jsp".format(**locals())
@@ -319,7 +678,50 @@ class TestAmcatSolr(amcattest.PolicyTestCase):
         args = query_args_from_form(form)
         self.assertEqual(args, dict(start=100, rows=100, filters=[
                     u'mediumid:{m.id}'.format(**locals()),
-                    u'sets:{s1.id} OR sets:{s2.id}'.format(**locals())]))
+                    u'sets:({s1.id} OR {s2.id})'.format(**locals())]))
+
+    def test_terms_filter(self):
+        """Are filters canonical, regardless of order and duplicates?"""
+        self.assertEqual(terms_filter("id", [3, 1, 2, 1]), "id:(1 OR 2 OR 3)")
+        self.assertEqual(terms_filter("id", [2, 1]), terms_filter("id", [1, 2]))
+        self.assertEqual(terms_filter("sets", [7]), "sets:7")
+        self.assertEqual(terms_filter("id", []), None)
+        # large lists are split in clauses that solr accepts
+        f = terms_filter("id", range(2500))
+        self.assertEqual(f.count("id:("), 3)
+        self.assertEqual(f.count(" OR ") + 1, 2500)
+
+    def test_connection_pool(self):
+        """Are connections reused, and are pools shared between Solr objects?"""
+        pool = ConnectionPool("http://localhost:1234/solr", size=2)
+        with pool.connection() as c1:
+            with pool.connection() as c2:
+                self.assertIsNot(c1, c2)
+        with pool.connection() as c3:
+            self.assertIn(c3, (c1, c2))
+        self.assertIs(get_pool(Solr().url), get_pool(Solr().url))
+
+    def test_query_cache_key(self):
+        """Are query cache keys normalised and invalidated by a new generation?"""
+        url = "http://localhost:1234/solr"
+        key = _query_cache_key(url, "test ", ["a:1", "b:2"], dict(fields=["id", "date"], rows=10))
+        self.assertEqual(key, _query_cache_key(url, "test", ["b:2", "a:1"],
+                                               dict(rows=10, fields="id,date")))
+        self.assertNotEqual(key, _query_cache_key(url, "test", ["a:1", "b:2"],
+                                                  dict(rows=20, fields="id,date")))
+        bump_generation(url)
+        self.assertNotEqual(key, _query_cache_key(url, "test", ["a:1", "b:2"],
+                                                  dict(rows=10, fields="id,date")))
+
+    def test_commit_pending(self):
+        """Are changes pending until the commitWithin period has passed?"""
+        url = "http://localhost:1234/solr"
+        cache.delete(PENDING_KEY.format(url=url))
+        self.assertFalse(commit_pending(url))
+        set_commit_pending(url, 10000)
+        self.assertTrue(commit_pending(url))
+        cache.set(PENDING_KEY.format(url=url), time.time() - 1)
+        self.assertFalse(commit_pending(url))
 
     def test_clean(self):
         """Test whether cleaning works correctly"""
@@ -355,6 +757,7 @@ class TestAmcatSolr(amcattest.PolicyTestCase):
             self.assertEqual(ad2[k], v, "Article 2 %s %r!=%r" % (k, ad2[k], v))
 
 
+    @unittest.skipIf(SOLR_BACKEND == 'embedded', "Highlighting needs a solr server")
     def test_highlight(self):
         with TestSolr() as solr:
             blabla  = "bla bla bla bla bla bla \n" *50
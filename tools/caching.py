@@ -36,10 +36,15 @@ from django.db import models
 
 log = logging.getLogger(__name__)
 from functools import wraps, partial
+from collections import OrderedDict
+import threading
+import time
+import cPickle as pickle
 
 from django.conf import settings
 from django.core.cache import cache
 from django.db.models import signals
+from django.db.models.fields import FieldDoesNotExist
 
 SIMPLE_CACHE_SECONDS = getattr(settings, 'SIMPLE_CACHE_SECONDS', 2592000)
 
@@ -120,30 +125,110 @@ def set_cache(obj, name, value, cache_attr=""):
 #                       O B J E C T   C A C H I N G                       #
 ###########################################################################
 
-# Setup thread-local cache for codebooks
-import threading
-_object_cache = threading.local()
+# size and lifetime (None for no timeout) of the object caches,
+# OBJECT_CACHE_SIZES can give the size for specific models, e.g. {'Codebook' : 100}
+OBJECT_CACHE_SIZE = getattr(settings, 'OBJECT_CACHE_SIZE', 10000)
+OBJECT_CACHE_SECONDS = getattr(settings, 'OBJECT_CACHE_SECONDS', None)
+OBJECT_CACHE_SIZES = getattr(settings, 'OBJECT_CACHE_SIZES', {})
+
+class LocalCache(object):
+    """
+    Thread-safe in-memory cache that keeps at most maxsize values for at most
+    timeout seconds (if not None), discarding the least recently used values
+    first. The number of hits, misses and evictions are kept in stats.
+    """
+    def __init__(self, maxsize, timeout=None):
+        self.maxsize, self.timeout = maxsize, timeout
+        self.stats = dict(hits=0, misses=0, evictions=0)
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._values.pop(key)
+            except KeyError:
+                self.stats["misses"] += 1
+                return None
+            if expires is not None and expires < time.time():
+                self.stats["misses"] += 1
+                self.stats["evictions"] += 1
+                return None
+            self._values[key] = (expires, value)
+            self.stats["hits"] += 1
+            return value
+
+    def _set(self, key, value):
+        self._values.pop(key, None)
+        expires = None if self.timeout is None else time.time() + self.timeout
+        self._values[key] = (expires, value)
+        while len(self._values) > self.maxsize:
+            self._values.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def __len__(self):
+        return len(self._values)
+
+class ObjectCache(LocalCache):
+    """
+    LocalCache for the objects of a model. Saving or deleting an object of the
+    model increases the version, which clears the cache and prevents objects
+    that were retrieved before the change from being stored afterwards.
+    """
+    def __init__(self, model):
+        super(ObjectCache, self).__init__(OBJECT_CACHE_SIZES.get(model.__name__, OBJECT_CACHE_SIZE),
+                                          OBJECT_CACHE_SECONDS)
+        self.version = 0
+
+    def invalidate(self, *args, **kargs):
+        with self._lock:
+            self.version += 1
+            self._values.clear()
+
+    def set(self, key, value, version=None):
+        """Store the value, unless the cache was invalidated since version"""
+        with self._lock:
+            if version is None or version == self.version:
+                self._set(key, value)
+
+_object_caches = {}
+_object_caches_lock = threading.Lock()
 
 def _get_object_cache(model):
-    key = CACHE_PREFIX + model.__name__
     try:
-        return getattr(_object_cache, key)
-    except AttributeError:
-        cache = {}
-        setattr(_object_cache, key, cache)
-        return cache
+        return _object_caches[model]
+    except KeyError:
+        with _object_caches_lock:
+            if model not in _object_caches:
+                cache = ObjectCache(model)
+                uid = CACHE_PREFIX + model._meta.db_table
+                signals.post_save.connect(cache.invalidate, sender=model, weak=False, dispatch_uid=uid)
+                signals.post_delete.connect(cache.invalidate, sender=model, weak=False, dispatch_uid=uid)
+                _object_caches[model] = cache
+            return _object_caches[model]
 
 def get_object(model, pk, create_if_needed=True, pkname='pk'):
     """Create the model object with the given pk, possibly retrieving it
     from cache"""
     cache = _get_object_cache(model)
-    try:
-        return cache[pk]
-    except KeyError:
-        if create_if_needed:
-            cache[pk] = model.objects.get(**{pkname : pk})
-            return cache[pk]
-
+    obj = cache.get(pk)
+    if obj is None and create_if_needed:
+        version = cache.version
+        obj = model.objects.get(**{pkname : pk})
+        cache.set(pk, obj, version)
+    return obj
 
 def get_objects(model, pks):
     """
@@ -159,48 +244,180 @@ def get_objects(model, pks):
             yield obj
     if not todo: return
     cache = _get_object_cache(model)
+    version = cache.version
     for obj in model.objects.filter(pk__in=todo):
-        cache[obj.id] = obj
+        cache.set(obj.id, obj, version)
         yield obj
-    
+
 def clear_cache(model):
     """Clear the local codebook cache manually, ie in between test runs"""
-    key = CACHE_PREFIX + model.__name__
-    setattr(_object_cache, key , {})
+    _get_object_cache(model).clear()
+
+def object_cache_stats():
+    """Return a {model name : stats} dict with the size, hits, misses and evictions per object cache"""
+    return dict((model.__name__, dict(size=len(cache), **cache.stats))
+                for (model, cache) in _object_caches.items())
 
 ###########################################################################
 #                  D J A N G O  M O D E L  C A C H I N G                  #
 ###########################################################################
+
+# size and lifetime of the per process cache in front of the django cache.
+# other processes only invalidate the django cache, so the lifetime bounds
+# how long a process can see a row that was changed elsewhere
+ROW_CACHE_LOCAL_SIZE = getattr(settings, 'ROW_CACHE_LOCAL_SIZE', 1000)
+ROW_CACHE_LOCAL_SECONDS = getattr(settings, 'ROW_CACHE_LOCAL_SECONDS', 10)
+
 def _get_cache_key(model, id):
     return ('%s:%s' % (model._meta.db_table, id)).replace(' ', '')
 
 class RowCacheManager(models.Manager):
     """
-    Manager for caching single-row queries. To make invalidation easy,
-    we use an extra layer of indirection. The query arguments are used as a
-    cache key, whose stored value is the unique cache key pointing to the
-    object. When a model using RowCacheManager is saved, this unique cache
-    should be invalidated. Doing two memcached queries is still much faster
-    than fetching from the database.
+    Manager for caching single-row queries. Rows are cached in a small per
+    process cache in front of the django cache. Lookups by primary key use
+    the row's unique cache key directly. Other lookups use an extra layer of
+    indirection: the query arguments are used as a cache key, whose stored
+    value is the unique cache key pointing to the object. The unique key is
+    invalidated when an object is saved or deleted.
+
+    The per process cache holds pickled objects, so (like the django cache)
+    every caller gets its own copy that it can change without affecting other
+    callers or threads. The number of hits and misses are kept in the counters dict.
     """
+    def __init__(self):
+        super(RowCacheManager, self).__init__()
+        self.local = LocalCache(ROW_CACHE_LOCAL_SIZE, ROW_CACHE_LOCAL_SECONDS)
+        self.counters = dict(local_hits=0, hits=0, misses=0)
+        self._counters_lock = threading.Lock()
+
+    def _count(self, counter, n=1):
+        with self._counters_lock:
+            self.counters[counter] += n
+
+    def _local_get(self, key):
+        data = self.local.get(key)
+        return None if data is None else pickle.loads(data)
+
+    def _local_set(self, key, value):
+        self.local.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def contribute_to_class(self, model, name):
+        super(RowCacheManager, self).contribute_to_class(model, name)
+        uid = "rowcache_%s_%s" % (model._meta.db_table, name)
+        signals.post_save.connect(self._handle_change, sender=model, weak=False, dispatch_uid=uid)
+        signals.post_delete.connect(self._handle_change, sender=model, weak=False, dispatch_uid=uid)
+
+    def _handle_change(self, sender, instance, **kargs):
+        self.invalidate(instance.pk)
+
+    def invalidate(self, pk):
+        """Remove the object with the given primary key from the caches"""
+        key = _get_cache_key(self.model, pk)
+        self.local.delete(key)
+        cache.delete(key)
+
+    def _pk_lookup(self, kwargs):
+        """Return the primary key if kwargs is a lookup by primary key, otherwise None"""
+        if len(kwargs) == 1:
+            (field, value), = kwargs.items()
+            pk = self.model._meta.pk
+            if field.replace("__exact", "") in ("pk", pk.name, pk.attname):
+                return value
+
+    def _matches(self, instance, kwargs):
+        """
+        Does the instance (still) match the lookup? Lookups that cannot be
+        checked on the instance are treated as not matching.
+        """
+        for lookup, value in kwargs.iteritems():
+            if lookup.endswith("__exact"):
+                lookup = lookup[:-len("__exact")]
+            try:
+                field = self.model._meta.get_field(lookup)
+            except FieldDoesNotExist:
+                return False
+            if field.rel:
+                value = getattr(value, "pk", value)
+            if getattr(instance, field.attname) != value:
+                return False
+        return True
+
+    def _get_cached(self, key):
+        """Get the value from the local or django cache, updating the counters"""
+        value = self._local_get(key)
+        if value is not None:
+            self._count("local_hits")
+            return value
+        value = cache.get(key)
+        if value is not None:
+            self._local_set(key, value)
+        return value
+
     def get(self, *args, **kwargs):
-        pointer_key = _get_cache_key(self.model, repr(kwargs))
-        instance_key = cache.get(pointer_key)
+        if args or self.get_query_set().query.where:
+            # not a simple lookup, e.g. using Q objects or through a related manager
+            return super(RowCacheManager, self).get(*args, **kwargs)
 
-        if instance_key is not None: 
-            instance = cache.get(instance_key)
-            if instance is not None:
+        pk = self._pk_lookup(kwargs)
+        if pk is not None:
+            pointer_key, instance_key = None, _get_cache_key(self.model, pk)
+        else:
+            pointer_key = _get_cache_key(self.model, repr(kwargs))
+            instance_key = self._get_cached(pointer_key)
+
+        if instance_key is not None:
+            instance = self._get_cached(instance_key)
+            # the looked up fields of the object may have changed since the pointer was cached
+            if instance is not None and (pointer_key is None or self._matches(instance, kwargs)):
+                self._count("hits")
                 return instance
 
         # One of the cache queries missed, so we have to get the object from the database:
+        self._count("misses")
         instance = super(RowCacheManager, self).get(*args, **kwargs)
-        if not instance_key:
-            instance_key = _get_cache_key(instance, instance.pk)
+        # a pointer may point to another object than the one that matches now
+        instance_key = _get_cache_key(instance, instance.pk)
+        if pointer_key is not None:
             cache.set(pointer_key, instance_key, SIMPLE_CACHE_SECONDS)
+            self._local_set(pointer_key, instance_key)
 
         cache.set(instance_key, instance, SIMPLE_CACHE_SECONDS)
+        self._local_set(instance_key, instance)
         return instance
 
+    def get_many(self, pks):
+        """
+        Return a {pk : object} dict of the objects with the given primary keys,
+        using one django cache request and at most one query for the misses.
+        Missing objects are not included.
+        """
+        keys = dict((_get_cache_key(self.model, pk), pk) for pk in pks)
+        result, todo = {}, []
+        for key, pk in keys.iteritems():
+            instance = self._local_get(key)
+            if instance is None:
+                todo.append(key)
+            else:
+                result[pk] = instance
+        self._count("local_hits", len(result))
+
+        if todo:
+            found = cache.get_many(todo)
+            for key, instance in found.iteritems():
+                result[keys[key]] = instance
+                self._local_set(key, instance)
+            self._count("hits", len(found))
+            todo = [keys[key] for key in todo if key not in found]
+
+        if todo:
+            self._count("misses", len(todo))
+            missing = super(RowCacheManager, self).get_query_set().in_bulk(todo)
+            values = dict((_get_cache_key(self.model, pk), instance) for (pk, instance) in missing.iteritems())
+            cache.set_many(values, SIMPLE_CACHE_SECONDS)
+            for key, instance in values.iteritems():
+                self._local_set(key, instance)
+            result.update(missing)
+        return result
     
 ###########################################################################
 #                          U N I T   T E S T S                            #
@@ -327,6 +544,65 @@ class TestCaching(amcattest.PolicyTestCase):
         self.assertEqual(t.get_y(), 1)
         self.assertTrue(t.changed)
 
+    def test_local_cache(self):
+        c = LocalCache(maxsize=2, timeout=60)
+        c.set("a", 1); c.set("b", 2)
+        self.assertEqual(c.get("a"), 1)
+        c.set("c", 3) # b is the least recently used
+        self.assertEqual((c.get("a"), c.get("b"), c.get("c")), (1, None, 3))
+        c.delete("a")
+        self.assertEqual(c.get("a"), None)
+        c.timeout = -1
+        c.set("d", 4)
+        self.assertEqual(c.get("d"), None)
+
+    def test_row_cache(self):
+        """Are cached rows invalidated on save and delete?"""
+        from amcat.models.article import Article
+        a = amcattest.create_test_article(headline="old")
+        self.assertEqual(Article.objects.get(pk=a.id).headline, "old")
+        with self.checkMaxQueries(0, "Get cached article"):
+            self.assertEqual(Article.objects.get(id=a.id).headline, "old")
+        # every caller gets its own copy
+        copy = Article.objects.get(pk=a.id)
+        copy.headline = "changed"
+        self.assertEqual(Article.objects.get(pk=a.id).headline, "old")
+
+        a.headline = "new"
+        a.save()
+        self.assertEqual(Article.objects.get(pk=a.id).headline, "new")
+
+        b = amcattest.create_test_article()
+        with self.checkMaxQueries(1, "Get multiple articles"):
+            self.assertEqual(Article.objects.get_many([a.id, b.id]), {a.id : a, b.id : b})
+        with self.checkMaxQueries(0, "Get multiple cached articles"):
+            self.assertEqual(set(Article.objects.get_many([a.id, b.id])), {a.id, b.id})
+
+        bid = b.id
+        b.delete()
+        self.assertEqual(Article.objects.get_many([a.id, bid]).keys(), [a.id])
+        self.assertRaises(Article.DoesNotExist, Article.objects.get, pk=bid)
+        self.assertTrue(Article.objects.counters["misses"] > 0)
+
+    def test_row_cache_lookup(self):
+        """Are lookups on other fields than the primary key right after the field changes?"""
+        from amcat.models.article import Article
+        a = amcattest.create_test_article(headline="lookup")
+        b = amcattest.create_test_article(headline="other")
+        self.assertEqual(Article.objects.get(headline="lookup").id, a.id)
+        with self.checkMaxQueries(0, "Get cached article by headline"):
+            self.assertEqual(Article.objects.get(headline="lookup").id, a.id)
+        a.headline = "changed"
+        a.save()
+        self.assertEqual(Article.objects.get(pk=a.id).headline, "changed")
+        # the cached pointer still points to a, which no longer matches
+        self.assertRaises(Article.DoesNotExist, Article.objects.get, headline="lookup")
+        b.headline = "lookup"
+        b.save()
+        self.assertEqual(Article.objects.get(headline="lookup").id, b.id)
+        self.assertEqual(Article.objects.get(pk=a.id).headline, "changed")
+        self.assertEqual(Article.objects.get(pk=b.id).headline, "lookup")
+
     def test_object_cache(self):
         from amcat.models.project import Project
         pid = amcattest.create_test_project().id
@@ -354,5 +630,31 @@ class TestCaching(amcattest.PolicyTestCase):
         
         with self.checkMaxQueries(0, "Get multiple cached projects one by one"):
             ps = [get_objects(Project, pid) for pid in pids]
+
+    def test_object_cache_invalidation(self):
+        from amcat.models.project import Project
+        p = amcattest.create_test_project()
+        cache = _get_object_cache(Project)
+        cache.clear()
+        self.assertIs(get_object(Project, p.id), get_object(Project, p.id))
+
+        # saving a project invalidates the cache
+        version = cache.version
+        p.name = "new name"
+        p.save()
+        self.assertEqual(get_object(Project, p.id).name, "new name")
+
+        # an object retrieved before the save is not stored
+        cache.set("x", "stale", version)
+        self.assertEqual(cache.get("x"), None)
+        self.assertIn("misses", object_cache_stats()["Project"])
+
+        # the cache is bounded
+        cache.maxsize = 2
+        pids = [amcattest.create_test_project().id for _x in range(3)]
+        list(get_objects(Project, pids))
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.stats["evictions"] > 0)
+        cache.maxsize = OBJECT_CACHE_SIZE
         
 #from amcat.tools import amcatlogging; amcatlogging.infoModule()
@@ -21,11 +21,12 @@
 
 from __future__ import unicode_literals, print_function, absolute_import
 
-import hashlib, re
+import hashlib, re, datetime, os, socket, select
 from contextlib import contextmanager
 
 from django.db import connection, connections, transaction, DEFAULT_DB_ALIAS
 from django.db.utils import DatabaseError
+from django.db.models import Q
 from django.conf import settings
 from django.core.cache import cache
 
@@ -33,6 +34,9 @@ import logging; log = logging.getLogger(__name__)
 
 PASSWORD_CACHE = 'amcat_password_{username}'
 
+# seconds a worker can hold a row claimed with claim_rows
+QUEUE_LEASE_SECONDS = getattr(settings, 'QUEUE_LEASE_SECONDS', 3600)
+
 class UserAlreadyExists(DatabaseError):
     """User already exists in the database"""
     pass
@@ -44,6 +48,34 @@ class Database(object):
         self.using = using or DEFAULT_DB_ALIAS
         self._cursor = None
 
+    def claim_rows(self, queryset, n, worker, lease):
+        """
+        Claim at most n rows of the queryset for the worker for lease seconds.
+        This generic implementation is not safe for concurrent use.
+        @return: the primary keys of the claimed rows
+        """
+        model, pkname = queryset.model, queryset.model._meta.pk.name
+        now = datetime.datetime.now()
+        free = Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+        pks = list(queryset.filter(free).order_by(pkname).values_list(pkname, flat=True)[:n])
+        model.objects.filter(free, pk__in=pks).update(
+            claimed_by=worker, claimed_until=now + datetime.timedelta(seconds=lease))
+        return list(model.objects.filter(pk__in=pks, claimed_by=worker).values_list(pkname, flat=True))
+
+    def notify(self, channel):
+        """
+        Notify the processes listening on the channel, when the current
+        transaction is committed. Does nothing if the database does not
+        support notifications.
+        """
+
+    def listen(self, channels):
+        """
+        @return: a Listener for notifications on the channels, or None if the
+                 database does not support notifications
+        """
+        return None
+
     @property
     def cursor(self):
         """Get a cursor on the database.
@@ -101,9 +133,60 @@ class Database(object):
             b'port' : int(db['PORT'])
         }
 
+class Listener(object):
+    """
+    Receives postgres notifications on the given channels, using a separate
+    connection in autocommit mode. Notifications that arrive while the
+    listener is not waiting are kept until the next call to wait.
+    """
+    def __init__(self, conn_params, channels):
+        import psycopg2, psycopg2.extensions # lazy import to prevent global dependency
+        self.conn = psycopg2.connect(**conn_params)
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.conn.cursor()
+        for channel in channels:
+            cursor.execute('LISTEN "{channel}"'.format(**locals()))
+
+    def wait(self, timeout):
+        """Wait at most timeout seconds for a notification, returns whether one was received"""
+        if not self.conn.notifies:
+            if select.select([self.conn], [], [], timeout) == ([], [], []):
+                return False
+            self.conn.poll()
+        received = bool(self.conn.notifies)
+        del self.conn.notifies[:]
+        return received
+
+    def close(self):
+        self.conn.close()
+
 class PostgreSQL(Database):
     """PostgreSQL implementation"""
 
+    def notify(self, channel):
+        self.cursor.execute('NOTIFY "{channel}"'.format(**locals()))
+        # outside a managed transaction the notification would wait for the next commit
+        transaction.commit_unless_managed(using=self.using)
+
+    def listen(self, channels):
+        db = settings.DATABASES[self.using]
+        return Listener(self._get_conn_params(db['USER'], db['PASSWORD']), channels)
+
+    def claim_rows(self, queryset, n, worker, lease):
+        # The lease condition is checked again by the UPDATE: if a concurrent
+        # claim updated a candidate row first, postgres re-evaluates the
+        # condition on the updated row and skips it
+        quote = connections[self.using].ops.quote_name
+        table, pk = quote(queryset.model._meta.db_table), quote(queryset.model._meta.pk.column)
+        free = "({table}.claimed_until IS NULL OR {table}.claimed_until < now())".format(**locals())
+        pkname = queryset.model._meta.pk.name
+        candidates = queryset.extra(where=[free]).order_by(pkname).values_list(pkname, flat=True)[:n]
+        sql, params = candidates.query.get_compiler(using=self.using).as_sql()
+        self.cursor.execute("UPDATE {table} SET claimed_by = %s,"
+                            " claimed_until = now() + %s * interval '1 second'"
+                            " WHERE {pk} IN ({sql}) AND {free} RETURNING {pk}".format(**locals()),
+                            [worker, lease] + list(params))
+        return [row[0] for row in self.cursor.fetchall()]
 
     def check_password(self, username, entered_password):
         import psycopg2 # lazy import to prevent global dependency
@@ -306,6 +389,28 @@ def get_database(using=DEFAULT_DB_ALIAS):
     except KeyError:
         raise DatabaseError("Your database (%s) is not supported!" % connection.vendor)
 
+def get_worker_id():
+    """Identify this process in queue claims"""
+    return "{host}:{pid}".format(host=socket.gethostname(), pid=os.getpid())
+
+@transaction.commit_on_success
+def claim_rows(queryset, n, worker=None, lease=QUEUE_LEASE_SECONDS):
+    """
+    Claim at most n rows of the queryset, e.g. from a queue table, so that
+    concurrent workers (possibly on other hosts) do not process the same rows.
+    The model needs claimed_by and claimed_until fields. The rows are claimed
+    for lease seconds: rows whose lease has expired, e.g. because the worker
+    crashed, can be claimed again. The claim is committed immediately, so
+    don't call this inside the transaction that processes the rows.
+
+    @return: a list of the primary keys of the claimed rows
+    """
+    return get_database().claim_rows(queryset, n, worker or get_worker_id(), lease)
+
+def notify(channel):
+    """Notify the processes listening on the channel when the current transaction is committed"""
+    get_database().notify(channel)
+
 def is_postgres():
     """Is the current database postgres?"""
     return connections.databases['default']['ENGINE'] == 'django.db.backends.postgresql_psycopg2'
@@ -359,6 +464,23 @@ class TestDBToolkit(amcattest.PolicyTestCase):
 
         self.assertFalse(db.user_exists(username))
 
+from django.test import TransactionTestCase
+from unittest import skipUnless
+
+class TestNotify(TransactionTestCase):
+    # a TransactionTestCase, as a TestCase never commits, so it cannot send notifications
+
+    @skipUnless(is_postgres(), "notifications are only supported by postgres")
+    def test_notify(self):
+        """Does a listener on another connection receive a notification sent outside a transaction?"""
+        listener = get_database().listen(["amcat_test_notify"])
+        try:
+            self.assertFalse(listener.wait(0))
+            notify("amcat_test_notify")
+            self.assertTrue(listener.wait(5))
+        finally:
+            listener.close()
+
 def run_test():
     """
     for some reason, django testing gets in the way of creating users
@@ -0,0 +1,160 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+"""
+Near-duplicate detection using MinHash signatures and locality sensitive
+hashing (LSH).
+
+A text is represented by the set of its word shingles (sequences of SHINGLE
+consecutive words). The similarity of two texts is the Jaccard similarity
+of their shingle sets, which is estimated by the fraction of positions at
+which their MinHash signatures agree. The signatures are divided in bands,
+and texts that agree on all positions of at least one band are candidate
+duplicates.
+
+NearDuplicates processes the texts one at a time and only keeps the
+signatures of the first text of each cluster, so it can scan large
+collections as long as the texts are streamed from the database.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+from array import array
+import random
+import re
+import zlib
+
+import logging; log = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# number of words per shingle
+SHINGLE = 4
+# the signature consists of BANDS bands of ROWS values each. Texts with a
+# similarity s become candidates with probability 1 - (1 - s^ROWS)^BANDS,
+# which is about 0.5 for s=0.5 and over 0.99 for s=0.8
+BANDS = 16
+ROWS = 4
+
+def shingles(text, size=SHINGLE):
+    """Return the set of (32 bit) hashes of the word shingles of the text"""
+    words = WORD_RE.findall(text.lower())
+    if len(words) < size:
+        words = words + [""] * (size - len(words))
+    return set(zlib.crc32(" ".join(words[i:i+size]).encode("utf-8")) & 0xffffffff
+               for i in xrange(len(words) - size + 1))
+
+class MinHasher(object):
+    """
+    Computes MinHash signatures of texts. Instead of random permutations,
+    the shingle hashes are xor-ed with random masks, which is much faster in
+    python and works as well for texts.
+    """
+    def __init__(self, bands=BANDS, rows=ROWS, seed=0):
+        self.bands, self.rows = bands, rows
+        rnd = random.Random(seed)
+        self.masks = [rnd.getrandbits(32) for _i in range(bands * rows)]
+
+    def signature(self, text):
+        hashes = shingles(text)
+        return array(b"L", [min(map(mask.__xor__, hashes)) for mask in self.masks])
+
+    def band_keys(self, signature):
+        """Return the (band, key) pairs of the signature used for bucketing"""
+        return [(b, hash(tuple(signature[b * self.rows:(b + 1) * self.rows])))
+                for b in range(self.bands)]
+
+def similarity(sig1, sig2):
+    """Estimate the Jaccard similarity of the texts with the given signatures"""
+    return sum(1 for (x, y) in zip(sig1, sig2) if x == y) / float(len(sig1))
+
+class NearDuplicates(object):
+    """
+    Clusters texts with an estimated similarity of at least threshold. Each
+    text is compared to the first text (the 'representative') of the clusters
+    it shares a band with, and added to the most similar cluster.
+    """
+    def __init__(self, threshold=0.8, hasher=None):
+        self.threshold = threshold
+        self.hasher = hasher or MinHasher()
+        self.signatures = {} # representative : signature
+        self.buckets = {} # (band, key) : [representatives]
+        self.clusters = {} # representative : [duplicates]
+
+    def add(self, key, text):
+        """Add the text, returning the key of the representative of its cluster"""
+        sig = self.hasher.signature(text)
+        bands = self.hasher.band_keys(sig)
+        candidates = set()
+        for band in bands:
+            candidates.update(self.buckets.get(band, ()))
+        best, best_sim = None, self.threshold
+        for candidate in candidates:
+            sim = similarity(sig, self.signatures[candidate])
+            if sim >= best_sim:
+                best, best_sim = candidate, sim
+        if best is not None:
+            self.clusters.setdefault(best, []).append(key)
+            return best
+        self.signatures[key] = sig
+        for band in bands:
+            self.buckets.setdefault(band, []).append(key)
+        return key
+
+    def get_clusters(self):
+        """Return the clusters with more than one text as lists of keys, representative first"""
+        return [[rep] + dups for (rep, dups) in self.clusters.iteritems()]
+
+def find_near_duplicates(texts, threshold=0.8):
+    """
+    Cluster the texts from a sequence of (key, text) pairs
+    @return: a list of clusters (lists of keys, the first key seen first)
+    """
+    nd = NearDuplicates(threshold)
+    for key, text in texts:
+        if text:
+            nd.add(key, text)
+    return nd.get_clusters()
+
+###########################################################################
+#                          U N I T   T E S T S                            #
+###########################################################################
+
+from amcat.tools import amcattest
+
+class TestMinHash(amcattest.PolicyTestCase):
+
+    TEXT = ("De minister van financien heeft vandaag in Den Haag de plannen voor de"
+            " nieuwe begroting gepresenteerd. Volgens de minister is er voor het"
+            " komende jaar geen ruimte voor lastenverlichting, maar worden de"
+            " bezuinigingen op onderwijs en zorg wel verzacht.")
+
+    def test_similarity(self):
+        h = MinHasher()
+        edited = self.TEXT.replace("vandaag", "gisteren") + " (ANP)"
+        other = "Het Nederlands elftal heeft gisteravond met twee-nul gewonnen van Duitsland."
+        self.assertEqual(similarity(h.signature(self.TEXT), h.signature(self.TEXT.upper())), 1.0)
+        self.assertTrue(similarity(h.signature(self.TEXT), h.signature(edited)) > 0.6)
+        self.assertTrue(similarity(h.signature(self.TEXT), h.signature(other)) < 0.2)
+
+    def test_clusters(self):
+        texts = [(1, self.TEXT), (2, "Iets heel anders dan de andere teksten in deze lijst"),
+                 (3, self.TEXT.replace("Den Haag", "Den  Haag,")), (4, ""), (5, self.TEXT)]
+        clusters = find_near_duplicates(texts, threshold=0.7)
+        self.assertEqual(clusters, [[1, 3, 5]])